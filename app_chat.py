@@ -1,17 +1,116 @@
 import os
-from flask import Flask, request, jsonify
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
 
 # --- UPDATED IMPORTS ---
 # We now only need to import the router function and potentially get_last_story
 from story_engine import (
     handle_user_message,
+    stream_user_message,
+    TYPING_MARKER,
+    cache_stats,
+    gateway_stats,
+    pipeline_stats,
+    pool_stats,
+    index_stats,
+    store_stats,
+    audio_renderer,
+    story_audio_id,
+    config_errors,
+    warm_up,
     get_last_story # Kept for potential external checks, though not strictly required for the new router logic
 )
 
+from llm_gateway import DeadlineExceeded, UpstreamError
+from story_batch import follow_results, job_stats, start_job
+import metrics
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# "request": a per-stage timing breakdown is added to /chat responses that ask for it
+# ({"timing": true} or an X-Debug-Timing: 1 header); "always" adds it to every
+# response; "off" never does.
+CHAT_TIMING = os.getenv("CHAT_TIMING", "request").lower()
+# How long an audio chunk request waits for the chunk to finish rendering.
+AUDIO_WAIT_SECONDS = float(os.getenv("AUDIO_WAIT_SECONDS", "10"))
+# Build the engine's store and clients in the background at startup, so /health
+# answers at once and the first /chat does not pay for them. "false" builds them
+# on first use instead (tests, one-off scripts).
+ENGINE_WARMUP = os.getenv("ENGINE_WARMUP", "true").lower() == "true"
+
+def _warm_up():
+    try:
+        warm_up()
+    except Exception as e:
+        print(f"Engine warm-up failed: {e}")
+
+if ENGINE_WARMUP and not config_errors():
+    threading.Thread(target=_warm_up, name="engine-warmup", daemon=True).start()
+
+def health_payload() -> Tuple[int, dict]:
+    """200 when the configuration is valid, else 503 with the problems (nothing is built)."""
+    errors = config_errors()
+    return (503, {"ok": False, "config_errors": errors}) if errors else (200, {"ok": True})
+
+def timing_requested(data: Mapping[str, Any], headers: Mapping[str, str]) -> bool:
+    if CHAT_TIMING == "always":
+        return True
+    if CHAT_TIMING != "request":
+        return False
+    return bool(data.get("timing")) or headers.get("X-Debug-Timing", "") in ("1", "true")
+
+def observe_request(route: str, status: int, started: float, timer: Optional[metrics.RequestTimer] = None,
+                    payload: Optional[dict] = None):
+    """Records the request in story_chat_request_seconds and attaches the timing breakdown."""
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route, str(status))
+    if timer is not None and payload is not None:
+        payload["timing"] = timer.breakdown()
+
+def upstream_error(e: Exception) -> Tuple[int, dict, Dict[str, str]]:
+    """Status, body and headers for an LLM failure: 504 past the deadline, else 503."""
+    if isinstance(e, DeadlineExceeded):
+        return 504, {"type": "error", "error": "The story took too long to write. Please try again."}, {}
+    retry_after = getattr(e, "retry_after", None)
+    headers = {"Retry-After": str(max(1, round(retry_after)))} if retry_after else {"Retry-After": "5"}
+    return 503, {"type": "error", "error": "The story service is busy right now. Please try again."}, headers
+
+def chat_payload(response: str, response_type: str, revisions) -> dict:
+    """Shapes a handle_user_message result into the /chat JSON body."""
+    payload = _chat_payload(response, response_type, revisions)
+    audio_id = story_audio_id(response) if response_type in ("story", "refinement") else None
+    if audio_id:
+        payload["audio"] = {"id": audio_id, "url": f"/audio/{audio_id}"}
+    return payload
+
+def _chat_payload(response: str, response_type: str, revisions) -> dict:
+    if response_type == "story" or response_type == "refusal":
+        # New story generation result (or refusal)
+        return {
+            "type": "story",
+            "story": response,
+            # Revisions will be 0 or 1, indicating if the internal judge forced a rewrite
+            "internal_revisions": revisions,
+            "status": response_type # "story" or "refusal"
+        }
+
+    elif response_type == "refinement":
+        # Story refinement result
+        return {
+            "type": "refined",
+            "story": response # This is the newly refined story text
+        }
+
+    else: # response_type == "chat"
+        # Simple chat reply result
+        return {
+            "type": "chat",
+            "reply": response
+        }
+
 @app.route("/chat", methods=["POST"])
 def chat():
     """
@@ -25,43 +124,180 @@ def chat():
     if not user_msg:
         return jsonify({"type": "chat", "reply": "Please send a message or a request for a story!"}), 200
 
+    started = time.perf_counter()
+    timer = None
     try:
-        # The router function handles intent detection and execution internally
-        response, response_type, revisions = handle_user_message(session_id, user_msg)
-
-        if response_type == "story" or response_type == "refusal":
-            # New story generation result (or refusal)
-            return jsonify({
-                "type": "story",
-                "story": response,
-                # Revisions will be 0 or 1, indicating if the internal judge forced a rewrite
-                "internal_revisions": revisions,
-                "status": response_type # "story" or "refusal"
-            })
-
-        elif response_type == "refinement":
-            # Story refinement result
-            return jsonify({
-                "type": "refined",
-                "story": response # This is the newly refined story text
-            })
-
-        else: # response_type == "chat"
-            # Simple chat reply result
-            return jsonify({
-                "type": "chat",
-                "reply": response
-            })
+        with metrics.request_timer(timing_requested(data, request.headers)) as timer:
+            # The router function handles intent detection and execution internally
+            response, response_type, revisions = handle_user_message(session_id, user_msg)
+
+        payload = chat_payload(response, response_type, revisions)
+        observe_request(response_type, 200, started, timer, payload)
+        return jsonify(payload)
+
+    except (UpstreamError, DeadlineExceeded) as e:
+        print(f"Upstream LLM failure in the chat endpoint: {e}")
+        status, body, headers = upstream_error(e)
+        observe_request("error", status, started, timer, body)
+        return jsonify(body), status, headers
 
     except Exception as e:
         # Log the error on the server side
         print(f"An error occurred in the chat endpoint: {e}")
-        return jsonify({"type": "error", "error": f"An internal server error occurred: {str(e)}"}), 500
+        body = {"type": "error", "error": f"An internal server error occurred: {str(e)}"}
+        observe_request("error", 500, started, timer, body)
+        return jsonify(body), 500
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Streaming version of /chat. The body is plain text: `[typing] ...` status lines
+    while the request is routed and judged, then the reply text in small chunks.
+    """
+    data = request.get_json(force=True) or {}
+    session_id = data.get("session", "default-session").strip()
+    user_msg = (data.get("message") or "").strip()
+
+    if not user_msg:
+        return Response("Please send a message or a request for a story!", mimetype="text/plain")
+
+    # The generator runs after this view returns, outside the request context.
+    timing = timing_requested(data, request.headers)
+    result_line = f"{TYPING_MARKER} result:"
+
+    def generate():
+        started = time.perf_counter()
+        route, status, timer = "error", 200, None
+        try:
+            with metrics.request_timer(timing) as timer:
+                for chunk in stream_user_message(session_id, user_msg):
+                    if chunk.startswith(result_line):
+                        route = chunk[len(result_line):].strip()
+                    yield chunk
+        except GeneratorExit:
+            status = 499  # client went away mid-stream
+            raise
+        except (UpstreamError, DeadlineExceeded) as e:
+            print(f"Upstream LLM failure in the chat stream endpoint: {e}")
+            status, body, _ = upstream_error(e)
+            yield f"\n{body['error']}"
+        except Exception as e:
+            # Headers are already sent, so report the failure inside the stream.
+            print(f"An error occurred in the chat stream endpoint: {e}")
+            status = 500
+            yield f"\nAn internal server error occurred: {str(e)}"
+        finally:
+            observe_request(route, status, started, timer)
+
+    return Response(generate(), mimetype="text/plain", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # stop nginx from buffering the chunks
+    })
+
+
+@app.route("/cache/stats")
+def llm_cache_stats():
+    return jsonify(cache_stats())
+
+
+@app.route("/llm/stats")
+def llm_gateway_stats():
+    return jsonify(gateway_stats())
+
+
+@app.route("/pipeline/stats")
+def story_pipeline_stats():
+    return jsonify(pipeline_stats())
+
+
+@app.route("/pool/stats")
+def story_pool_stats():
+    return jsonify(pool_stats())
+
+
+@app.route("/index/stats")
+def story_index_stats():
+    return jsonify(index_stats())
+
+
+@app.route("/store/stats")
+def session_store_stats():
+    return jsonify(store_stats())
+
+
+@app.route("/batch", methods=["POST"])
+def batch_start():
+    """
+    Starts a batch job from a JSONL body of themes (see story_batch.py). Posting the
+    same body again resumes the job without redoing finished items.
+    """
+    try:
+        job_id, stats = start_job(request.get_data())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(dict(stats, id=job_id, status_url=f"/batch/{job_id}",
+                        results_url=f"/batch/{job_id}/results")), 202
+
+
+@app.route("/batch/<job_id>")
+def batch_status(job_id: str):
+    stats = job_stats(job_id)
+    if stats is None:
+        return jsonify({"error": "No such batch job."}), 404
+    return jsonify(stats)
+
+
+@app.route("/batch/<job_id>/results")
+def batch_results(job_id: str):
+    """Result lines as JSONL, streamed as they are written while the job runs."""
+    lines = follow_results(job_id)
+    if lines is None:
+        return jsonify({"error": "No such batch job."}), 404
+    return Response(lines, mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+
+@app.route("/audio/<story_id>")
+def story_audio_manifest(story_id: str):
+    """Chunks of a story's audio with their URLs and whether each is rendered yet."""
+    renderer = audio_renderer()
+    manifest = renderer.manifest(story_id) if renderer is not None else None
+    if manifest is None:
+        return jsonify({"error": "No audio for this story."}), 404
+    for i, chunk in enumerate(manifest["chunks"]):
+        chunk.pop("key")
+        chunk["url"] = f"/audio/{story_id}/{i}"
+    return jsonify(manifest)
+
+
+@app.route("/audio/<story_id>/<int:index>")
+def story_audio_chunk(story_id: str, index: int):
+    """One audio chunk; waits up to AUDIO_WAIT_SECONDS for it to render. Supports Range requests."""
+    renderer = audio_renderer()
+    manifest = renderer.manifest(story_id) if renderer is not None else None
+    if manifest is None or not 0 <= index < len(manifest["chunks"]):
+        return jsonify({"error": "No such audio chunk."}), 404
+    path = renderer.chunk_path(story_id, index, wait=AUDIO_WAIT_SECONDS)
+    if path is None:
+        return jsonify({"error": "The audio is still being prepared."}), 503, {"Retry-After": "1"}
+    return send_file(path, mimetype=manifest["media_type"], conditional=True, max_age=86400)
+
+
+@app.route("/audio/stats")
+def story_audio_stats():
+    renderer = audio_renderer()
+    return jsonify(renderer.stats() if renderer is not None else {"enabled": False})
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/health")
 def health():
-    return {"ok": True}
+    status, body = health_payload()
+    return jsonify(body), status
 
 if __name__ == "__main__":
     # Ensure all components are loaded before running the app
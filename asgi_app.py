@@ -0,0 +1,110 @@
+# asgi_app.py
+"""
+Async server entry point: the /chat, /metrics and /health endpoints of app_chat.py served by
+story_engine_async, so a worker waits on the upstream API without holding a thread.
+
+    uvicorn asgi_app:app --workers 2
+
+Plain ASGI (no framework) to keep the dependency footprint to a server such as uvicorn.
+"""
+import json
+import time
+
+from story_engine_async import ahandle_user_message
+from app_chat import chat_payload, health_payload, observe_request, timing_requested, upstream_error
+from llm_gateway import DeadlineExceeded, UpstreamError
+import metrics
+
+_CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"content-type"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+]
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def _send_json(send, status: int, payload: dict, headers: dict = None):
+    body = json.dumps(payload).encode("utf-8")
+    extra = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode())] + extra + _CORS_HEADERS,
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def chat(scope, receive, send):
+    """Same contract as app_chat.chat."""
+    try:
+        data = json.loads(await _read_body(receive) or b"{}") or {}
+    except ValueError:
+        data = {}
+    session_id = (data.get("session") or "default-session").strip()
+    user_msg = (data.get("message") or "").strip()
+
+    if not user_msg:
+        await _send_json(send, 200, {"type": "chat", "reply": "Please send a message or a request for a story!"})
+        return
+
+    headers = {k.decode("latin-1").title(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    started = time.perf_counter()
+    timer = None
+    try:
+        with metrics.request_timer(timing_requested(data, headers)) as timer:
+            response, response_type, revisions = await ahandle_user_message(session_id, user_msg)
+    except (UpstreamError, DeadlineExceeded) as e:
+        print(f"Upstream LLM failure in the async chat endpoint: {e}")
+        status, body, extra = upstream_error(e)
+        observe_request("error", status, started, timer, body)
+        await _send_json(send, status, body, extra)
+        return
+    except Exception as e:
+        print(f"An error occurred in the async chat endpoint: {e}")
+        body = {"type": "error", "error": f"An internal server error occurred: {str(e)}"}
+        observe_request("error", 500, started, timer, body)
+        await _send_json(send, 500, body)
+        return
+    payload = chat_payload(response, response_type, revisions)
+    observe_request(response_type, 200, started, timer, payload)
+    await _send_json(send, 200, payload)
+
+async def _send_text(send, status: int, text: str, content_type: bytes):
+    body = text.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 204, "headers": _CORS_HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+    elif path == "/chat" and method == "POST":
+        await chat(scope, receive, send)
+    elif path == "/metrics":
+        await _send_text(send, 200, metrics.render(), b"text/plain; version=0.0.4")
+    elif path == "/health":
+        await _send_json(send, *health_payload())
+    else:
+        await _send_json(send, 404, {"type": "error", "error": "Not found"})
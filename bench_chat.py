@@ -0,0 +1,274 @@
+# bench_chat.py
+"""
+End-to-end load test of POST /chat with synthetic sessions.
+
+By default the Flask app is started in-process on the deterministic fake LLM
+backend (LLM_BACKEND=fake) with a fresh SQLite store, so no API key or quota is
+needed and results are comparable between runs. Each of --sessions concurrent
+clients plays the same script (chat, new story, refine, refine, chat) --rounds
+times, and the run reports:
+
+  - p50 / p95 / p99 latency per route (new_story, refine, chat),
+  - time spent in the session store per request (in-process runs only),
+  - LLM calls per story and generation time per pipeline mode (in-process runs only),
+  - requests per second and errors.
+
+Every run is appended to --results (JSON lines) and compared with the previous
+run that used the same settings; --max-regression makes a slower run fail.
+
+    python bench_chat.py
+    python bench_chat.py --sessions 32 --rounds 3 --latency "*=lognormal:200,0.3"
+    python bench_chat.py --pipeline self_judge --rewrite-policy violations
+    python bench_chat.py --url http://127.0.0.1:5000     # an already running server
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+THEMES = ["a bunny who shares", "a sleepy owl", "a brave little boat", "a dragon who loves tea",
+          "a kitten learning to swim", "a robot planting flowers", "a snail's big race", "a lost star"]
+
+def session_script(i: int) -> List[Tuple[str, str]]:
+    """(route, message) turns of one synthetic session."""
+    return [
+        ("chat", "hi there!"),
+        ("new_story", f"tell me a story about {THEMES[i % len(THEMES)]}"),
+        ("refine", "make it shorter"),
+        ("refine", "add a friendly dragon"),
+        ("chat", "thank you, that was lovely"),
+    ]
+
+
+# ============================================================
+# IN-PROCESS SERVER
+# ============================================================
+class _TimedStore:
+    """Wraps the session store and accumulates the time spent in each of its methods."""
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.seconds[name] += time.perf_counter() - t0
+                    self.calls[name] += 1
+        return timed
+
+
+def start_local_server(args) -> Tuple[str, Optional[_TimedStore]]:
+    """Starts app_chat on a free port with the configured backend and a temp store."""
+    workdir = tempfile.mkdtemp(prefix="bench-chat-")
+    os.environ["LLM_BACKEND"] = args.backend
+    os.environ["MEMORY_DB_PATH"] = os.path.join(workdir, "sessions.db")
+    os.environ["MEMORY_JSON_PATH"] = os.path.join(workdir, "none.json")
+    os.environ.setdefault("FAKE_LLM_SEED", "0")
+    if args.latency:
+        os.environ["FAKE_LLM_LATENCY_MS"] = args.latency
+    if args.no_cache:
+        os.environ["LLM_CACHE_ENABLED"] = "false"
+    os.environ["STORY_PIPELINE"] = args.pipeline
+    os.environ["STORY_REWRITE_POLICY"] = args.rewrite_policy
+
+    import story_engine
+    from app_chat import app
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    timed = _TimedStore(story_engine.app_context().store)
+    story_engine.app_context().store = timed
+    server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", timed
+
+
+# ============================================================
+# LOAD
+# ============================================================
+def _post(conn: http.client.HTTPConnection, path: str, payload: Dict[str, Any]) -> int:
+    conn.request("POST", path, body=json.dumps(payload), headers={"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    resp.read()
+    return resp.status
+
+
+def run_session(url: str, i: int, rounds: int, run_id: str,
+                samples: Dict[str, List[float]], errors: List[str], lock: threading.Lock):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.netloc, timeout=120)
+    session = f"bench-{run_id}-{i}"
+    for _ in range(rounds):
+        for route, message in session_script(i):
+            t0 = time.perf_counter()
+            try:
+                status = _post(conn, parts.path.rstrip("/") + "/chat", {"session": session, "message": message})
+            except (OSError, http.client.HTTPException) as e:
+                status, conn = f"{type(e).__name__}: {e}", http.client.HTTPConnection(parts.netloc, timeout=120)
+            elapsed = time.perf_counter() - t0
+            with lock:
+                if status == 200:
+                    samples[route].append(elapsed)
+                else:
+                    errors.append(f"{route}: {status}")
+    conn.close()
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    if len(samples) < 2:
+        return {"n": len(samples), "p50_ms": round(samples[0] * 1000, 1) if samples else 0.0}
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"n": len(samples), "p50_ms": round(q[49] * 1000, 1),
+            "p95_ms": round(q[94] * 1000, 1), "p99_ms": round(q[98] * 1000, 1)}
+
+
+# ============================================================
+# RESULTS HISTORY
+# ============================================================
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _previous(path: str, config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                if row.get("config") == config:
+                    last = row
+    return last
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any], max_regression: float) -> List[str]:
+    """Prints deltas against `previous` and returns the metrics that regressed too much."""
+    print(f"\nvs previous run {previous['rev']} ({previous['timestamp']}):")
+    regressions = []
+    for route, stats in current["routes"].items():
+        old = previous["routes"].get(route, {})
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if metric in stats and old.get(metric):
+                change = stats[metric] / old[metric] - 1
+                print(f"  {route:<10}{metric:<8}{old[metric]:>9.1f} -> {stats[metric]:>9.1f}  ({change:+.1%})")
+                if max_regression and change > max_regression:
+                    regressions.append(f"{route} {metric} {change:+.1%}")
+    if previous.get("rps"):
+        change = current["rps"] / previous["rps"] - 1
+        print(f"  {'rps':<18}{previous['rps']:>9.2f} -> {current['rps']:>9.2f}  ({change:+.1%})")
+        if max_regression and -change > max_regression:
+            regressions.append(f"rps {change:+.1%}")
+    return regressions
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sessions", type=int, default=16, help="concurrent synthetic sessions")
+    ap.add_argument("--rounds", type=int, default=2, help="times each session replays its script")
+    ap.add_argument("--url", default="", help="benchmark a running server instead of an in-process one")
+    ap.add_argument("--backend", default="fake", help="LLM_BACKEND for the in-process server")
+    ap.add_argument("--latency", default="", help="FAKE_LLM_LATENCY_MS, e.g. '*=fixed:50'")
+    ap.add_argument("--no-cache", action="store_true", help="disable the LLM cache")
+    ap.add_argument("--pipeline", default="judge_loop", help="STORY_PIPELINE: judge_loop, self_judge or ab")
+    ap.add_argument("--rewrite-policy", default="any", help="STORY_REWRITE_POLICY: any, violations or never")
+    ap.add_argument("--results", default="bench_results.jsonl")
+    ap.add_argument("--label", default="", help="free-form note stored with the results")
+    ap.add_argument("--max-regression", type=float, default=0.0,
+                    help="fail if a latency percentile grows (or rps drops) by more than this fraction")
+    args = ap.parse_args()
+
+    timed = None
+    url = args.url
+    if not url:
+        url, timed = start_local_server(args)
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    errors: List[str] = []
+    lock = threading.Lock()
+    run_id = str(int(time.time()))
+    threads = [threading.Thread(target=run_session, args=(url, i, args.rounds, run_id, samples, errors, lock))
+               for i in range(args.sessions)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    requests = sum(len(v) for v in samples.values()) + len(errors)
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rev": _git_rev(),
+        "label": args.label,
+        "config": {"sessions": args.sessions, "rounds": args.rounds, "target": args.url or "in-process",
+                   "backend": args.backend, "latency": args.latency, "cache": not args.no_cache,
+                   "pipeline": args.pipeline, "rewrite_policy": args.rewrite_policy},
+        "routes": {route: _summary(v) for route, v in sorted(samples.items())},
+        "requests": requests,
+        "errors": len(errors),
+        "wall_s": round(wall, 2),
+        "rps": round(requests / wall, 2),
+    }
+    if timed is not None:
+        result["store_ms_per_request"] = round(sum(timed.seconds.values()) * 1000 / max(requests, 1), 3)
+        result["store_ms_per_call"] = {name: round(timed.seconds[name] * 1000 / timed.calls[name], 3)
+                                       for name in sorted(timed.calls)}
+        from story_engine import pipeline_stats
+        result["pipeline"] = pipeline_stats()
+
+    print(f"{requests} requests from {args.sessions} sessions in {wall:.2f}s "
+          f"({result['rps']:.2f} req/s), {len(errors)} errors")
+    print(f"{'route':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, stats in result["routes"].items():
+        print(f"{route:<12}{stats['n']:>6}" + "".join(
+            f"{stats.get(m, float('nan')):>10.1f}" for m in ("p50_ms", "p95_ms", "p99_ms")))
+    if timed is not None:
+        print(f"store I/O: {result['store_ms_per_request']:.3f} ms per request; per call: "
+              + ", ".join(f"{k} {v:.3f} ms" for k, v in result["store_ms_per_call"].items()))
+        for mode, stats in result["pipeline"].items():
+            print(f"pipeline {mode}: {stats['stories']} stories, {stats['llm_calls_per_story']:.2f} LLM calls "
+                  f"per story, {stats['rewrite_rate']:.0%} rewritten, {stats['mean_ms']:.1f} ms per story")
+    for e in errors[:10]:
+        print(f"  ERROR {e}")
+
+    previous = _previous(args.results, result["config"])
+    regressions = compare(result, previous, args.max_regression) if previous else []
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(f"\nresults appended to {args.results}")
+
+    for r in regressions:
+        print(f"REGRESSION: {r}")
+    return 1 if errors or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
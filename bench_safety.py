@@ -0,0 +1,77 @@
+# bench_safety.py
+"""
+Accuracy and speed of the local safety pre-screen (safety_screen.py) on the
+labeled corpus in safety_corpus.jsonl.
+
+    python bench_safety.py
+    python bench_safety.py --corpus my_corpus.jsonl --repeat 2000
+
+Accuracy: an "unsafe" verdict on a safe story is a false refusal and fails the
+run. On a safe instruction it is a false positive: the request is sent to the LLM
+request check instead of straight to the pipeline, so it costs a call but is not refused;
+the false-positive rate is reported. Unsafe texts that are not caught are fine as
+long as they are not "clean" (the LLM judge still sees them).
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from safety_screen import screen
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--corpus", default="safety_corpus.jsonl")
+    ap.add_argument("--repeat", type=int, default=500, help="timing repetitions per text")
+    args = ap.parse_args()
+
+    with open(args.corpus, "r", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+
+    counts = {}
+    false_refusals, false_positives, clean_misses = [], [], []
+    for row in rows:
+        verdict = screen(row["text"]).verdict
+        key = (row["kind"], row["label"], verdict)
+        counts[key] = counts.get(key, 0) + 1
+        if row["label"] == "safe" and verdict == "unsafe":
+            (false_positives if row["kind"] == "instruction" else false_refusals).append(row["text"])
+        if row["label"] == "unsafe" and verdict == "clean":
+            clean_misses.append(row["text"])
+
+    print(f"{'kind':<12}{'label':<8}{'unsafe':>8}{'review':>8}{'clean':>8}")
+    for kind in ("instruction", "story"):
+        for label in ("unsafe", "safe"):
+            cells = [counts.get((kind, label, v), 0) for v in ("unsafe", "review", "clean")]
+            if sum(cells):
+                print(f"{kind:<12}{label:<8}" + "".join(f"{c:>8}" for c in cells))
+
+    story_times, instr_times = [], []
+    for row in rows:
+        text = row["text"]
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            screen(text)
+        per_call = (time.perf_counter() - t0) / args.repeat * 1e6
+        (story_times if row["kind"] == "story" else instr_times).append(per_call)
+
+    for name, times in (("story", story_times), ("instruction", instr_times)):
+        if times:
+            print(f"{name} screening: mean {statistics.mean(times):.1f} us, "
+                  f"max {max(times):.1f} us over {len(times)} texts")
+
+    safe_instructions = sum(1 for row in rows if row["kind"] == "instruction" and row["label"] == "safe")
+    if safe_instructions:
+        print(f"instruction false positives (sent to the request check): {len(false_positives)}/{safe_instructions} "
+              f"({len(false_positives) / safe_instructions:.0%})")
+    for text in false_positives:
+        print(f"FALSE POSITIVE: {text[:80]!r}")
+    for text in false_refusals:
+        print(f"FALSE REFUSAL: {text[:80]!r}")
+    for text in clean_misses:
+        print(f"UNSAFE MARKED CLEAN: {text[:80]!r}")
+    return 1 if false_refusals or clean_misses else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+# bench_startup.py
+"""
+Startup cost of the chat server: import time and time to the first /health.
+
+Each sample runs in a fresh interpreter on the fake LLM backend with a scratch
+store directory:
+
+  - import:  `python -X importtime -c "import app_chat"`; the cumulative time of
+    the top-level import, plus the modules with the largest self time;
+  - health:  starts app_chat on a local port and polls GET /health until it
+    answers 200; the time from process start.
+
+Medians over --runs are appended to --results (JSON lines) and compared with the
+previous run with the same settings. --import-budget-ms / --health-budget-ms (and
+--max-regression) make a slow run fail, so CI can hold the line.
+
+    python bench_startup.py
+    python bench_startup.py --runs 10 --import-budget-ms 400 --health-budget-ms 1500
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+from bench_chat import _git_rev, _previous
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_SERVE = """
+import sys
+sys.path.insert(0, {root!r})
+from app_chat import app
+from werkzeug.serving import make_server
+make_server("127.0.0.1", {port}, app, threaded=True).serve_forever()
+"""
+
+
+def _env(workdir: str, warmup: bool) -> Dict[str, str]:
+    env = dict(os.environ, LLM_BACKEND="fake", ENGINE_WARMUP="true" if warmup else "false",
+               MEMORY_DB_PATH=os.path.join(workdir, "sessions.db"),
+               MEMORY_JSON_PATH=os.path.join(workdir, "none.json"),
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def import_sample(module: str, env: Dict[str, str], workdir: str) -> Tuple[float, Dict[str, float]]:
+    """(cumulative ms of `import module`, self ms per imported module)."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env,
+                          cwd=workdir, capture_output=True, text=True, check=True)
+    total, self_ms = 0.0, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        self_ms[name.strip()] = int(own) / 1000
+        if name.rstrip() == " " + module:  # nested imports are indented further
+            total = int(cumulative) / 1000
+    return total, self_ms
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def health_sample(env: Dict[str, str], workdir: str, timeout: float = 30.0) -> float:
+    """Milliseconds from starting the server process to its first 200 on /health."""
+    port = _free_port()
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", _SERVE.format(root=ROOT, port=port)], env=env,
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with code {proc.returncode}")
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            try:
+                conn.request("GET", "/health")
+                if conn.getresponse().status == 200:
+                    return (time.perf_counter() - t0) * 1000
+            except OSError:
+                time.sleep(0.005)
+            finally:
+                conn.close()
+        raise RuntimeError(f"no healthy answer within {timeout:.0f}s")
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    ap.add_argument("--module", default="app_chat", help="module whose import is timed")
+    ap.add_argument("--no-warmup", action="store_true", help="ENGINE_WARMUP=false in the server")
+    ap.add_argument("--top", type=int, default=10, help="modules listed by self time")
+    ap.add_argument("--import-budget-ms", type=float, default=0.0, help="fail above this median (0 = no budget)")
+    ap.add_argument("--health-budget-ms", type=float, default=0.0, help="fail above this median (0 = no budget)")
+    ap.add_argument("--results", default="bench_results.jsonl")
+    ap.add_argument("--label", default="", help="free-form note stored with the results")
+    ap.add_argument("--max-regression", type=float, default=0.0,
+                    help="fail if a median grows by more than this fraction over the previous run")
+    args = ap.parse_args()
+
+    imports: List[float] = []
+    health: List[float] = []
+    self_ms: Dict[str, List[float]] = {}
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        env = _env(workdir, warmup=not args.no_warmup)
+        import_sample(args.module, env, workdir)  # compile the .pyc files first
+        for _ in range(args.runs):
+            total, own = import_sample(args.module, env, workdir)
+            imports.append(total)
+            for name, ms in own.items():
+                self_ms.setdefault(name, []).append(ms)
+            health.append(health_sample(env, workdir))
+
+    result: Dict[str, Any] = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rev": _git_rev(),
+        "label": args.label,
+        "config": {"bench": "startup", "module": args.module, "runs": args.runs, "warmup": not args.no_warmup},
+        "import_ms": round(statistics.median(imports), 1),
+        "health_ms": round(statistics.median(health), 1),
+        "top_self_ms": dict(sorted(((n, round(statistics.median(v), 1)) for n, v in self_ms.items()),
+                                   key=lambda kv: -kv[1])[:args.top]),
+    }
+    print(f"import {args.module}: median {result['import_ms']:.1f} ms "
+          f"(min {min(imports):.1f}, max {max(imports):.1f}) over {args.runs} runs")
+    print(f"first /health: median {result['health_ms']:.1f} ms (min {min(health):.1f}, max {max(health):.1f})")
+    print("largest self import times:")
+    for name, ms in result["top_self_ms"].items():
+        print(f"  {ms:>8.1f} ms  {name}")
+
+    failures = []
+    previous = _previous(args.results, result["config"])
+    if previous:
+        print(f"\nvs previous run {previous['rev']} ({previous['timestamp']}):")
+        for metric in ("import_ms", "health_ms"):
+            change = result[metric] / previous[metric] - 1
+            print(f"  {metric:<10}{previous[metric]:>9.1f} -> {result[metric]:>9.1f}  ({change:+.1%})")
+            if args.max_regression and change > args.max_regression:
+                failures.append(f"REGRESSION: {metric} {change:+.1%}")
+    for metric, budget in (("import_ms", args.import_budget_ms), ("health_ms", args.health_budget_ms)):
+        if budget and result[metric] > budget:
+            failures.append(f"OVER BUDGET: {metric} {result[metric]:.1f} > {budget:.1f}")
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    print(f"\nresults appended to {args.results}")
+
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# eval_router.py
+"""
+Offline evaluation of the local fast-path router against the LLM Intent Classifier.
+
+Replays every user message stored in sessions.json (with the "story active" flag it
+had at that point in the conversation), routes it with both routers, and reports
+how often the fast path fires, how often it agrees with the LLM, and how much
+routing latency it would have saved.
+
+The LLM side always calls the model: the intent classifier's response cache is
+switched off for the run, so repeat runs measure the model, not cache hits.
+
+    python eval_router.py                       # needs GEMINI_API_KEY (LLM_BACKEND=gemini)
+    LLM_BACKEND=fake python eval_router.py      # offline, no key; canned labels and latency
+    python eval_router.py --sessions sessions.json --threshold 0.85 --limit 50
+"""
+import argparse
+import json
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from intent_router import LocalIntentRouter, DEFAULT_MODEL_PATH
+from memory_store import STORY_TAG
+
+def replay_messages(sessions: Dict[str, List[Dict[str, str]]]) -> List[Tuple[str, bool]]:
+    """(user_message, has_story) pairs in conversation order."""
+    out = []
+    for history in sessions.values():
+        has_story = False
+        for m in history:
+            if m["role"] == "human":
+                out.append((m["content"], has_story))
+            elif m["content"].startswith(STORY_TAG):
+                has_story = True
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sessions", default="sessions.json")
+    ap.add_argument("--model", default=DEFAULT_MODEL_PATH)
+    ap.add_argument("--threshold", type=float, default=None,
+                    help="confidence threshold (default: story_engine.LOCAL_ROUTER_THRESHOLD)")
+    ap.add_argument("--limit", type=int, default=0, help="evaluate at most N messages")
+    args = ap.parse_args()
+
+    # Imported late: story_engine reads its configuration from the environment at import.
+    import story_engine
+    story_engine.LLM_CACHE_ROUTES.discard("intent_classifier_tool")  # time the model, not the cache
+
+    threshold = story_engine.LOCAL_ROUTER_THRESHOLD if args.threshold is None else args.threshold
+    router = LocalIntentRouter.load(args.model)
+
+    with open(args.sessions, "r", encoding="utf-8") as f:
+        messages = replay_messages(json.load(f))
+    if args.limit:
+        messages = messages[:args.limit]
+
+    llm_ms, local_ms = [], []
+    fast, fast_agree, all_agree = 0, 0, 0
+    disagreements = []
+    for text, has_story in messages:
+        t0 = time.perf_counter()
+        raw = story_engine._invoke(story_engine.app_context().judge_llm,
+                                   story_engine.INTENT_CLASSIFIER_PROMPT(text, has_story),
+                                   "intent_classifier_tool")
+        llm_intent, _ = story_engine._parse_intent(raw, text, has_story)
+        llm_ms.append((time.perf_counter() - t0) * 1000)
+
+        t0 = time.perf_counter()
+        local_intent, confidence = router.classify(text)
+        local_ms.append((time.perf_counter() - t0) * 1000)
+        if local_intent == "refine" and not has_story:
+            local_intent = "new_story"
+
+        all_agree += local_intent == llm_intent
+        if confidence >= threshold:
+            fast += 1
+            if local_intent == llm_intent:
+                fast_agree += 1
+            else:
+                disagreements.append((text, local_intent, llm_intent, confidence))
+
+    n = len(messages)
+    if not n:
+        print("no user messages found")
+        return
+    mean_llm = statistics.mean(llm_ms)
+    print(f"messages evaluated:        {n}")
+    print(f"threshold:                 {threshold}")
+    print(f"fast-path coverage:        {fast}/{n} ({fast / n:.1%})")
+    print(f"agreement on fast path:    {fast_agree}/{fast} ({fast_agree / max(fast, 1):.1%})")
+    print(f"agreement, all messages:   {all_agree}/{n} ({all_agree / n:.1%})")
+    print(f"LLM router latency:        mean {mean_llm:.0f} ms, p50 {statistics.median(llm_ms):.0f} ms")
+    print(f"local router latency:      mean {statistics.mean(local_ms):.3f} ms")
+    print(f"routing time saved:        {fast * mean_llm / 1000:.1f} s total, "
+          f"{fast * mean_llm / n:.0f} ms per message on average")
+    for text, local_intent, llm_intent, confidence in disagreements[:20]:
+        print(f"  MISMATCH local={local_intent} ({confidence:.2f}) llm={llm_intent}: {text[:70]!r}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# fake_llm_server.py
+"""
+Local stand-in for the upstream LLM API, for testing llm_gateway.py and load
+testing the app without spending quota.
+
+Speaks the HttpChatModel protocol (POST /v1/chat -> {"content": ...}) and answers
+with the same canned router / judge / story / chat replies as the in-process fake
+backend (llm_backends.canned_reply).
+Latency and failures are injected on purpose:
+
+    python fake_llm_server.py --port 8765 --latency-ms 400 --jitter-ms 150 \\
+        --tail-rate 0.02 --tail-ms 4000 --throttle-rate 0.05 --error-rate 0.02
+
+then point the app at it with LLM_BASE_URL=http://127.0.0.1:8765.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from llm_backends import canned_reply, estimated_usage
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], latency_ms: float = 300, jitter_ms: float = 100,
+                 tail_rate: float = 0.0, tail_ms: float = 3000, throttle_rate: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0):
+        super().__init__(address, _Handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "slow": 0,
+                                       "in_flight": 0, "max_in_flight": 0}
+
+    def track(self, delta: int):
+        with self._lock:
+            self.counts["in_flight"] += delta
+            self.counts["max_in_flight"] = max(self.counts["max_in_flight"], self.counts["in_flight"])
+
+    def draw(self) -> Tuple[str, float]:
+        """Outcome ("ok" / "throttled" / "error") and latency in seconds for one request."""
+        with self._lock:
+            self.counts["requests"] += 1
+            r = self._rng.random()
+            if r < self.throttle_rate:
+                outcome = "throttled"
+            elif r < self.throttle_rate + self.error_rate:
+                outcome = "errors"
+            else:
+                outcome = "ok"
+            self.counts[outcome] += 1
+            latency = max(0.0, self._rng.gauss(self.latency_ms, self.jitter_ms))
+            if outcome == "ok" and self._rng.random() < self.tail_rate:
+                self.counts["slow"] += 1
+                latency = self.tail_ms
+        return outcome, latency / 1000.0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so client connection pooling is exercised
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status: int, body: Dict, headers: Dict[str, str] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.server.counts)
+        elif self.path == "/health":
+            self._send(200, {"ok": True})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/v1/chat":
+            self._send(404, {"error": "not found"})
+            return
+        outcome, latency = self.server.draw()
+        if outcome == "throttled":
+            self._send(429, {"error": "quota exceeded"}, {"Retry-After": "0.2"})
+            return
+        self.server.track(1)
+        try:
+            time.sleep(latency)
+        finally:
+            self.server.track(-1)
+        if outcome == "errors":
+            self._send(503, {"error": "upstream overloaded"})
+            return
+        prompt = body.get("prompt", "")
+        reply = canned_reply(prompt)
+        self._send(200, {"content": reply, "usage": estimated_usage(prompt, reply)})
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, **options) -> FakeLLMServer:
+    """Starts a server on a background thread (port 0 picks a free port)."""
+    server = FakeLLMServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency-ms", type=float, default=300)
+    ap.add_argument("--jitter-ms", type=float, default=100)
+    ap.add_argument("--tail-rate", type=float, default=0.0, help="share of requests that are very slow")
+    ap.add_argument("--tail-ms", type=float, default=3000)
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="share answered with 429")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share answered with 503")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    server = FakeLLMServer((args.host, args.port), args.latency_ms, args.jitter_ms, args.tail_rate,
+                           args.tail_ms, args.throttle_rate, args.error_rate, args.seed)
+    print(f"fake LLM listening on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# fake_redis_server.py
+"""
+Local stand-in for a Redis server, for testing RedisMessageHistoryStore and
+running several app nodes against shared sessions without installing Redis.
+
+Speaks RESP2 and implements the subset of commands the session store uses
+(strings, lists, sorted sets, key expiry, MULTI / EXEC / WATCH), in memory and
+single-threaded in effect (one lock around every command):
+
+    python fake_redis_server.py --port 6390
+
+then start the app with MEMORY_BACKEND=redis MEMORY_REDIS_URL=redis://127.0.0.1:6390/0.
+Data is lost when the server stops.
+"""
+import argparse
+import fnmatch
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _Error(Exception):
+    pass
+
+
+_WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int]):
+        super().__init__(address, _Handler)
+        self.lock = threading.Lock()
+        self.data: Dict[bytes, Any] = {}         # bytes (string), list (list), dict member -> score (zset)
+        self.expires: Dict[bytes, float] = {}    # key -> monotonic deadline
+        self.versions: Dict[bytes, int] = {}     # bumped on every change, for WATCH
+        self.commands = 0
+
+    # --- keyspace -------------------------------------------------------
+    def _alive(self, key: bytes) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._delete(key)
+        return key in self.data
+
+    def _delete(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        if self.data.pop(key, None) is None:
+            return False
+        self._touched(key)
+        return True
+
+    def _touched(self, key: bytes):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def _get(self, key: bytes, kind: type) -> Any:
+        if not self._alive(key):
+            return None
+        value = self.data[key]
+        if not isinstance(value, kind):
+            raise _Error(_WRONGTYPE)
+        return value
+
+    def _store(self, key: bytes, value: Any):
+        self.data[key] = value
+        self._touched(key)
+        if isinstance(value, (list, dict)) and not value:
+            self._delete(key)  # empty lists and sorted sets do not exist in Redis
+
+    def version(self, key: bytes) -> int:
+        self._alive(key)
+        return self.versions.get(key, 0)
+
+    # --- commands -------------------------------------------------------
+    def call(self, args: List[bytes]) -> Any:
+        """Runs one command (caller holds the lock) and returns the reply."""
+        self.commands += 1
+        name = args[0].decode().upper()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            raise _Error(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args[1:])
+        except TypeError:
+            raise _Error(f"ERR wrong number of arguments for '{name.lower()}' command") from None
+        except ValueError:
+            raise _Error("ERR value is not an integer or out of range") from None
+
+    def cmd_ping(self, message: Optional[bytes] = None):
+        return "PONG" if message is None else message
+
+    def cmd_select(self, db: bytes):
+        return "OK"
+
+    def cmd_auth(self, *args: bytes):
+        return "OK"
+
+    def cmd_flushall(self, *args: bytes):
+        for key in list(self.data):
+            self._delete(key)
+        return "OK"
+
+    cmd_flushdb = cmd_flushall
+
+    def cmd_dbsize(self):
+        return sum(self._alive(k) for k in list(self.data))
+
+    def cmd_keys(self, pattern: bytes):
+        return [k for k in list(self.data) if self._alive(k) and fnmatch.fnmatchcase(k, pattern)]
+
+    def cmd_exists(self, *keys: bytes):
+        return sum(self._alive(k) for k in keys)
+
+    def cmd_del(self, *keys: bytes):
+        return sum(self._alive(k) and self._delete(k) for k in keys)
+
+    def cmd_get(self, key: bytes):
+        return self._get(key, bytes)
+
+    def cmd_mget(self, *keys: bytes):
+        return [self.data[k] if self._alive(k) and isinstance(self.data[k], bytes) else None for k in keys]
+
+    def cmd_set(self, key: bytes, value: bytes, *options: bytes):
+        opts = [o.upper() for o in options]
+        ttl = None
+        for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+            if unit in opts:
+                ttl = int(opts[opts.index(unit) + 1]) * scale
+        if b"NX" in opts and self._alive(key):
+            return None
+        if b"XX" in opts and not self._alive(key):
+            return None
+        self.expires.pop(key, None)
+        self._store(key, value)
+        if ttl is not None:
+            self.expires[key] = time.monotonic() + ttl
+        return "OK"
+
+    def cmd_incrby(self, key: bytes, amount: bytes):
+        value = int(self._get(key, bytes) or b"0") + int(amount)
+        self._store(key, str(value).encode())
+        return value
+
+    def cmd_incr(self, key: bytes):
+        return self.cmd_incrby(key, b"1")
+
+    def cmd_pexpire(self, key: bytes, ms: bytes):
+        if not self._alive(key):
+            return 0
+        self.expires[key] = time.monotonic() + int(ms) / 1000.0
+        self._touched(key)
+        return 1
+
+    def cmd_expire(self, key: bytes, seconds: bytes):
+        return self.cmd_pexpire(key, str(int(seconds) * 1000).encode())
+
+    def cmd_persist(self, key: bytes):
+        return int(self._alive(key) and self.expires.pop(key, None) is not None)
+
+    def cmd_pttl(self, key: bytes):
+        if not self._alive(key):
+            return -2
+        deadline = self.expires.get(key)
+        return -1 if deadline is None else int((deadline - time.monotonic()) * 1000)
+
+    def cmd_ttl(self, key: bytes):
+        ms = self.cmd_pttl(key)
+        return ms if ms < 0 else round(ms / 1000)
+
+    # lists
+    def cmd_rpush(self, key: bytes, *values: bytes):
+        items = self._get(key, list) or []
+        items.extend(values)
+        self._store(key, items)
+        return len(items)
+
+    def cmd_llen(self, key: bytes):
+        return len(self._get(key, list) or [])
+
+    @staticmethod
+    def _range(length: int, start: int, stop: int) -> slice:
+        start = max(0, start + length if start < 0 else start)
+        stop = stop + length if stop < 0 else stop
+        return slice(start, max(start, stop + 1))
+
+    def cmd_lrange(self, key: bytes, start: bytes, stop: bytes):
+        items = self._get(key, list) or []
+        return items[self._range(len(items), int(start), int(stop))]
+
+    def cmd_lindex(self, key: bytes, index: bytes):
+        items = self._get(key, list) or []
+        i = int(index)
+        return items[i] if -len(items) <= i < len(items) else None
+
+    def cmd_lset(self, key: bytes, index: bytes, value: bytes):
+        items = self._get(key, list)
+        if items is None:
+            raise _Error("ERR no such key")
+        i = int(index)
+        if not -len(items) <= i < len(items):
+            raise _Error("ERR index out of range")
+        items[i] = value
+        self._touched(key)
+        return "OK"
+
+    def cmd_ltrim(self, key: bytes, start: bytes, stop: bytes):
+        items = self._get(key, list)
+        if items is not None:
+            self._store(key, items[self._range(len(items), int(start), int(stop))])
+        return "OK"
+
+    # sorted sets
+    @staticmethod
+    def _score_bound(raw: bytes) -> Tuple[float, bool]:
+        """(bound, exclusive) from "1.5", "(1.5", "-inf" or "+inf"."""
+        exclusive = raw.startswith(b"(")
+        return float(raw[1:] if exclusive else raw), exclusive
+
+    def _by_score(self, key: bytes, low: bytes, high: bytes) -> List[bytes]:
+        (lo, lo_ex), (hi, hi_ex) = self._score_bound(low), self._score_bound(high)
+        members = sorted((self._get(key, dict) or {}).items(), key=lambda kv: (kv[1], kv[0]))
+        return [m for m, s in members
+                if (s > lo if lo_ex else s >= lo) and (s < hi if hi_ex else s <= hi)]
+
+    def cmd_zadd(self, key: bytes, *pairs: bytes):
+        if len(pairs) % 2:
+            raise TypeError
+        members = self._get(key, dict) or {}
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        self._store(key, members)
+        return added
+
+    def cmd_zscore(self, key: bytes, member: bytes):
+        score = (self._get(key, dict) or {}).get(member)
+        return None if score is None else repr(score).encode()
+
+    def cmd_zrem(self, key: bytes, *members: bytes):
+        current = self._get(key, dict) or {}
+        removed = sum(current.pop(m, None) is not None for m in members)
+        if removed:
+            self._store(key, current)
+        return removed
+
+    def cmd_zcard(self, key: bytes):
+        return len(self._get(key, dict) or {})
+
+    def cmd_zrange(self, key: bytes, start: bytes, stop: bytes):
+        members = [m for m, _ in sorted((self._get(key, dict) or {}).items(), key=lambda kv: (kv[1], kv[0]))]
+        return members[self._range(len(members), int(start), int(stop))]
+
+    def cmd_zrangebyscore(self, key: bytes, low: bytes, high: bytes):
+        return self._by_score(key, low, high)
+
+    def cmd_zremrangebyscore(self, key: bytes, low: bytes, high: bytes):
+        members = self._by_score(key, low, high)
+        return self.cmd_zrem(key, *members) if members else 0
+
+
+# ============================================================
+# CONNECTIONS (RESP2, MULTI / EXEC / WATCH)
+# ============================================================
+_ABORTED = object()  # EXEC reply when a watched key changed (null array)
+
+
+def _encode(value: Any) -> bytes:
+    if value is _ABORTED:
+        return b"*-1\r\n"
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, _Error):
+        return b"-%s\r\n" % str(value).encode()
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(_encode(v) for v in value)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        # One small write per reply: without this, pipelined replies wait on Nagle.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()  # inline command (telnet / nc)
+        args = []
+        for _ in range(int(line[1:])):
+            n = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def handle(self):
+        server: FakeRedisServer = self.server
+        queued: Optional[List[List[bytes]]] = None   # commands after MULTI
+        watched: Dict[bytes, int] = {}
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            name = args[0].upper()
+            with server.lock:
+                if name == b"MULTI":
+                    reply = _Error("ERR MULTI calls can not be nested") if queued is not None else "OK"
+                    queued = [] if queued is None else queued
+                elif name == b"DISCARD":
+                    reply = "OK" if queued is not None else _Error("ERR DISCARD without MULTI")
+                    queued, watched = None, {}
+                elif name == b"EXEC":
+                    if queued is None:
+                        reply = _Error("ERR EXEC without MULTI")
+                    elif any(server.version(k) != v for k, v in watched.items()):
+                        reply = _ABORTED  # a watched key changed
+                    else:
+                        reply = [self._run(cmd) for cmd in queued]
+                    queued, watched = None, {}
+                elif name == b"WATCH":
+                    if queued is not None:
+                        reply = _Error("ERR WATCH inside MULTI is not allowed")
+                    else:
+                        watched.update({k: server.version(k) for k in args[1:]})
+                        reply = "OK"
+                elif name == b"UNWATCH":
+                    watched, reply = {}, "OK"
+                elif name == b"QUIT":
+                    self.wfile.write(b"+OK\r\n")
+                    return
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    reply = self._run(args)
+            self.wfile.write(_encode(reply))
+
+    def _run(self, args: List[bytes]) -> Any:
+        try:
+            return self.server.call(args)
+        except _Error as e:
+            return e
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0) -> FakeRedisServer:
+    """Starts a server on a background thread (port 0 picks a free port)."""
+    server = FakeRedisServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6390)
+    args = ap.parse_args()
+    server = FakeRedisServer((args.host, args.port))
+    print(f"fake Redis listening on redis://{args.host}:{server.server_address[1]}/0")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
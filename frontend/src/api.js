@@ -1,3 +1,5 @@
+import readStream from "./utils/streamReader";
+
 export async function sendMessage(session, message) {
   const res = await fetch("/chat", {
     method: "POST",
@@ -7,4 +9,14 @@ export async function sendMessage(session, message) {
 
   const data = await res.json();
   return data.story || data.reply || data.error || "No response";
-}
\ No newline at end of file
+}
+
+export async function sendMessageStream(session, message, onChunk, onStatus) {
+  const res = await fetch("/chat/stream", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ session, message })
+  });
+
+  await readStream(res, onChunk, onStatus);
+}
@@ -1,4 +1,7 @@
-export default async function readStream(response, onChunk) {
+// Status lines look like "[typing] Checking the story...\n"; everything else is text.
+const TYPING_LINE = /\[typing\][^\n]*\n?/g;
+
+export default async function readStream(response, onChunk, onStatus) {
   const reader = response.body.getReader();
   const decoder = new TextDecoder();
 
@@ -6,8 +9,14 @@ export default async function readStream(response, onChunk) {
     const { value, done } = await reader.read();
     if (done) break;
     const chunk = decoder.decode(value, { stream: true });
-    if (!chunk.startsWith("[typing]")) {
-      onChunk(chunk);
+    if (onStatus) {
+      for (const line of chunk.match(TYPING_LINE) || []) {
+        onStatus(line.replace("[typing]", "").trim());
+      }
+    }
+    const text = chunk.replace(TYPING_LINE, "");
+    if (text) {
+      onChunk(text);
     }
   }
-}
\ No newline at end of file
+}
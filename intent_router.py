@@ -0,0 +1,120 @@
+# intent_router.py
+"""
+Local fast-path intent router.
+
+A small softmax-regression classifier over word unigrams and bigrams that answers
+obvious messages ("hi", "thanks!", "tell me a story about a bunny", "make it
+shorter") without an Intent Classifier LLM call. The trained weights ship as a
+compact JSON file (intent_model.json); story_engine only trusts a prediction whose
+confidence clears LOCAL_ROUTER_THRESHOLD and falls back to the LLM otherwise.
+
+Retrain after editing intent_training.jsonl:
+
+    python intent_router.py train intent_training.jsonl intent_model.json
+"""
+import json
+import math
+import os
+import random
+import re
+import sys
+from typing import Dict, List, Tuple
+
+INTENTS = ("new_story", "refine", "chat")
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_model.json")
+
+_WORD = re.compile(r"[a-z']+")
+
+def features(text: str) -> List[str]:
+    """Lower-cased unigrams and bigrams, a first-word marker and a short-message marker."""
+    words = _WORD.findall(text.lower())
+    feats = set(words)
+    feats.update(f"{a}_{b}" for a, b in zip(words, words[1:]))
+    if words:
+        feats.add(f"^{words[0]}")
+    if len(words) <= 3:
+        feats.add("<short>")
+    return sorted(feats)
+
+def _softmax(scores: List[float]) -> List[float]:
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+class LocalIntentRouter:
+    """Linear classifier over sparse binary features; weights are {intent: {feature: w}}."""
+
+    def __init__(self, model: Dict):
+        self.intents: Tuple[str, ...] = tuple(model["intents"])
+        self.bias: Dict[str, float] = model["bias"]
+        self.weights: Dict[str, Dict[str, float]] = model["weights"]
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_MODEL_PATH) -> "LocalIntentRouter":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        feats = features(text)
+        scores = [
+            self.bias[intent] + sum(self.weights[intent].get(f, 0.0) for f in feats)
+            for intent in self.intents
+        ]
+        return dict(zip(self.intents, _softmax(scores)))
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        """Returns (intent, confidence)."""
+        probs = self.predict_proba(text)
+        intent = max(probs, key=probs.get)
+        return intent, probs[intent]
+
+
+def train(examples: List[Dict[str, str]], epochs: int = 200, lr: float = 0.5,
+          l2: float = 1e-2, seed: int = 0) -> Dict:
+    """Fits softmax regression with SGD. Returns a JSON-serializable model."""
+    rng = random.Random(seed)
+    data = [(features(e["text"]), INTENTS.index(e["intent"])) for e in examples]
+    bias = [0.0] * len(INTENTS)
+    weights: List[Dict[str, float]] = [{} for _ in INTENTS]
+
+    for _ in range(epochs):
+        rng.shuffle(data)
+        for feats, label in data:
+            scores = [bias[k] + sum(weights[k].get(f, 0.0) for f in feats) for k in range(len(INTENTS))]
+            probs = _softmax(scores)
+            for k in range(len(INTENTS)):
+                grad = probs[k] - (1.0 if k == label else 0.0)
+                bias[k] -= lr * grad
+                w = weights[k]
+                for f in feats:
+                    old = w.get(f, 0.0)
+                    w[f] = old - lr * (grad + l2 * old)
+
+    return {
+        "intents": list(INTENTS),
+        "bias": {intent: round(bias[k], 4) for k, intent in enumerate(INTENTS)},
+        "weights": {
+            intent: {f: round(v, 4) for f, v in sorted(weights[k].items()) if abs(v) >= 1e-3}
+            for k, intent in enumerate(INTENTS)
+        },
+    }
+
+
+def _read_jsonl(path: str) -> List[Dict[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "train":
+        print("usage: python intent_router.py train <examples.jsonl> <model.json>")
+        sys.exit(2)
+    examples = _read_jsonl(sys.argv[2])
+    model = train(examples)
+    with open(sys.argv[3], "w", encoding="utf-8") as f:
+        json.dump(model, f, separators=(",", ":"), sort_keys=True)
+    router = LocalIntentRouter(model)
+    correct = sum(router.classify(e["text"])[0] == e["intent"] for e in examples)
+    print(f"trained on {len(examples)} examples, training accuracy {correct / len(examples):.1%}")
@@ -0,0 +1,256 @@
+# llm_backends.py
+"""
+Pluggable chat-model backends for the story pipeline.
+
+    LLM_BACKEND=gemini   Google Gemini through langchain (needs GEMINI_API_KEY)
+    LLM_BACKEND=http     any endpoint speaking the HttpChatModel protocol (LLM_BASE_URL),
+                         e.g. fake_llm_server.py
+    LLM_BACKEND=fake     in-process deterministic fake: canned router / judge / story /
+                         chat replies with configurable latency, for tests and benchmarks
+
+Every backend exposes `model`, `temperature`, `invoke(prompt, config=None)` and
+`ainvoke(prompt, config=None)` returning an object with `.content`. The Gemini
+client is created lazily on first use, so importing the engine never needs a key.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional, Protocol
+
+
+class ChatModel(Protocol):
+    model: str
+    temperature: float
+
+    def invoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> Any: ...
+
+    async def ainvoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> Any: ...
+
+
+class _Reply(NamedTuple):
+    content: str
+    usage_metadata: Optional[Dict[str, int]] = None
+
+
+def estimated_usage(prompt: str, reply: str) -> Dict[str, int]:
+    """Token usage for fake replies, at roughly four characters per token."""
+    usage = {"input_tokens": max(1, len(prompt) // 4), "output_tokens": max(1, len(reply) // 4)}
+    usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+    return usage
+
+
+# ============================================================
+# CANNED REPLIES (shared with fake_llm_server.py)
+# ============================================================
+CANNED_STORY = (
+    "Once upon a time, a little bunny named Pip found a bright red strawberry in the garden. "
+    "It was the biggest, shiniest strawberry Pip had ever seen, and it smelled like sunshine. "
+    "Pip carried it carefully along the path, past the tall sunflowers and the humming bees. "
+    "Under the old oak tree, Pip met a sleepy hedgehog named Hazel, who was rubbing her eyes. "
+    "\"Good evening, Hazel,\" said Pip. \"Would you like to share my strawberry?\" "
+    "Hazel smiled a wide, sleepy smile and nodded. "
+    "A moment later, a tiny mouse named Moss peeked out from behind a mushroom. "
+    "\"There is enough for you too,\" Pip said kindly, and Moss squeaked with joy. "
+    "Pip broke the strawberry into three juicy pieces, one for each friend. "
+    "They sat together on a soft patch of moss and ate slowly, giggling as the sweet juice ran down their chins. "
+    "The fireflies came out one by one and danced above them like tiny lanterns. "
+    "Hazel told a funny story about a snail who wanted to race the wind, and Moss laughed so hard he rolled over. "
+    "When the moon rose high and round, the three friends curled up close together, warm and happy. "
+    "Pip thought that the strawberry had tasted even better because it was shared. "
+    "Moral: Sharing makes every treat sweeter."
+)
+CANNED_HINT = "Make the ending a little warmer."
+
+def prompt_kind(prompt: str) -> str:
+    """Which pipeline prompt this is: router, judge, rewrite, chat, self_judged or story."""
+    if "routing system" in prompt:
+        return "router"
+    if "Story Evaluation Tool" in prompt or "Request Safety Check" in prompt:
+        return "judge"
+    if "Rewrite the ENTIRE story" in prompt:
+        return "rewrite"
+    if "friendly story assistant" in prompt:
+        return "chat"
+    if "Self-Assessment:" in prompt:
+        return "self_judged"
+    return "story"
+
+def _quoted_after(prompt: str, marker: str) -> str:
+    return prompt.split(marker, 1)[-1].split('"', 1)[0] if marker in prompt else ""
+
+def _fraction(text: str) -> float:
+    """Stable pseudo-random number in [0, 1) derived from `text`."""
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16) / 16 ** 8
+
+def canned_reply(prompt: str, hint_rate: float = 0.0) -> str:
+    """
+    A plausible, deterministic reply for each of the pipeline's prompts. The judge
+    asks for a rewrite on a `hint_rate` share of stories (chosen by story hash).
+    """
+    kind = prompt_kind(prompt)
+    if kind == "router":
+        request = _quoted_after(prompt, 'User Request: "').lower()
+        if any(w in request for w in ("story", "tell me", "once upon")):
+            intent = "new_story"
+        elif any(w in request for w in ("make it", "change", "shorter", "longer", "add ", "instead")):
+            intent = "refine"
+        else:
+            intent = "chat"
+        return json.dumps({"intent": intent, "instruction": request})
+    if kind == "judge":
+        hint = CANNED_HINT if _fraction(prompt) < hint_rate else ""
+        return json.dumps({"unsafe": False, "hint": hint})
+    if kind == "chat":
+        return "That sounds lovely! Would you like another story?"
+    if kind == "rewrite":
+        hint = _quoted_after(prompt, 'applying this hint: "')
+        return CANNED_STORY + (f" (Rewritten: {hint})" if hint else "")
+    theme = _quoted_after(prompt, 'Theme/Topic: "')
+    story = (f"A story about {theme}. " if theme else "") + CANNED_STORY
+    if kind == "self_judged":
+        hint = CANNED_HINT if _fraction(story) < hint_rate else ""
+        return json.dumps({"story": story, "unsafe": False, "has_moral": True, "hint": hint})
+    return story
+
+
+# ============================================================
+# FAKE BACKEND
+# ============================================================
+_DEFAULT_LATENCY = "router=lognormal:350,0.3;judge=lognormal:700,0.3;story=lognormal:2500,0.25;" \
+                   "rewrite=lognormal:2500,0.25;chat=lognormal:600,0.3;self_judged=lognormal:2800,0.25"
+
+def latency_sampler(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parses a latency distribution in milliseconds and returns a sampler giving seconds:
+    "250" or "fixed:250", "uniform:100,400", "normal:300,50", "lognormal:300,0.4"
+    (median and sigma).
+    """
+    name, _, args = spec.strip().partition(":")
+    if not args:
+        name, args = "fixed", name
+    p = [float(x) for x in args.split(",")]
+    if name == "fixed":
+        return lambda rng: p[0] / 1000
+    if name == "uniform":
+        return lambda rng: rng.uniform(p[0], p[1]) / 1000
+    if name == "normal":
+        return lambda rng: max(0.0, rng.gauss(p[0], p[1])) / 1000
+    if name == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(p[0]), p[1]) / 1000 if p[0] > 0 else 0.0
+    raise ValueError(f"unknown latency distribution: {spec!r}")
+
+def parse_latency(spec: str) -> Dict[str, Callable[[random.Random], float]]:
+    """'router=fixed:100;story=lognormal:2000,0.3' -> sampler per prompt kind ('*' sets all)."""
+    samplers = {}
+    for item in spec.split(";"):
+        if not item.strip():
+            continue
+        kind, _, dist = item.partition("=")
+        if kind.strip() == "*":
+            for k in ("router", "judge", "story", "rewrite", "chat", "self_judged"):
+                samplers[k] = latency_sampler(dist)
+        else:
+            samplers[kind.strip()] = latency_sampler(dist)
+    return samplers
+
+
+class FakeChatModel:
+    """
+    Deterministic stand-in for an LLM: canned replies (see canned_reply) after a
+    latency drawn from a per-prompt-kind distribution. The latency sequence is
+    seeded, so the same run order gives the same timings.
+    """
+
+    def __init__(self, model: str = "fake-llm", temperature: float = 0.0,
+                 latency: Optional[str] = None, seed: int = 0, hint_rate: float = 0.0):
+        self.model = model
+        self.temperature = temperature
+        self.hint_rate = hint_rate
+        self._latency = parse_latency(_DEFAULT_LATENCY)
+        self._latency.update(parse_latency(latency or ""))
+        self._rng = random.Random(f"{seed}|{model}|{temperature}")
+        self._lock = threading.Lock()
+
+    def _draw(self, prompt: str):
+        kind = prompt_kind(prompt)
+        with self._lock:
+            delay = self._latency[kind](self._rng)
+        return delay, canned_reply(prompt, self.hint_rate)
+
+    def invoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> _Reply:
+        delay, reply = self._draw(prompt)
+        time.sleep(delay)
+        return _Reply(reply, estimated_usage(prompt, reply))
+
+    async def ainvoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> _Reply:
+        delay, reply = self._draw(prompt)
+        await asyncio.sleep(delay)
+        return _Reply(reply, estimated_usage(prompt, reply))
+
+
+# ============================================================
+# GEMINI BACKEND (lazy)
+# ============================================================
+class LazyChatModel:
+    """Builds the real client on first call, so a missing key only fails when it is used."""
+
+    def __init__(self, factory: Callable[[], Any], model: str, temperature: float):
+        self.model = model
+        self.temperature = temperature
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def invoke(self, prompt: str, config: Optional[Dict[str, Any]] = None):
+        return self.client().invoke(prompt, config=config)
+
+    async def ainvoke(self, prompt: str, config: Optional[Dict[str, Any]] = None):
+        return await self.client().ainvoke(prompt, config=config)
+
+
+def _gemini(model: str, temperature: float, api_key: Optional[str], timeout: float):
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY not set in .env")
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=model,
+        google_api_key=api_key,
+        temperature=temperature,
+        # Retries and timeouts are owned by the gateway (deadline-aware, with jitter).
+        max_retries=0,
+        timeout=timeout,
+    )
+
+
+def make_chat_model(backend: str, model: str, temperature: float) -> ChatModel:
+    """Creates a chat model for `backend`, configured from the environment."""
+    if backend == "gemini":
+        api_key = os.getenv("GEMINI_API_KEY")
+        timeout = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "30"))
+        return LazyChatModel(lambda: _gemini(model, temperature, api_key, timeout), model, temperature)
+    if backend == "http":
+        from llm_gateway import HttpChatModel
+        base_url = os.getenv("LLM_BASE_URL")
+        if not base_url:
+            raise ValueError("LLM_BACKEND=http needs LLM_BASE_URL")
+        return HttpChatModel(base_url, model=model, temperature=temperature)
+    if backend == "fake":
+        return FakeChatModel(
+            model=model, temperature=temperature,
+            latency=os.getenv("FAKE_LLM_LATENCY_MS", ""),
+            seed=int(os.getenv("FAKE_LLM_SEED", "0")),
+            hint_rate=float(os.getenv("FAKE_LLM_HINT_RATE", "0.3")),
+        )
+    raise ValueError(f"unknown LLM_BACKEND: {backend!r} (expected gemini, http or fake)")
@@ -0,0 +1,192 @@
+# llm_cache.py
+"""
+Content-addressed cache for LLM tool outputs (router decisions, judge verdicts,
+drafts, rewrites).
+
+Keys are built from the prompt kind, model, temperature and a hash of the
+normalized input, so "A story about a bunny who shares." and "a story about a
+bunny who shares" share an entry. Lookups go through an in-memory LRU first and an
+optional on-disk SQLite tier second; both honour a TTL, and the disk tier is kept
+under a byte budget by evicting the least recently used entries.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+_SPACE = re.compile(r"\s+")
+
+def normalize(text: str) -> str:
+    """Case-folds, collapses whitespace and strips surrounding punctuation."""
+    return _SPACE.sub(" ", text.casefold()).strip(" \t\n.!?,;:\"'")
+
+def make_key(kind: str, model: str, temperature: float, text: str) -> str:
+    digest = hashlib.sha256(normalize(text).encode("utf-8")).hexdigest()
+    return f"{kind}|{model}|{temperature:g}|{digest}"
+
+
+class _DiskTier:
+    """
+    SQLite-backed tier with TTL and size-based LRU eviction. The size of the tier is
+    kept as a running total (seeded at open), so a put does not sum the table; it is
+    recounted only when the total says the budget is exceeded, which also picks up
+    what other processes sharing the file have written.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._conn().execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._total = self._stored_bytes(self._conn())
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        conn = self._conn()
+        row = conn.execute("SELECT value, created, size FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created, size = row
+        now = time.time()
+        if ttl and now - created > ttl:
+            if conn.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount:
+                self._grow(-size)
+            return None
+        conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return value
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        size = len(key) + len(value.encode("utf-8"))
+        conn = self._conn()
+        old = conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+            (key, value, now, now, size),
+        )
+        if self._grow(size - (old[0] if old else 0)) > self.max_bytes:
+            self._evict(conn)
+
+    def _grow(self, delta: int) -> int:
+        with self._lock:
+            self._total += delta
+            return self._total
+
+    @staticmethod
+    def _stored_bytes(conn: sqlite3.Connection) -> int:
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()
+        return total
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = self._stored_bytes(conn)
+        if total <= self.max_bytes:
+            with self._lock:
+                self._total = total
+            return
+        # Trim to 90% of the budget so we don't evict on every single put.
+        excess = total - int(self.max_bytes * 0.9)
+        victims, freed = [], 0
+        for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany("DELETE FROM cache WHERE key = ?", victims)
+        with self._lock:
+            self._total = total - freed
+
+
+class LLMCache:
+    """Two-tier (memory LRU + optional disk) cache with per-kind hit/miss counters."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 0.0,
+                 disk_path: Optional[str] = None, disk_max_bytes: int = 50 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _DiskTier(disk_path, disk_max_bytes) if disk_path else None
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, key: str, outcome: str):
+        kind = key.split("|", 1)[0]
+        with self._lock:
+            counters = self._stats.setdefault(kind, {"hits": 0, "disk_hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                created, value = entry
+                if self.ttl and time.time() - created > self.ttl:
+                    del self._mem[key]
+                    entry = None
+                else:
+                    self._mem.move_to_end(key)
+        if entry is not None:
+            self._count(key, "hits")
+            return entry[1]
+
+        if self._disk is not None:
+            value = self._disk.get(key, self.ttl)
+            if value is not None:
+                self._remember(key, value)
+                self._count(key, "disk_hits")
+                return value
+
+        self._count(key, "misses")
+        return None
+
+    def put(self, key: str, value: str):
+        self._remember(key, value)
+        if self._disk is not None:
+            self._disk.put(key, value)
+
+    def _remember(self, key: str, value: str):
+        with self._lock:
+            self._mem[key] = (time.time(), value)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Per-kind hits / disk_hits / misses and hit ratio."""
+        with self._lock:
+            out = {}
+            for kind, c in self._stats.items():
+                total = c["hits"] + c["disk_hits"] + c["misses"]
+                out[kind] = dict(c, hit_ratio=round((c["hits"] + c["disk_hits"]) / total, 4) if total else 0.0)
+            out["_memory_entries"] = len(self._mem)
+            return out
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            self._stats.clear()
+
+
+def cache_from_env() -> LLMCache:
+    return LLMCache(
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024")),
+        ttl=float(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+        disk_path=os.getenv("LLM_CACHE_DISK_PATH") or None,
+        disk_max_bytes=int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(50 * 1024 * 1024))),
+    )
@@ -0,0 +1,607 @@
+# llm_gateway.py
+"""
+Gateway between the story pipeline and the upstream LLM API.
+
+Every LLM call goes through LLMGateway.invoke() / ainvoke(), which adds:
+
+- per-model budgets: a concurrency cap and a requests-per-minute token bucket,
+  shared by every client of the same model (the three Gemini clients differ only
+  in temperature, so they draw from one quota);
+- retries with exponential backoff and full jitter on 429 / 5xx / timeouts,
+  honouring Retry-After when the upstream sends one;
+- deadline propagation: `with deadline(seconds):` bounds everything inside it, and
+  each attempt only gets the time that is left (DeadlineExceeded when it runs out);
+- caller rate limits: `with rate_limit(bucket):` additionally draws every call
+  inside the block from a shared bucket (e.g. one batch job's own RPM), so bulk
+  work cannot use up the budget interactive turns need;
+- hedged requests: if a latency-critical call has not answered after
+  `hedge_after` seconds, a second identical request is sent and the first answer
+  wins. The hedge is only sent when the budget has room for it right now.
+
+HttpChatModel is a small client for an HTTP LLM endpoint with a keep-alive
+connection pool; together with fake_llm_server.py it lets the gateway be tested
+against injected latency and errors (see stress_gateway.py).
+"""
+import asyncio
+import contextvars
+import http.client
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class UpstreamError(RuntimeError):
+    """The upstream LLM call failed (after retries, when raised by the gateway)."""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    """The turn's deadline passed before the LLM answered."""
+
+
+class _AttemptTimeout(TimeoutError):
+    """A single attempt took longer than the per-attempt timeout (retryable)."""
+
+
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+# google.api_core exception names for the same conditions, matched by name so this
+# module does not need the google packages installed.
+_RETRYABLE_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "BadGateway", "GatewayTimeout", "DeadlineExceeded", "RetryError",
+}
+
+def _retryable(exc: BaseException) -> bool:
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    if isinstance(exc, (_AttemptTimeout, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(exc, "status", None) or getattr(exc, "code", None) or getattr(exc, "status_code", None)
+    if isinstance(status, int) and status in _RETRYABLE_STATUS:
+        return True
+    return type(exc).__name__ in _RETRYABLE_NAMES
+
+
+# ============================================================
+# DEADLINES
+# ============================================================
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("llm_deadline", default=None)
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """
+    Bounds all gateway calls inside the block to `seconds` from now. Nested blocks
+    can only shorten the deadline. Carried by contextvars, so it follows asyncio
+    tasks and asyncio.to_thread calls.
+    """
+    if not seconds:
+        yield
+        return
+    current = _DEADLINE.get()
+    new = time.monotonic() + seconds
+    token = _DEADLINE.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None when there is none."""
+    d = _DEADLINE.get()
+    return None if d is None else d - time.monotonic()
+
+
+# ============================================================
+# BUDGETS
+# ============================================================
+class _TokenBucket:
+    """Requests-per-minute budget. Thread-safe; callers sleep for the returned delay."""
+
+    def __init__(self, rpm: float, burst: Optional[float] = None):
+        self.rate = rpm / 60.0
+        self.capacity = burst if burst is not None else max(1.0, self.rate * 10)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """
+        Takes one token, possibly on credit, and returns how long to wait before
+        using it. Raises DeadlineExceeded (without taking the token) if that wait
+        would be longer than `max_wait`.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            delay = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if max_wait is not None and delay > max_wait:
+                raise DeadlineExceeded(f"rate limit wait {delay:.2f}s exceeds the deadline")
+            self._tokens -= 1
+            return delay
+
+    def try_take(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+_CALLER_BUCKETS: contextvars.ContextVar[Tuple[_TokenBucket, ...]] = contextvars.ContextVar(
+    "llm_caller_buckets", default=())
+
+@contextmanager
+def rate_limit(bucket: Optional[_TokenBucket]) -> Iterator[None]:
+    """
+    Draws every gateway call attempt inside the block from `bucket` as well as from
+    the model budget (hedges excepted). Follows contextvars like deadline(); pass the
+    same bucket to several threads to share one limit between them.
+    """
+    if bucket is None:
+        yield
+        return
+    token = _CALLER_BUCKETS.set(_CALLER_BUCKETS.get() + (bucket,))
+    try:
+        yield
+    finally:
+        _CALLER_BUCKETS.reset(token)
+
+def _caller_delay() -> float:
+    """Seconds to wait for the caller buckets (DeadlineExceeded if past the deadline)."""
+    return max((b.reserve(max_wait=remaining()) for b in _CALLER_BUCKETS.get()), default=0.0)
+
+
+class _Slots:
+    """
+    Concurrency cap shared by threads and event loops: threads block in acquire(),
+    tasks wait in aacquire() without holding a thread, and both draw from one count.
+    A released slot goes straight to the longest waiter.
+    """
+
+    class _Waiter:
+        __slots__ = ("granted", "wake")
+
+        def __init__(self, wake: Callable[[], None]):
+            self.granted = False
+            self.wake = wake
+
+    def __init__(self, limit: int):
+        self._free = limit
+        self._lock = threading.Lock()
+        self._waiters: Deque["_Slots._Waiter"] = deque()
+
+    def acquire(self, blocking: bool = True, timeout: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return True
+            if not blocking:
+                return False
+            event = threading.Event()
+            waiter = self._Waiter(event.set)
+            self._waiters.append(waiter)
+        event.wait(timeout)
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+            return waiter.granted
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            waiter = self._Waiter(lambda: loop.call_soon_threadsafe(
+                lambda: future.done() or future.set_result(None)))
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._hand_over()
+                else:
+                    self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        with self._lock:
+            self._hand_over()
+
+    def _hand_over(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            try:
+                waiter.wake()
+            except RuntimeError:  # its event loop is closed
+                continue
+            waiter.granted = True
+            return
+        self._free += 1
+
+    def has_room(self) -> bool:
+        with self._lock:
+            return bool(self._free) and not self._waiters
+
+
+class _ModelBudget:
+    def __init__(self, model: str, concurrency: int, rpm: float):
+        self.model = model
+        self.concurrency = concurrency
+        self.bucket = _TokenBucket(rpm) if rpm else None
+        # One cap for sync and async callers alike.
+        self.slots = _Slots(concurrency)
+        self.counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                         "failures": 0, "throttled": 0, "in_flight": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, delta: int = 1):
+        with self.lock:
+            self.counters[name] += delta
+
+
+class _Reply(NamedTuple):
+    content: str
+    usage_metadata: Optional[Dict[str, int]] = None
+
+
+def _model_name(llm: Any) -> str:
+    name = str(getattr(llm, "model", None) or getattr(llm, "model_name", None) or "default")
+    return name[len("models/"):] if name.startswith("models/") else name
+
+
+# ============================================================
+# GATEWAY
+# ============================================================
+class LLMGateway:
+    """Budgets, retries, deadlines and hedging around `llm.invoke` / `llm.ainvoke`."""
+
+    def __init__(self, max_concurrency: int = 16, rpm: float = 0.0, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, attempt_timeout: float = 30.0,
+                 model_limits: Optional[Dict[str, Tuple[int, float]]] = None, workers: int = 64):
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.attempt_timeout = attempt_timeout
+        self.model_limits = dict(model_limits or {})
+        self._budgets: Dict[str, _ModelBudget] = {}
+        self._lock = threading.Lock()
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _budget(self, llm: Any) -> _ModelBudget:
+        model = _model_name(llm)
+        with self._lock:
+            budget = self._budgets.get(model)
+            if budget is None:
+                concurrency, rpm = self.model_limits.get(model, (self.max_concurrency, self.rpm))
+                budget = self._budgets[model] = _ModelBudget(model, concurrency, rpm)
+            return budget
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._workers, thread_name_prefix="llm-gateway")
+            return self._executor
+
+    def _timeout(self) -> float:
+        """Time allowed for the next attempt: the attempt timeout, capped by the deadline."""
+        left = remaining()
+        if left is None:
+            return self.attempt_timeout
+        if left <= 0:
+            raise DeadlineExceeded("deadline passed before the LLM call")
+        return min(self.attempt_timeout, left)
+
+    def _backoff(self, attempt: int, exc: BaseException) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = getattr(exc, "retry_after", None)
+        return max(delay, retry_after) if retry_after else delay
+
+    def _give_up(self, budget: _ModelBudget, attempts: int, exc: BaseException) -> UpstreamError:
+        budget.count("failures")
+        return UpstreamError(
+            f"{budget.model}: giving up after {attempts} attempt(s): {exc}",
+            status=getattr(exc, "status", None), retry_after=getattr(exc, "retry_after", None),
+        )
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            budgets = list(self._budgets.values())
+        out = {}
+        for b in budgets:
+            with b.lock:
+                out[b.model] = dict(b.counters)
+        return out
+
+    # ---------------- sync ----------------
+    def invoke(self, llm: Any, prompt: str, config: Optional[Dict[str, Any]] = None,
+               hedge_after: Optional[float] = None) -> Any:
+        """
+        Calls `llm.invoke(prompt, config=config)` and returns the model's reply
+        (`.content`, plus `.usage_metadata` when the backend reports token usage).
+        """
+        budget = self._budget(llm)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._attempt(budget, llm, prompt, config or {}, hedge_after)
+            except Exception as e:
+                if not _retryable(e):
+                    budget.count("failures")
+                    raise
+                delay = self._backoff(attempt, e)
+                left = remaining()
+                if attempt == self.max_retries or (left is not None and delay >= left):
+                    raise self._give_up(budget, attempt + 1, e) from e
+                budget.count("retries")
+                time.sleep(delay)
+        raise AssertionError("unreachable")
+
+    def _rate_delay(self, budget: _ModelBudget) -> float:
+        """
+        Takes a token from the caller buckets and the model bucket and returns how long
+        to wait before calling. Only the deadline caps the wait (DeadlineExceeded);
+        without one, a rate backlog is waited out rather than failing the call.
+        """
+        delay = _caller_delay()
+        if budget.bucket is not None:
+            delay = max(delay, budget.bucket.reserve(max_wait=remaining()))
+        if delay:
+            budget.count("throttled")
+        return delay
+
+    def _submit(self, budget: _ModelBudget, llm: Any, prompt: str, config: Dict[str, Any],
+                timeout: float, hedge: bool = False) -> Optional[Future]:
+        """Takes a concurrency slot (and a rate token for hedges), then runs the call on the pool."""
+        if hedge:
+            # Hedges are best effort: only when both budgets have room right now.
+            if not budget.slots.acquire(blocking=False):
+                return None
+            if budget.bucket is not None and not budget.bucket.try_take():
+                budget.slots.release()
+                return None
+        elif not budget.slots.acquire(timeout=timeout):
+            raise _AttemptTimeout(f"{budget.model}: no free upstream slot within {timeout:.1f}s")
+
+        def run() -> Any:
+            budget.count("in_flight")
+            try:
+                return llm.invoke(prompt, config=config)
+            finally:
+                budget.count("in_flight", -1)
+                budget.slots.release()
+
+        budget.count("calls")
+        if hedge:
+            budget.count("hedges")
+        # copy_context() keeps tracing (LangSmith) and deadline context in the worker.
+        return self._pool().submit(contextvars.copy_context().run, run)
+
+    def _attempt(self, budget: _ModelBudget, llm: Any, prompt: str, config: Dict[str, Any],
+                 hedge_after: Optional[float]) -> Any:
+        delay = self._rate_delay(budget)
+        if delay:
+            time.sleep(delay)
+        timeout = self._timeout()
+        ends = time.monotonic() + timeout
+        primary = self._submit(budget, llm, prompt, config, timeout)
+        futures: List[Future] = [primary]
+        if hedge_after and hedge_after < ends - time.monotonic():
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                hedge = self._submit(budget, llm, prompt, config, timeout, hedge=True)
+                if hedge is not None:
+                    futures.append(hedge)
+
+        error: Optional[BaseException] = None
+        while futures:
+            done, _ = wait(futures, timeout=max(0.0, ends - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                futures.remove(f)
+                if f.exception() is None:
+                    if f is not primary:
+                        budget.count("hedge_wins")
+                    return f.result()
+                error = f.exception()
+        if futures:
+            # Timed out; the abandoned calls still hold their slots until they return.
+            left = remaining()
+            if left is not None and left <= 0:
+                raise DeadlineExceeded(f"{budget.model}: deadline passed while waiting for the LLM")
+            raise _AttemptTimeout(f"{budget.model}: no answer within {timeout:.1f}s")
+        raise error
+
+    # ---------------- async ----------------
+    async def ainvoke(self, llm: Any, prompt: str, config: Optional[Dict[str, Any]] = None,
+                      hedge_after: Optional[float] = None) -> Any:
+        """Async invoke(): awaits `llm.ainvoke`; rate and concurrency budgets are shared with the sync path."""
+        budget = self._budget(llm)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._aattempt(budget, llm, prompt, config or {}, hedge_after)
+            except Exception as e:
+                if not _retryable(e):
+                    budget.count("failures")
+                    raise
+                delay = self._backoff(attempt, e)
+                left = remaining()
+                if attempt == self.max_retries or (left is not None and delay >= left):
+                    raise self._give_up(budget, attempt + 1, e) from e
+                budget.count("retries")
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    async def _acall(self, budget: _ModelBudget, llm: Any, prompt: str, config: Dict[str, Any]) -> Any:
+        await budget.slots.aacquire()
+        budget.count("calls")
+        budget.count("in_flight")
+        try:
+            return await llm.ainvoke(prompt, config=config)
+        finally:
+            budget.count("in_flight", -1)
+            budget.slots.release()
+
+    async def _aattempt(self, budget: _ModelBudget, llm: Any, prompt: str, config: Dict[str, Any],
+                        hedge_after: Optional[float]) -> Any:
+        delay = self._rate_delay(budget)
+        if delay:
+            await asyncio.sleep(delay)
+        timeout = self._timeout()
+        loop = asyncio.get_running_loop()
+        ends = loop.time() + timeout
+        primary = asyncio.ensure_future(self._acall(budget, llm, prompt, config))
+        tasks = [primary]
+        try:
+            if hedge_after and hedge_after < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                has_room = budget.slots.has_room()
+                if not done and has_room and (budget.bucket is None or budget.bucket.try_take()):
+                    budget.count("hedges")
+                    tasks.append(asyncio.ensure_future(
+                        self._acall(budget, llm, prompt, config)))
+
+            error: Optional[BaseException] = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, ends - loop.time()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for t in done:
+                    if t.exception() is None:
+                        if t is not primary:
+                            budget.count("hedge_wins")
+                        return t.result()
+                    error = t.exception()
+            if pending:
+                left = remaining()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded(f"{budget.model}: deadline passed while waiting for the LLM")
+                raise _AttemptTimeout(f"{budget.model}: no answer within {timeout:.1f}s")
+            raise error
+        finally:
+            # Unlike threads, losing or timed-out tasks can actually be cancelled.
+            for t in tasks:
+                t.cancel()
+
+
+def _parse_model_limits(spec: str) -> Dict[str, Tuple[int, float]]:
+    """'gemini-2.5-flash=16/600,other=4/60' -> {model: (concurrency, rpm)}."""
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, value = item.split("=", 1)
+        concurrency, _, rpm = value.partition("/")
+        limits[model.strip()] = (int(concurrency), float(rpm or 0))
+    return limits
+
+def gateway_from_env() -> LLMGateway:
+    return LLMGateway(
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+        rpm=float(os.getenv("LLM_RPM", "0")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+        backoff_base=float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5")),
+        backoff_max=float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8")),
+        attempt_timeout=float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "30")),
+        model_limits=_parse_model_limits(os.getenv("LLM_MODEL_LIMITS", "")),
+        workers=int(os.getenv("LLM_GATEWAY_WORKERS", "64")),
+    )
+
+
+# ============================================================
+# HTTP CLIENT (fake_llm_server.py or any endpoint speaking its protocol)
+# ============================================================
+class _ConnectionPool:
+    """Keep-alive HTTP connections to one host, reused across calls and threads."""
+
+    def __init__(self, base_url: str, size: int, timeout: float):
+        parts = urlsplit(base_url)
+        self._cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self._host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self._timeout = timeout
+        self._idle: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(maxsize=size)
+        # Blocking calls made from ainvoke run here, not on the loop's small default pool.
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix="llm-http")
+
+    @contextmanager
+    def connection(self) -> Iterator[http.client.HTTPConnection]:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._cls(self._host, timeout=self._timeout)
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+_pools: Dict[str, _ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+class HttpChatModel:
+    """
+    Chat model served over HTTP: POST {prefix}/v1/chat with
+    {"model", "temperature", "prompt", "run_name"} -> {"content": "..."}.
+    Instances with the same base_url share one connection pool.
+    """
+
+    def __init__(self, base_url: str, model: str = "fake-llm", temperature: float = 0.0,
+                 pool_size: int = 32, timeout: float = 60.0):
+        self.model = model
+        self.temperature = temperature
+        with _pools_lock:
+            pool = _pools.get(base_url)
+            if pool is None:
+                pool = _pools[base_url] = _ConnectionPool(base_url, pool_size, timeout)
+        self._pool = pool
+
+    def invoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> _Reply:
+        body = json.dumps({
+            "model": self.model, "temperature": self.temperature, "prompt": prompt,
+            "run_name": (config or {}).get("run_name", ""),
+        })
+        with self._pool.connection() as conn:
+            conn.request("POST", self._pool.prefix + "/v1/chat", body=body,
+                         headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            payload = resp.read()
+        if resp.status != 200:
+            retry_after = resp.getheader("Retry-After")
+            raise UpstreamError(f"HTTP {resp.status}: {payload[:200]!r}", status=resp.status,
+                                retry_after=float(retry_after) if retry_after else None)
+        data = json.loads(payload)
+        return _Reply(data["content"], data.get("usage"))
+
+    async def ainvoke(self, prompt: str, config: Optional[Dict[str, Any]] = None) -> _Reply:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool.executor, self.invoke, prompt, config)
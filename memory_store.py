@@ -1,30 +1,1234 @@
+import base64
 import json
 import os
-from typing import List, Dict, Any
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator, Sequence, Callable, Tuple
+from urllib.parse import unquote, urlsplit
 
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process locking degrades to in-process locks only
+    fcntl = None
+
+
+# AI messages holding an approved story start with this tag.
+STORY_TAG = "[FINAL STORY]"
+
+def _is_story(m: Dict[str, str]) -> bool:
+    return m["role"] == "ai" and m["content"].startswith(STORY_TAG)
+
+def story_text(content: str) -> str:
+    return content[len(STORY_TAG):].strip()
+
+
+class StoreCorruptedError(RuntimeError):
+    """Raised when the store file cannot be parsed. The file is left untouched."""
+
+
+# ============================================================
+# LOCKING
+# ============================================================
+class _SessionLocks:
+    """
+    Striped in-process locks keyed by session id.
+    A fixed pool keeps memory bounded no matter how many sessions are seen.
+    """
+
+    def __init__(self, stripes: int = 256):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def get(self, session_id: str) -> threading.Lock:
+        return self._locks[zlib.crc32(session_id.encode("utf-8")) % len(self._locks)]
+
+
+@contextmanager
+def _file_lock(path: str, exclusive: bool = True) -> Iterator[None]:
+    """Advisory cross-process lock on `path` (a dedicated .lock file)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load_json(path: str) -> Dict[str, Any]:
+    """Loads a sidecar JSON file; a missing file is an empty mapping."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise StoreCorruptedError(f"Cannot parse {path}: {e}") from e
+
+def _pack_segment(messages: List[Dict[str, str]]) -> str:
+    """zlib-compressed JSON, base64-encoded so it fits in a JSON file."""
+    raw = json.dumps(messages, ensure_ascii=False).encode("utf-8")
+    return base64.b64encode(zlib.compress(raw)).decode("ascii")
+
+def _unpack_segment(segment: str) -> List[Dict[str, str]]:
+    return json.loads(zlib.decompress(base64.b64decode(segment)))
+
+def _atomic_write_json(path: str, data: Any, **dump_kwargs):
+    """Writes JSON to a temp file in the same directory and renames it over `path`."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# ============================================================
+# JSON STORE (legacy, whole-file)
+# ============================================================
 class JsonMessageHistoryStore:
-    def __init__(self, path: str):
+    """
+    Legacy store: every session's history in one JSON file.
+
+    With `hot_window` > 0 only the most recent messages stay in that file; older ones
+    are moved in batches to zlib-compressed segments in a sidecar `*.archive.json`,
+    and session summaries live in `*.summaries.json`.
+    """
+
+    def __init__(self, path: str, hot_window: int = 0):
         self.path = path
-        if not os.path.exists(self.path):
-            with open(self.path, "w", encoding="utf-8") as f:
-                json.dump({}, f)
+        self.hot_window = hot_window
+        self._lock_path = path + ".lock"
+        base = os.path.splitext(path)[0]
+        self._archive_path = base + ".archive.json"
+        self._summary_path = base + ".summaries.json"
+        self._session_locks = _SessionLocks()
+        with _file_lock(self._lock_path):
+            if not os.path.exists(self.path):
+                _atomic_write_json(self.path, {})
 
     def _load_db(self) -> Dict[str, Any]:
         try:
             with open(self.path, "r", encoding="utf-8") as f:
                 return json.load(f)
-        except Exception:
-            db = {}
-            with open(self.path, "w", encoding="utf-8") as f:
-                json.dump(db, f)
-            return db
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            # Never "repair" by truncating: that would wipe every session.
+            raise StoreCorruptedError(f"Cannot parse {self.path}: {e}") from e
+
+    def _write_db(self, db: Dict[str, Any]):
+        _atomic_write_json(self.path, db, indent=2, ensure_ascii=False)
 
     def get_history(self, session_id: str) -> List[Dict[str, str]]:
-        db = self._load_db()
+        # Writes are atomic renames, so readers only need a shared lock to avoid
+        # racing the rename on platforms where that matters.
+        with _file_lock(self._lock_path, exclusive=False):
+            db = self._load_db()
         return db.get(session_id, [])
 
     def set_history(self, session_id: str, history: List[Dict[str, str]]):
-        db = self._load_db()
-        db[session_id] = history
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(db, f, indent=2, ensure_ascii=False)
\ No newline at end of file
+        with self._session_locks.get(session_id), _file_lock(self._lock_path):
+            db = self._load_db()
+            db[session_id] = self._compact(session_id, list(history))
+            self._write_db(db)
+
+    def get_full_history(self, session_id: str) -> List[Dict[str, str]]:
+        """Archived segments followed by the hot messages."""
+        with _file_lock(self._lock_path, exclusive=False):
+            segments = _load_json(self._archive_path).get(session_id, [])
+            hot = self._load_db().get(session_id, [])
+        return [m for seg in segments for m in _unpack_segment(seg)] + hot
+
+    def apply_changes(self, session_id: str, appended: List[Dict[str, str]],
+                      summary: Optional[Dict[str, Any]] = None):
+        """Appends new messages and (optionally) stores the summary in one locked write."""
+        with self._session_locks.get(session_id), _file_lock(self._lock_path):
+            if appended:
+                db = self._load_db()
+                history = db.get(session_id, [])
+                history.extend(appended)
+                db[session_id] = self._compact(session_id, history)
+                self._write_db(db)
+            if summary is not None:
+                summaries = _load_json(self._summary_path)
+                summaries[session_id] = summary
+                _atomic_write_json(self._summary_path, summaries, ensure_ascii=False)
+
+    def _compact(self, session_id: str, history: List[Dict[str, str]], slack: Optional[int] = None):
+        """
+        Moves messages older than the hot window to the archive file (caller holds the
+        file lock) and returns the hot remainder. Archiving waits until the window
+        overflows by half again, so it happens in batches.
+        """
+        if not self.hot_window:
+            return history
+        if slack is None:
+            slack = max(1, self.hot_window // 2)
+        if len(history) <= self.hot_window + slack:
+            return history
+        cut = len(history) - self.hot_window
+        archive = _load_json(self._archive_path)
+        archive.setdefault(session_id, []).append(_pack_segment(history[:cut]))
+        _atomic_write_json(self._archive_path, archive)
+        return history[cut:]
+
+    def compact_all(self) -> int:
+        """Archives old messages of every session now. Returns the number of sessions compacted."""
+        with _file_lock(self._lock_path):
+            db = self._load_db()
+            compacted = 0
+            for session_id, history in db.items():
+                hot = self._compact(session_id, history, slack=0)
+                compacted += len(hot) < len(history)
+                db[session_id] = hot
+            if compacted:
+                self._write_db(db)
+        return compacted
+
+    def get_summary(self, session_id: str) -> Dict[str, Any]:
+        with _file_lock(self._lock_path, exclusive=False):
+            return _load_json(self._summary_path).get(session_id, {})
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]):
+        self.apply_changes(session_id, list(messages))
+
+    def session_ids(self) -> List[str]:
+        with _file_lock(self._lock_path, exclusive=False):
+            return list(self._load_db())
+
+    def story_versions(self, session_id: str) -> List[str]:
+        """All approved stories of a session, oldest first (scans the history)."""
+        return [story_text(m["content"]) for m in self.get_full_history(session_id) if _is_story(m)]
+
+    def get_current_story(self, session_id: str) -> Optional[str]:
+        history = self.get_history(session_id)
+        if self.hot_window and not any(_is_story(m) for m in history):
+            # The last story may have scrolled out of the hot window.
+            history = self.get_full_history(session_id)
+        for m in reversed(history):
+            if _is_story(m):
+                return story_text(m["content"])
+        return None
+
+
+# ============================================================
+# SQLITE (WAL) STORE — one row per message, indexed per session
+# ============================================================
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT    NOT NULL,
+    seq        INTEGER NOT NULL,
+    role       TEXT    NOT NULL,
+    content    TEXT    NOT NULL,
+    PRIMARY KEY (session_id, seq)
+) WITHOUT ROWID;
+
+-- Versioned list of approved stories per session, so the current story can be
+-- read without touching the message list. `seq` is the message that carried it.
+CREATE TABLE IF NOT EXISTS stories (
+    session_id TEXT    NOT NULL,
+    version    INTEGER NOT NULL,
+    seq        INTEGER NOT NULL,
+    content    TEXT    NOT NULL,
+    PRIMARY KEY (session_id, version)
+) WITHOUT ROWID;
+
+-- Older messages moved out of the hot table, as zlib-compressed JSON segments.
+CREATE TABLE IF NOT EXISTS archive (
+    session_id TEXT    NOT NULL,
+    first_seq  INTEGER NOT NULL,
+    last_seq   INTEGER NOT NULL,
+    data       BLOB    NOT NULL,
+    PRIMARY KEY (session_id, first_seq)
+) WITHOUT ROWID;
+
+-- Small per-session profile (name, favourite themes, past story titles) as JSON.
+CREATE TABLE IF NOT EXISTS summaries (
+    session_id TEXT PRIMARY KEY,
+    data       TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+-- One row per session. `version` changes on every write (caches compare it) and
+-- `expires_at` is when expire() deletes the session (NULL: never).
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    version    INTEGER NOT NULL,
+    expires_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_by_expiry ON sessions (expires_at);
+"""
+
+class SqliteMessageHistoryStore:
+    """
+    Drop-in replacement for JsonMessageHistoryStore backed by SQLite in WAL mode.
+
+    Messages are stored one row per message under a (session_id, seq) primary key,
+    so reading a session never touches other sessions and appending a message is a
+    single-row insert instead of a rewrite of the whole database.
+
+    Every write runs in a BEGIN IMMEDIATE transaction (serialized across processes by
+    SQLite) under a per-session in-process lock, and readers see a consistent WAL
+    snapshot, so concurrent turns never lose each other's messages.
+
+    Whenever a [FINAL STORY] message is written, the story is also recorded as a new
+    version in the `stories` table; get_current_story() reads that single row.
+
+    With `hot_window` > 0, only the most recent `hot_window` messages stay in the
+    hot table that get_history() reads; older ones are moved to the compressed
+    `archive` table in batches (get_full_history() stitches both together).
+
+    With `ttl` > 0, a session is deleted by expire() once it has not been written
+    for `ttl` seconds (see SessionMaintenance).
+    """
+
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None, hot_window: int = 0,
+                 ttl: float = 0.0):
+        self.path = path
+        self.hot_window = hot_window
+        self.ttl = ttl
+        self._local = threading.local()
+        self._session_locks = _SessionLocks()
+        with self._transaction() as conn:
+            for stmt in _SCHEMA.split(";"):
+                if stmt.strip():
+                    conn.execute(stmt)
+        self._backfill_stories()
+        self._backfill_sessions()
+        if legacy_json_path:
+            migrate_json_store(legacy_json_path, self)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared across threads; keep one per thread.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly in _transaction().
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the database write lock up front."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        """The hot (recent) part of a session's history; all of it when windowing is off."""
+        rows = self._conn().execute(
+            "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq",
+            (session_id,),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def get_full_history(self, session_id: str) -> List[Dict[str, str]]:
+        """Archived segments followed by the hot messages."""
+        conn = self._conn()
+        history: List[Dict[str, str]] = []
+        for (data,) in conn.execute(
+            "SELECT data FROM archive WHERE session_id = ? ORDER BY first_seq", (session_id,)
+        ):
+            history.extend(json.loads(zlib.decompress(data)))
+        return history + self.get_history(session_id)
+
+    def set_history(self, session_id: str, history: List[Dict[str, str]]):
+        """
+        Persists the hot history (what get_history() returned, possibly modified),
+        writing only what changed: the common prefix with the stored rows is kept and
+        everything after the first difference is replaced. For the usual "one more
+        message" case this is a single insert.
+        """
+        with self._session_locks.get(session_id), self._transaction() as conn:
+            stored = conn.execute(
+                "SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,),
+            ).fetchall()
+            base = stored[0][0] if stored else self._next_seq(conn, session_id)
+            keep = 0
+            for (_, role, content), m in zip(stored, history):
+                if role != m["role"] or content != m["content"]:
+                    break
+                keep += 1
+            if keep < len(stored):
+                conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND seq >= ?",
+                    (session_id, base + keep),
+                )
+                conn.execute(
+                    "DELETE FROM stories WHERE session_id = ? AND seq >= ?",
+                    (session_id, base + keep),
+                )
+            self._insert(conn, session_id, base + keep, history[keep:])
+            self._compact(conn, session_id)
+            self._touch(conn, session_id)
+
+    def apply_changes(self, session_id: str, appended: List[Dict[str, str]],
+                      summary: Optional[Dict[str, Any]] = None) -> Tuple[int, int]:
+        """
+        Appends new messages and (optionally) stores the session summary in a single
+        transaction. Messages appended concurrently by
+        other writers are preserved. Returns the session_version() just before and
+        just after the write.
+        """
+        with self._session_locks.get(session_id), self._transaction() as conn:
+            before = self._version(conn, session_id)
+            if appended:
+                self._insert(conn, session_id, self._next_seq(conn, session_id), appended)
+                self._compact(conn, session_id)
+            if summary is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO summaries (session_id, data) VALUES (?, ?)",
+                    (session_id, json.dumps(summary, ensure_ascii=False)),
+                )
+            if appended or summary is not None:
+                self._touch(conn, session_id)
+            return before, self._version(conn, session_id)
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]):
+        """Appends messages to the end of a session without reading its history."""
+        self.apply_changes(session_id, list(messages))
+
+    def get_current_story(self, session_id: str) -> Optional[str]:
+        """Latest approved story of a session, without reading its messages."""
+        row = self._conn().execute(
+            "SELECT content FROM stories WHERE session_id = ? ORDER BY version DESC LIMIT 1",
+            (session_id,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def story_versions(self, session_id: str) -> List[str]:
+        """All approved stories of a session, oldest first."""
+        rows = self._conn().execute(
+            "SELECT content FROM stories WHERE session_id = ? ORDER BY version",
+            (session_id,),
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def get_summary(self, session_id: str) -> Dict[str, Any]:
+        row = self._conn().execute(
+            "SELECT data FROM summaries WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def session_ids(self) -> List[str]:
+        """Sessions that have not expired."""
+        rows = self._conn().execute(
+            "SELECT session_id FROM sessions WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def session_version(self, session_id: str) -> int:
+        """Changes whenever the session is written, compacted or expired (0: no such session)."""
+        return self._version(self._conn(), session_id)
+
+    @staticmethod
+    def _version(conn: sqlite3.Connection, session_id: str) -> int:
+        row = conn.execute("SELECT version FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def compact_all(self) -> int:
+        """Archives old messages of every session now. Returns the number of sessions compacted."""
+        compacted = 0
+        for session_id in self.session_ids():
+            with self._session_locks.get(session_id), self._transaction() as conn:
+                compacted += self._compact(conn, session_id, slack=0)
+        return compacted
+
+    def expire(self, now: Optional[float] = None, batch: int = 500) -> int:
+        """
+        Deletes the sessions whose TTL has passed and returns how many. Sessions
+        written before the TTL was configured get a full TTL from now. A no-op when
+        the store has no TTL.
+        """
+        if not self.ttl:
+            return 0
+        now = time.time() if now is None else now
+        with self._transaction() as conn:
+            conn.execute("UPDATE sessions SET expires_at = ? WHERE expires_at IS NULL", (now + self.ttl,))
+        expired = 0
+        while True:
+            # Small batches, so writers never wait long for the write lock.
+            with self._transaction() as conn:
+                ids = [(r[0],) for r in conn.execute(
+                    "SELECT session_id FROM sessions WHERE expires_at <= ? LIMIT ?", (now, batch))]
+                for table in ("messages", "stories", "archive", "summaries", "sessions"):
+                    conn.executemany(f"DELETE FROM {table} WHERE session_id = ?", ids)
+            expired += len(ids)
+            if len(ids) < batch:
+                return expired
+
+    def reclaim_space(self, min_free: float = 0.25) -> bool:
+        """
+        Truncates the WAL and, when at least `min_free` of the database file is free
+        pages (left by expired and archived rows), VACUUMs it so the file shrinks.
+        Returns True if it vacuumed.
+        """
+        conn = self._conn()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        (free,) = conn.execute("PRAGMA freelist_count").fetchone()
+        (pages,) = conn.execute("PRAGMA page_count").fetchone()
+        if not pages or free / pages < min_free:
+            return False
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+    def try_lease(self, name: str, seconds: float) -> bool:
+        """Takes the named lease for `seconds` unless another holder's lease is still running."""
+        key, now = f"lease:{name}", time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            if row and float(row[0]) > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(now + seconds)))
+        return True
+
+    def claim_shard(self, index: int, count: int):
+        """Records this database as shard `index` of `count`; ValueError if it is another shard."""
+        label = f"{index}/{count}"
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'shard'").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO meta (key, value) VALUES ('shard', ?)", (label,))
+            elif row[0] != label:
+                raise ValueError(f"{self.path} is shard {row[0]}, not {label}: "
+                                 "the shard count changed, sessions would be looked up in the wrong shard")
+
+    def _touch(self, conn: sqlite3.Connection, session_id: str):
+        """
+        Bumps the session's version and pushes its expiry out by the TTL. Versions
+        start from the clock, so a session recreated after expiry never reuses one.
+        """
+        conn.execute(
+            "INSERT INTO sessions (session_id, version, expires_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (session_id) DO UPDATE"
+            " SET version = MAX(version + 1, excluded.version), expires_at = excluded.expires_at",
+            (session_id, time.time_ns() // 1000, time.time() + self.ttl if self.ttl else None),
+        )
+
+    @staticmethod
+    def _next_seq(conn: sqlite3.Connection, session_id: str) -> int:
+        (hot,) = conn.execute(
+            "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if hot is not None:
+            return hot + 1
+        (archived,) = conn.execute(
+            "SELECT COALESCE(MAX(last_seq), -1) FROM archive WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return archived + 1
+
+    def _compact(self, conn: sqlite3.Connection, session_id: str, slack: Optional[int] = None) -> int:
+        """
+        Moves messages older than the hot window into one compressed archive segment.
+        By default it waits until the window overflows by half again, so archiving
+        happens in batches rather than on every append. Returns 1 if it archived.
+        """
+        if not self.hot_window:
+            return 0
+        if slack is None:
+            slack = max(1, self.hot_window // 2)
+        (count,) = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if count <= self.hot_window + slack:
+            return 0
+        rows = conn.execute(
+            "SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq LIMIT ?",
+            (session_id, count - self.hot_window),
+        ).fetchall()
+        segment = [{"role": role, "content": content} for _, role, content in rows]
+        conn.execute(
+            "INSERT INTO archive (session_id, first_seq, last_seq, data) VALUES (?, ?, ?, ?)",
+            (session_id, rows[0][0], rows[-1][0],
+             zlib.compress(json.dumps(segment, ensure_ascii=False).encode("utf-8"))),
+        )
+        conn.execute(
+            "DELETE FROM messages WHERE session_id = ? AND seq <= ?", (session_id, rows[-1][0])
+        )
+        # The hot window changed, so cached copies of it are stale.
+        conn.execute("UPDATE sessions SET version = version + 1 WHERE session_id = ?", (session_id,))
+        return 1
+
+    @classmethod
+    def _insert(cls, conn: sqlite3.Connection, session_id: str, start: int, messages: List[Dict[str, str]]):
+        conn.executemany(
+            "INSERT INTO messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+            [(session_id, start + i, m["role"], m["content"]) for i, m in enumerate(messages)],
+        )
+        for i, m in enumerate(messages):
+            if _is_story(m):
+                cls._add_story(conn, session_id, start + i, m["content"])
+
+    @staticmethod
+    def _add_story(conn: sqlite3.Connection, session_id: str, seq: int, content: str):
+        (version,) = conn.execute(
+            "SELECT COALESCE(MAX(version), 0) FROM stories WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        conn.execute(
+            "INSERT INTO stories (session_id, version, seq, content) VALUES (?, ?, ?, ?)",
+            (session_id, version + 1, seq, story_text(content)),
+        )
+
+    def _backfill_stories(self):
+        """One-time: build the stories table for databases created before it existed."""
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'stories_backfilled'").fetchone():
+                return
+            conn.execute("DELETE FROM stories")
+            rows = conn.execute(
+                "SELECT session_id, seq, content FROM messages"
+                " WHERE role = 'ai' AND substr(content, 1, ?) = ? ORDER BY session_id, seq",
+                (len(STORY_TAG), STORY_TAG),
+            ).fetchall()
+            for session_id, seq, content in rows:
+                self._add_story(conn, session_id, seq, content)
+            conn.execute("INSERT INTO meta (key, value) VALUES ('stories_backfilled', ?)", (str(len(rows)),))
+
+    def _backfill_sessions(self):
+        """One-time: add a sessions row for every session of databases created before it existed."""
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'sessions_backfilled'").fetchone():
+                return
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, version, expires_at)"
+                " SELECT session_id, ?, ? FROM (SELECT session_id FROM messages UNION"
+                " SELECT session_id FROM archive UNION SELECT session_id FROM summaries)",
+                (time.time_ns() // 1000, time.time() + self.ttl if self.ttl else None),
+            )
+            conn.execute("INSERT INTO meta (key, value) VALUES ('sessions_backfilled', ?)", (str(cur.rowcount),))
+
+
+def migrate_json_store(json_path: str, store: SqliteMessageHistoryStore) -> int:
+    """
+    One-time import of a legacy sessions.json into a SqliteMessageHistoryStore.
+    The import is recorded in the store's meta table, so calling this again (from
+    this or any other worker process) is a no-op.
+    Returns the number of sessions imported.
+    """
+    if not os.path.exists(json_path):
+        return 0
+    marker = f"migrated:{os.path.abspath(json_path)}"
+
+    with store._transaction() as conn:
+        if conn.execute("SELECT 1 FROM meta WHERE key = ?", (marker,)).fetchone():
+            return 0
+
+        with open(json_path, "r", encoding="utf-8") as f:
+            db = json.load(f)
+
+        for session_id, history in db.items():
+            for table in ("messages", "stories", "archive"):
+                conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+            store._insert(conn, session_id, 0, history)
+            store._compact(conn, session_id, slack=0)
+            store._touch(conn, session_id)
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (marker, str(len(db))))
+    return len(db)
+
+
+# ============================================================
+# REDIS STORE — shared by every app node
+# ============================================================
+class RedisError(RuntimeError):
+    """Error reply from the Redis server."""
+
+
+def _resp_command(args: Sequence[Any]) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        data = a if isinstance(a, bytes) else str(a).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+def _resp_reply(reader) -> Any:
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        return RedisError(rest.decode("utf-8"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        return None if n < 0 else reader.read(n + 2)[:-2]
+    if kind == b"*":
+        n = int(rest)
+        return None if n < 0 else [_resp_reply(reader) for _ in range(n)]
+    raise ConnectionError(f"Unexpected Redis reply: {line[:80]!r}")
+
+
+class _RespClient:
+    """
+    Minimal Redis (RESP2) client for RedisMessageHistoryStore: commands and
+    pipelines over one connection per thread, nothing else. `url` is
+    redis://[:password@]host[:port][/db].
+    """
+
+    def __init__(self, url: str, timeout: float = 10.0):
+        parts = urlsplit(url)
+        if parts.scheme != "redis":
+            raise ValueError(f"Unsupported Redis URL {url!r} (expected redis://host:port/db)")
+        self.address = (parts.hostname or "127.0.0.1", parts.port or 6379)
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+            setup = ([("AUTH", self.password)] if self.password else []) + ([("SELECT", self.db)] if self.db else [])
+            if setup:
+                self.pipeline(*setup)
+        return conn
+
+    def _drop(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[0].close()
+
+    def pipeline(self, *commands: Sequence[Any]) -> List[Any]:
+        """Sends the commands in one write and returns their replies (RedisError on an error reply)."""
+        sock, reader = self._connection()
+        try:
+            sock.sendall(b"".join(_resp_command(c) for c in commands))
+            replies = [_resp_reply(reader) for _ in commands]
+        except OSError:
+            self._drop()  # out of sync with the server: reconnect on the next call
+            raise
+        for r in replies:
+            if isinstance(r, RedisError):
+                raise r
+        return replies
+
+    def execute(self, *args: Any) -> Any:
+        return self.pipeline(args)[0]
+
+
+class RedisMessageHistoryStore:
+    """
+    Session store on a Redis server, so several app nodes share their sessions.
+
+    Each session is a handful of keys under `<prefix>{<session id>}:`: `msgs` (the
+    hot messages, a list of JSON), `archive` (compressed segments of older ones),
+    `base` (seq of the first hot message), `stories` ([seq, text] per approved
+    story), `summary`, and `born` / `ver` for session_version(). Writes that depend
+    on what is stored (story seqs, replacements, compaction) run in WATCH / MULTI /
+    EXEC transactions retried on conflict, so writers on different nodes never lose
+    each other's messages; plain appends are a single MULTI.
+
+    With `ttl` > 0 every write pushes the Redis expiry of the session's keys out
+    by `ttl` seconds, so Redis itself drops abandoned sessions; `<prefix>sessions`
+    (a sorted set by expiry) lists live sessions and is trimmed by expire().
+    """
+
+    def __init__(self, url: str, prefix: str = "story:", hot_window: int = 0, ttl: float = 0.0):
+        self.url = url
+        self.prefix = prefix
+        self.hot_window = hot_window
+        self.ttl = ttl
+        self._client = _RespClient(url)
+        self._session_locks = _SessionLocks()
+        self._index = prefix + "sessions"
+
+    def _keys(self, session_id: str) -> Dict[str, str]:
+        # The {hash tag} keeps a session's keys in one slot on Redis Cluster.
+        base = f"{self.prefix}{{{session_id}}}:"
+        return {name: base + name for name in ("msgs", "archive", "base", "stories", "summary", "born", "ver")}
+
+    def _transact(self, watch: List[str], build: Callable[[], List[tuple]]) -> List[Any]:
+        """
+        Runs the commands from build() in MULTI / EXEC. With `watch`, build() reads
+        after WATCH and the whole thing is retried if a watched key changed meanwhile.
+        Returns the EXEC replies.
+        """
+        for _ in range(100):
+            if watch:
+                self._client.execute("WATCH", *watch)
+            try:
+                commands = build()
+            except BaseException:
+                if watch:
+                    self._client.execute("UNWATCH")
+                raise
+            replies = self._client.pipeline(("MULTI",), *commands, ("EXEC",))
+            if replies[-1] is not None:
+                return replies[-1]
+        raise RedisError("Too many concurrent writers on one session")
+
+    def _touch(self, session_id: str, k: Dict[str, str]) -> List[tuple]:
+        """
+        Commands that bump the session's version and refresh its expiry. Their first
+        three replies give the versions before and after (see _touched_versions).
+        `born` starts from the clock, so a session recreated after expiry never
+        reuses a version.
+        """
+        commands = [("GET", k["born"]), ("SET", k["born"], time.time_ns() // 1000, "NX"), ("INCR", k["ver"])]
+        if self.ttl:
+            commands += [("PEXPIRE", key, int(self.ttl * 1000)) for key in k.values()]
+            commands.append(("ZADD", self._index, time.time() + self.ttl, session_id))
+        else:
+            commands += [("PERSIST", key) for key in k.values()]
+            commands.append(("ZADD", self._index, "+inf", session_id))
+        return commands
+
+    @staticmethod
+    def _touched_versions(replies: List[Any]) -> Tuple[str, str]:
+        born, _, ver = replies
+        before = f"{born.decode()}:{ver - 1}" if born else ""
+        return before, f"{(born or b'').decode()}:{ver}"
+
+    @staticmethod
+    def _story_entries(start: int, messages: List[Dict[str, str]]) -> List[str]:
+        return [json.dumps([start + i, story_text(m["content"])], ensure_ascii=False)
+                for i, m in enumerate(messages) if _is_story(m)]
+
+    def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        """The hot (recent) part of a session's history; all of it when windowing is off."""
+        return [json.loads(m) for m in self._client.execute("LRANGE", self._keys(session_id)["msgs"], 0, -1)]
+
+    def get_full_history(self, session_id: str) -> List[Dict[str, str]]:
+        """Archived segments followed by the hot messages (read in one transaction)."""
+        k = self._keys(session_id)
+        segments, hot = self._transact([], lambda: [("LRANGE", k["archive"], 0, -1), ("LRANGE", k["msgs"], 0, -1)])
+        history = [m for seg in segments for m in json.loads(zlib.decompress(seg))]
+        return history + [json.loads(m) for m in hot]
+
+    def set_history(self, session_id: str, history: List[Dict[str, str]]):
+        """Persists the hot history, rewriting only what follows the common prefix with the stored one."""
+        k = self._keys(session_id)
+
+        def build():
+            stored, base, stories = self._client.pipeline(
+                ("LRANGE", k["msgs"], 0, -1), ("GET", k["base"]), ("LRANGE", k["stories"], 0, -1))
+            base = int(base or 0)
+            keep = 0
+            for raw, m in zip(stored, history):
+                if json.loads(raw) != m:
+                    break
+                keep += 1
+            commands = []
+            if keep < len(stored):
+                kept = [s for s in stories if json.loads(s)[0] < base + keep]
+                commands.append(("LTRIM", k["msgs"], 0, keep - 1) if keep else ("DEL", k["msgs"]))
+                commands.append(("DEL", k["stories"]))
+                commands += [("RPUSH", k["stories"], *kept)] if kept else []
+            new = history[keep:]
+            if new:
+                commands.append(("RPUSH", k["msgs"], *[json.dumps(m, ensure_ascii=False) for m in new]))
+                entries = self._story_entries(base + keep, new)
+                commands += [("RPUSH", k["stories"], *entries)] if entries else []
+            return commands + self._touch(session_id, k)
+
+        with self._session_locks.get(session_id):
+            self._transact([k["msgs"], k["stories"]], build)
+            self._compact(session_id)
+
+    def apply_changes(self, session_id: str, appended: List[Dict[str, str]],
+                      summary: Optional[Dict[str, Any]] = None) -> Optional[Tuple[str, str]]:
+        """
+        Appends new messages and (optionally) stores the session summary in one
+        transaction. Messages appended concurrently by other
+        writers are preserved. Returns the session_version() just before and just
+        after the write (before compaction, which bumps it again).
+        """
+        if not appended and summary is None:
+            return None
+        k = self._keys(session_id)
+        touch: List[tuple] = []
+        needs_position = any(_is_story(m) for m in appended)
+
+        def build():
+            commands = []
+            if needs_position:
+                length, base = self._client.pipeline(("LLEN", k["msgs"]), ("GET", k["base"]))
+                entries = self._story_entries(int(base or 0) + length, appended)
+                commands += [("RPUSH", k["stories"], *entries)] if entries else []
+            if appended:
+                commands.append(("RPUSH", k["msgs"], *[json.dumps(m, ensure_ascii=False) for m in appended]))
+            if summary is not None:
+                commands.append(("SET", k["summary"], json.dumps(summary, ensure_ascii=False)))
+            touch[:] = self._touch(session_id, k)
+            return commands + touch
+
+        with self._session_locks.get(session_id):
+            replies = self._transact([k["msgs"], k["stories"]] if needs_position else [], build)
+            versions = self._touched_versions(replies[-len(touch):][:3])
+            if appended and self._compact(session_id):
+                versions = (versions[0], self.session_version(session_id))
+        return versions
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]):
+        """Appends messages to the end of a session without reading its history."""
+        self.apply_changes(session_id, list(messages))
+
+    def get_current_story(self, session_id: str) -> Optional[str]:
+        """Latest approved story of a session, without reading its messages."""
+        raw = self._client.execute("LINDEX", self._keys(session_id)["stories"], -1)
+        return json.loads(raw)[1] if raw else None
+
+    def story_versions(self, session_id: str) -> List[str]:
+        """All approved stories of a session, oldest first."""
+        return [json.loads(s)[1] for s in self._client.execute("LRANGE", self._keys(session_id)["stories"], 0, -1)]
+
+    def get_summary(self, session_id: str) -> Dict[str, Any]:
+        raw = self._client.execute("GET", self._keys(session_id)["summary"])
+        return json.loads(raw) if raw else {}
+
+    def session_ids(self) -> List[str]:
+        """Sessions that have not expired."""
+        return [s.decode("utf-8") for s in self._client.execute("ZRANGEBYSCORE", self._index, f"({time.time()}", "+inf")]
+
+    def session_version(self, session_id: str) -> str:
+        """Changes whenever the session is written, compacted or expired ("" : no such session)."""
+        k = self._keys(session_id)
+        born, ver = self._client.execute("MGET", k["born"], k["ver"])
+        return f"{(born or b'').decode()}:{(ver or b'').decode()}" if born or ver else ""
+
+    def compact_all(self) -> int:
+        """Archives old messages of every session now. Returns the number of sessions compacted."""
+        compacted = 0
+        for session_id in self.session_ids():
+            with self._session_locks.get(session_id):
+                compacted += self._compact(session_id, slack=0)
+        return compacted
+
+    def _compact(self, session_id: str, slack: Optional[int] = None) -> int:
+        """Moves messages older than the hot window into one archive segment (batched like the SQLite store)."""
+        if not self.hot_window:
+            return 0
+        if slack is None:
+            slack = max(1, self.hot_window // 2)
+        k = self._keys(session_id)
+        archived = []
+
+        def build():
+            archived.clear()
+            length = self._client.execute("LLEN", k["msgs"])
+            if length <= self.hot_window + slack:
+                return []
+            cut = length - self.hot_window
+            segment = b"[" + b",".join(self._client.execute("LRANGE", k["msgs"], 0, cut - 1)) + b"]"
+            archived.append(cut)
+            commands = [("RPUSH", k["archive"], zlib.compress(segment)), ("LTRIM", k["msgs"], cut, -1),
+                        ("INCRBY", k["base"], cut), ("INCR", k["ver"])]
+            if self.ttl:
+                commands += [("PEXPIRE", k[name], int(self.ttl * 1000)) for name in ("archive", "base")]
+            return commands
+
+        self._transact([k["msgs"]], build)
+        return 1 if archived else 0
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """
+        Deletes the sessions whose TTL has passed (Redis usually has already) and
+        drops them from the session list. Returns how many. A no-op without a TTL.
+        """
+        if not self.ttl:
+            return 0
+        now = time.time() if now is None else now
+        expired = 0
+        for raw in self._client.execute("ZRANGEBYSCORE", self._index, "-inf", now):
+            session_id = raw.decode("utf-8")
+            k = self._keys(session_id)
+            gone = []
+
+            def build():
+                gone.clear()
+                score = self._client.execute("ZSCORE", self._index, session_id)
+                if score is None or float(score) > now:
+                    return []  # written again meanwhile
+                gone.append(session_id)
+                return [("DEL", *k.values()), ("ZREM", self._index, session_id)]
+
+            self._transact([k["ver"], self._index], build)
+            expired += len(gone)
+        return expired
+
+    def reclaim_space(self) -> bool:
+        """Nothing to do: Redis frees the memory of deleted keys itself."""
+        return False
+
+    def try_lease(self, name: str, seconds: float) -> bool:
+        """Takes the named lease for `seconds` unless another holder's lease is still running."""
+        key = f"{self.prefix}lease:{name}"
+        return self._client.execute("SET", key, "1", "NX", "PX", max(1, int(seconds * 1000))) is not None
+
+    def claim_shard(self, index: int, count: int):
+        """Records this server as shard `index` of `count`; ValueError if it is another shard."""
+        label = f"{index}/{count}"
+        key = self.prefix + "shard"
+        _, stored = self._client.pipeline(("SET", key, label, "NX"), ("GET", key))
+        if stored.decode("utf-8") != label:
+            raise ValueError(f"{self.url} is shard {stored.decode('utf-8')}, not {label}: "
+                             "the shard count changed, sessions would be looked up in the wrong shard")
+
+
+# ============================================================
+# SHARDING
+# ============================================================
+class ShardedMessageHistoryStore:
+    """
+    Spreads sessions over several stores (SQLite files or Redis servers) by a
+    stable hash of the session id. A session lives in exactly one shard, so every
+    per-session call is a single call on that shard; only session_ids() and the
+    maintenance calls visit all of them. Each shard records its position and the
+    shard count, so reopening with a different count fails instead of losing sessions.
+    """
+
+    def __init__(self, shards: Sequence[Any]):
+        if not shards:
+            raise ValueError("ShardedMessageHistoryStore needs at least one shard")
+        self.shards = list(shards)
+        for i, shard in enumerate(self.shards):
+            shard.claim_shard(i, len(self.shards))
+
+    def shard(self, session_id: str):
+        return self.shards[zlib.crc32(session_id.encode("utf-8")) % len(self.shards)]
+
+    def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        return self.shard(session_id).get_history(session_id)
+
+    def get_full_history(self, session_id: str) -> List[Dict[str, str]]:
+        return self.shard(session_id).get_full_history(session_id)
+
+    def set_history(self, session_id: str, history: List[Dict[str, str]]):
+        self.shard(session_id).set_history(session_id, history)
+
+    def apply_changes(self, session_id: str, appended: List[Dict[str, str]],
+                      summary: Optional[Dict[str, Any]] = None) -> Any:
+        return self.shard(session_id).apply_changes(session_id, appended, summary)
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]):
+        self.shard(session_id).append_messages(session_id, messages)
+
+    def get_current_story(self, session_id: str) -> Optional[str]:
+        return self.shard(session_id).get_current_story(session_id)
+
+    def story_versions(self, session_id: str) -> List[str]:
+        return self.shard(session_id).story_versions(session_id)
+
+    def get_summary(self, session_id: str) -> Dict[str, Any]:
+        return self.shard(session_id).get_summary(session_id)
+
+    def session_version(self, session_id: str) -> Any:
+        return self.shard(session_id).session_version(session_id)
+
+    def session_ids(self) -> List[str]:
+        return [session_id for shard in self.shards for session_id in shard.session_ids()]
+
+    def compact_all(self) -> int:
+        return sum(shard.compact_all() for shard in self.shards)
+
+    def expire(self, now: Optional[float] = None) -> int:
+        return sum(shard.expire(now) for shard in self.shards)
+
+    def reclaim_space(self) -> bool:
+        return any([shard.reclaim_space() for shard in self.shards])
+
+
+# ============================================================
+# HOT SESSION CACHE
+# ============================================================
+class CachedMessageHistoryStore:
+    """
+    Size-bounded LRU of hot sessions (hot history, current story, summary) in
+    front of another store. An entry is only served while the store's
+    session_version() still matches the one it was filled at, so writes from other
+    processes or nodes, compaction and expiry show up on the next read. With
+    `max_age` > 0 that check is skipped for entries checked in the last `max_age`
+    seconds: one read less per call, but another node's write can go unseen that long.
+    Writes go straight to the store. When the entry was current right before a
+    write (the store returns the versions around it), the written story and summary
+    are applied to it, so the next turn of a session is served from the cache;
+    otherwise the entry is dropped.
+    """
+
+    def __init__(self, store, max_sessions: int = 1000, max_age: float = 0.0):
+        self.store = store
+        self.max_sessions = max(1, max_sessions)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._writes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __getattr__(self, name: str):
+        # Everything not cached (full history, story versions, maintenance...) goes to the store.
+        return getattr(self.store, name)
+
+    def _cached(self, session_id: str, field: str, load: Callable[[str], Any]) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and field in entry and self.max_age and now - entry["checked"] < self.max_age:
+                self._entries.move_to_end(session_id)
+                self._hits += 1
+                return entry[field]
+            writes = self._writes
+        # The version is read before the value, so a value is never older than its version.
+        version = self.store.session_version(session_id)
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry["version"] == version:
+                entry["checked"] = now
+                if field in entry:
+                    self._entries.move_to_end(session_id)
+                    self._hits += 1
+                    return entry[field]
+            self._misses += 1
+        value = load(session_id)
+        with self._lock:
+            if self._writes == writes:  # no write through this cache meanwhile
+                entry = self._entries.get(session_id)
+                if entry is None or entry["version"] != version:
+                    entry = self._entries[session_id] = {"version": version, "checked": now}
+                entry[field] = value
+                self._entries.move_to_end(session_id)
+                while len(self._entries) > self.max_sessions:
+                    self._entries.popitem(last=False)
+        return value
+
+    def _invalidate(self, session_id: str):
+        with self._lock:
+            self._writes += 1
+            self._entries.pop(session_id, None)
+
+    def get_history(self, session_id: str) -> List[Dict[str, str]]:
+        return list(self._cached(session_id, "history", self.store.get_history))
+
+    def get_current_story(self, session_id: str) -> Optional[str]:
+        return self._cached(session_id, "story", self.store.get_current_story)
+
+    def get_summary(self, session_id: str) -> Dict[str, Any]:
+        return dict(self._cached(session_id, "summary", self.store.get_summary))
+
+    def set_history(self, session_id: str, history: List[Dict[str, str]]):
+        try:
+            self.store.set_history(session_id, history)
+        finally:
+            self._invalidate(session_id)
+
+    def apply_changes(self, session_id: str, appended: List[Dict[str, str]],
+                      summary: Optional[Dict[str, Any]] = None) -> Any:
+        try:
+            versions = self.store.apply_changes(session_id, appended, summary)
+        except BaseException:
+            self._invalidate(session_id)
+            raise
+        with self._lock:
+            self._writes += 1
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return versions
+            if not versions or entry["version"] != versions[0]:
+                del self._entries[session_id]
+                return versions
+            entry["version"] = versions[1]
+            entry.pop("history", None)  # the store may have moved messages to the archive
+            stories = [m for m in appended if _is_story(m)]
+            if stories:
+                entry["story"] = story_text(stories[-1]["content"])
+            if summary is not None:
+                entry["summary"] = summary
+        return versions
+
+    def append_messages(self, session_id: str, messages: List[Dict[str, str]]):
+        self.apply_changes(session_id, list(messages))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"sessions": len(self._entries), "max_sessions": self.max_sessions,
+                    "hits": self._hits, "misses": self._misses}
+
+
+# ============================================================
+# MAINTENANCE (expiry, compaction, space reclaim)
+# ============================================================
+class SessionMaintenance:
+    """
+    Background thread that deletes expired sessions every `interval` seconds and,
+    every `compact_interval` seconds, archives old messages of every session and
+    gives freed space back to the file system. Each shard takes a lease first, so
+    every app process can run one and each shard is still maintained by one at a time.
+    """
+
+    def __init__(self, store, interval: float = 60.0, compact_interval: float = 3600.0):
+        self.store = store
+        self.interval = interval
+        self.compact_interval = compact_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.totals = {"runs": 0, "expired": 0, "compacted": 0, "vacuumed": 0, "errors": 0}
+
+    def start(self) -> "SessionMaintenance":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="session-maintenance", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self, compact: bool = False) -> Dict[str, int]:
+        """Expires (and with `compact`, compacts and vacuums) every shard whose lease it gets."""
+        done = {"expired": 0, "compacted": 0, "vacuumed": 0}
+        for shard in getattr(self.store, "shards", [self.store]):
+            if shard.try_lease("expire", self.interval * 0.9):
+                done["expired"] += shard.expire()
+            if compact and shard.try_lease("compact", self.compact_interval * 0.9):
+                done["compacted"] += shard.compact_all()
+                done["vacuumed"] += shard.reclaim_space()
+        self.totals["runs"] += 1
+        for key, n in done.items():
+            self.totals[key] += n
+        return done
+
+    def _loop(self):
+        next_compact = time.monotonic() + self.compact_interval
+        while not self._stop.wait(self.interval):
+            compact = self.compact_interval > 0 and time.monotonic() >= next_compact
+            if compact:
+                next_compact = time.monotonic() + self.compact_interval
+            try:
+                self.run_once(compact)
+            except Exception as e:
+                self.totals["errors"] += 1
+                print(f"Session maintenance failed: {e}")
@@ -0,0 +1,295 @@
+# metrics.py
+"""
+In-process instrumentation for the story pipeline.
+
+Two surfaces share the same measurements:
+
+- Prometheus-style metrics (render() -> text exposition format, served at /metrics):
+  per-stage LLM call latency, prompt/response sizes and token usage, per-operation
+  store latency and per-route request latency. Values are per process; with several
+  gunicorn/uvicorn workers, scrape each worker or aggregate in Prometheus.
+- A per-request timing breakdown: inside `with request_timer() as timer:` every LLM
+  call, store operation and local step is recorded as a span, and
+  `timer.breakdown()` returns them for the /chat response. Spans are collected
+  through a contextvar, so asyncio tasks and to_thread calls are included.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STORE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.labels, k)} {v:g}" for k, v in items]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def totals(self) -> Dict[Tuple[str, ...], Tuple[int, float]]:
+        """(count, sum) per label values."""
+        with self._lock:
+            return {k: (int(v[-2]), v[-1]) for k, v in self._values.items()}
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in items:
+            for bound, count in zip(self.buckets, row):
+                le = f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {count:g}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {row[-2]:g}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {row[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {row[-2]:g}")
+        return lines
+
+
+# ============================================================
+# METRICS
+# ============================================================
+LLM_SECONDS = Histogram("story_llm_call_seconds", "LLM tool call wall time, including cache lookups.",
+                        ("stage", "outcome"))
+LLM_PROMPT_CHARS = Counter("story_llm_prompt_chars_total", "Characters sent to the LLM.", ("stage",))
+LLM_RESPONSE_CHARS = Counter("story_llm_response_chars_total", "Characters received from the LLM.", ("stage",))
+LLM_TOKENS = Counter("story_llm_tokens_total", "Tokens reported by the LLM backend.", ("stage", "kind"))
+STORE_SECONDS = Histogram("story_store_op_seconds", "Session store operation wall time.", ("op",),
+                          buckets=STORE_BUCKETS)
+STAGE_SECONDS = Histogram("story_local_stage_seconds", "Local (non-LLM) pipeline step wall time.", ("stage",))
+REQUEST_SECONDS = Histogram("story_chat_request_seconds", "/chat request wall time.", ("route", "status"))
+PIPELINE_SECONDS = Histogram("story_pipeline_seconds", "New-story generation wall time per pipeline mode.",
+                             ("mode", "outcome"))
+PIPELINE_LLM_CALLS = Counter("story_pipeline_llm_calls_total",
+                             "Upstream LLM calls made by new-story generation (cache hits excluded).", ("mode",))
+PIPELINE_REWRITES = Counter("story_pipeline_rewrites_total", "Generated stories that were rewritten.", ("mode",))
+INDEX_LOOKUPS = Counter("story_index_lookups_total", "Semantic story index lookups by outcome.", ("outcome",))
+INDEX_REUSES = Counter("story_index_reuses_total", "Indexed stories offered or used as rewrite seeds.", ("kind",))
+BATCH_ITEMS = Counter("story_batch_items_total", "Batch job items written, by status.", ("status",))
+
+_METRICS = [LLM_SECONDS, LLM_PROMPT_CHARS, LLM_RESPONSE_CHARS, LLM_TOKENS, STORE_SECONDS,
+            STAGE_SECONDS, REQUEST_SECONDS, PIPELINE_SECONDS, PIPELINE_LLM_CALLS, PIPELINE_REWRITES,
+            INDEX_LOOKUPS, INDEX_REUSES, BATCH_ITEMS]
+# Callables returning extra exposition lines (e.g. cache and gateway counters).
+_collectors: List[Callable[[], List[str]]] = []
+
+def add_collector(fn: Callable[[], List[str]]):
+    _collectors.append(fn)
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines += metric.render()
+    for fn in _collectors:
+        lines += fn()
+    return "\n".join(lines) + "\n"
+
+def counter_lines(name: str, help: str, labels: Sequence[str],
+                  values: Dict[Tuple[str, ...], float], kind: str = "counter") -> List[str]:
+    """Exposition lines for values computed at scrape time."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels, k)} {v:g}" for k, v in sorted(values.items())]
+    return lines
+
+
+# ============================================================
+# PER-REQUEST TIMING
+# ============================================================
+_SPANS: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar("story_spans", default=None)
+_CALL_COUNTS: contextvars.ContextVar[Optional[List["CallCount"]]] = contextvars.ContextVar("story_call_counts",
+                                                                                          default=None)
+
+
+class RequestTimer:
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+        self.total = 0.0
+
+    def breakdown(self) -> Dict[str, Any]:
+        """Total time, time per stage, and the individual spans in start order."""
+        by_stage: Dict[str, float] = {}
+        spans = []
+        for s in sorted(list(self.spans), key=lambda s: s["_t0"]):
+            by_stage[s["stage"]] = round(by_stage.get(s["stage"], 0.0) + s["ms"], 3)
+            span = {k: v for k, v in s.items() if k != "_t0"}
+            span["start_ms"] = round((s["_t0"] - self.started) * 1000, 3)
+            spans.append(span)
+        return {"total_ms": round(self.total * 1000, 3), "by_stage": by_stage, "spans": spans}
+
+
+@contextmanager
+def request_timer(enabled: bool = True) -> Iterator[Optional[RequestTimer]]:
+    """Collects the spans recorded inside the block (yields None when disabled)."""
+    if not enabled:
+        yield None
+        return
+    timer = RequestTimer()
+    token = _SPANS.set(timer.spans)
+    try:
+        yield timer
+    finally:
+        timer.total = time.perf_counter() - timer.started
+        _SPANS.reset(token)
+
+
+def _span(stage: str, t0: float, elapsed: float, **extra):
+    spans = _SPANS.get()
+    if spans is not None:
+        spans.append(dict(stage=stage, ms=round(elapsed * 1000, 3), _t0=t0, **extra))
+
+
+class CallCount:
+    """Upstream LLM calls (cache hits excluded) made inside a count_llm_calls() block."""
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.calls += 1
+
+
+@contextmanager
+def count_llm_calls() -> Iterator[CallCount]:
+    """Counts the LLM calls of the block, including those made from copied contexts."""
+    count = CallCount()
+    token = _CALL_COUNTS.set((_CALL_COUNTS.get() or []) + [count])
+    try:
+        yield count
+    finally:
+        _CALL_COUNTS.reset(token)
+
+
+class _LLMCall:
+    """Filled in by the caller inside llm_call(): outcome, response and token usage."""
+
+    def __init__(self):
+        self.outcome = "ok"
+        self.response_chars = 0
+        self.usage: Optional[Dict[str, Any]] = None
+
+    def cache_hit(self, content: str):
+        self.outcome = "cache_hit"
+        self.response_chars = len(content)
+
+    def response(self, content: str, usage: Optional[Dict[str, Any]] = None):
+        self.response_chars = len(content)
+        self.usage = usage
+
+
+@contextmanager
+def llm_call(stage: str, prompt: str) -> Iterator[_LLMCall]:
+    """Times one LLM tool call (`stage` is its run_name) and records sizes and tokens."""
+    call = _LLMCall()
+    t0 = time.perf_counter()
+    try:
+        yield call
+    except asyncio.CancelledError:
+        call.outcome = "cancelled"  # e.g. an unused speculative draft
+        raise
+    except BaseException:
+        call.outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        LLM_SECONDS.observe(elapsed, stage, call.outcome)
+        if call.outcome != "cache_hit":
+            for count in _CALL_COUNTS.get() or ():
+                count.add()
+        extra: Dict[str, Any] = {"outcome": call.outcome}
+        if call.outcome == "ok":
+            LLM_PROMPT_CHARS.inc(stage, amount=len(prompt))
+            LLM_RESPONSE_CHARS.inc(stage, amount=call.response_chars)
+            if call.usage:
+                for kind in ("input_tokens", "output_tokens"):
+                    if call.usage.get(kind):
+                        LLM_TOKENS.inc(stage, kind, amount=call.usage[kind])
+                extra["tokens"] = {k: call.usage.get(k) for k in ("input_tokens", "output_tokens")}
+        _span(stage, t0, elapsed, **extra)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times a local pipeline step (fast-path router, safety pre-screen...)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.observe(elapsed, name)
+        _span(name, t0, elapsed)
+
+
+class InstrumentedStore:
+    """Wraps a session store; every public method call is timed as `store.<method>`."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._store, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                STORE_SECONDS.observe(elapsed, name)
+                _span(f"store.{name}", t0, elapsed)
+        return timed
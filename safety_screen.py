@@ -0,0 +1,207 @@
+# safety_screen.py
+"""
+Deterministic local safety pre-screen for kids' stories and user instructions.
+
+Every inflected form of a small lexicon (kill, kills, killed, killing, killer...)
+is precompiled into one hash table mapping the form back to its lemma, so a text
+is screened with a single tokenizing pass and one dict lookup per word. Terms are
+either HARD (never acceptable: blood, murder, gun...) or SOFT (often fine in
+context, e.g. "lost", "dark", "cry": the LLM judge decides). A hit the negation
+directly applies to ("no blood", "without any fighting", "remove the guns") is
+downgraded to SOFT, since it usually asks for *less* of the thing. Harmless
+compounds of lexicon words ("killer whale", "blood orange", "bath bomb") are
+skipped before lookup.
+
+    screen(text).verdict  ->  "unsafe" | "review" | "clean"
+
+"unsafe" means at least one non-negated HARD term, "clean" means no lexicon term
+at all, and anything else is "review".
+"""
+import re
+from typing import Dict, List, NamedTuple, Tuple
+
+HARD = "hard"
+SOFT = "soft"
+
+# lemma -> irregular forms (regular -s/-es/-ed/-ing/-er/-ers forms are generated)
+_HARD_TERMS: Dict[str, Tuple[str, ...]] = {
+    "blood": ("bloody", "bloodied", "bloodshed", "bleed", "bleeds", "bleeding", "bled"),
+    "murder": ("murderous",),
+    "kill": (),
+    "stab": (),
+    "slaughter": (),
+    "massacre": (),
+    "behead": (),
+    "decapitate": (),
+    "strangle": (),
+    "torture": (),
+    "suicide": (),
+    "corpse": (),
+    "gun": ("gunshot", "gunfire"),
+    "rifle": (),
+    "pistol": (),
+    "bomb": (),
+    "grenade": (),
+    "abuse": ("abusive",),
+    "rape": (),
+    "assault": (),
+    "gore": ("gory",),
+    "drown": (),
+    "kidnap": ("kidnapped", "kidnapping", "kidnapper"),
+}
+
+_SOFT_TERMS: Dict[str, Tuple[str, ...]] = {
+    "die": ("dies", "died", "dying", "dead", "death", "deaths", "deadly"),
+    "fight": ("fought", "fighting"),
+    "hit": ("hitting",),
+    "hurt": ("hurting",),
+    "injure": ("injury", "injuries"),
+    "wound": (),
+    "weapon": (),
+    "sword": (),
+    "knife": ("knives",),
+    "war": ("warrior", "warriors"),
+    "battle": (),
+    "attack": (),
+    "monster": (),
+    "ghost": (),
+    "scary": ("scare", "scared", "scares", "scaring"),
+    "fear": ("fearful", "frightened", "frightening", "terrified", "terror", "horror"),
+    "afraid": (),
+    "cry": ("cried", "cries", "crying"),
+    "sad": ("sadness",),
+    "grief": ("grieve", "grieving", "mourn", "mourning", "funeral"),
+    "lost": ("loss",),
+    "dark": ("darkness",),
+    "danger": ("dangerous",),
+    "bully": ("bullied", "bullies", "bullying"),
+    "punch": (),
+    "steal": ("stole", "stolen"),
+    "cage": (),
+    "shoot": ("shot",),
+    "hate": ("hatred",),
+    "poison": ("poisonous",),
+}
+
+# Harmless words and compounds that contain a lexicon form; matched before the lexicon.
+_SAFE_COMPOUNDS = (
+    "killer whale", "killer whales", "killer bee", "killer bees",
+    "blood orange", "blood oranges", "blood moon", "bloodhound", "bloodhounds",
+    "bath bomb", "bath bombs", "glitter bomb", "glitter bombs", "seed bomb", "seed bombs",
+    "gunner", "gunners", "water gun", "water guns", "bubble gun", "bubble guns", "glue gun",
+    "photo shoot", "bamboo shoot", "bamboo shoots",
+)
+
+_NEGATORS = {
+    "no", "not", "never", "without", "nothing", "none", "don't", "dont", "doesn't",
+    "isn't", "aren't", "wasn't", "avoid", "remove", "removing", "less", "stop",
+    "nobody", "neither", "nor",
+}
+# A negation covers the phrase right after it: determiners and intensifiers are
+# skipped ("without any fighting", "remove the guns"), lexicon words extend it
+# ("no scary monsters"), "or"/"nor" carries it on ("no fighting or blood"), and
+# the first other word ends it ("did not hesitate and killed" is not negated).
+_NEGATION_FILLERS = {
+    "a", "an", "the", "any", "more", "of", "too", "so", "very", "much", "many", "all",
+    "some", "such", "real", "really", "his", "her", "their", "its", "them", "those", "these",
+}
+_NEGATION_CONTINUERS = {"or", "nor"}
+
+_VOWELS = set("aeiou")
+
+
+def _inflections(lemma: str) -> List[str]:
+    """Regular English inflections, good enough for a short verb/noun lexicon."""
+    forms = {lemma, lemma + ("es" if lemma.endswith(("s", "x", "z", "ch", "sh")) else "s")}
+    if lemma.endswith("e"):
+        stem = lemma[:-1]
+        forms.update({lemma + "d", stem + "ing", lemma + "r", lemma + "rs"})
+    else:
+        stem = lemma
+        # Short CVC words double the final consonant: stab -> stabbed, stabbing.
+        if (len(lemma) <= 4 and lemma[-1] not in _VOWELS and lemma[-2] in _VOWELS
+                and lemma[-3:-2] not in _VOWELS and lemma[-1] not in "wxy"):
+            stem = lemma + lemma[-1]
+        forms.update({stem + "ed", stem + "ing", stem + "er", stem + "ers"})
+    return sorted(forms)
+
+
+def _build_lexicon() -> Dict[str, Tuple[str, str]]:
+    surface: Dict[str, Tuple[str, str]] = {}
+    for severity, terms in ((SOFT, _SOFT_TERMS), (HARD, _HARD_TERMS)):
+        for lemma, extra in terms.items():
+            for form in _inflections(lemma) + list(extra):
+                surface[form] = (lemma, severity)
+    return surface
+
+
+_LEXICON = _build_lexicon()
+_WORD = re.compile(r"[a-z']+")
+
+
+def _build_compounds() -> Dict[str, List[Tuple[str, ...]]]:
+    """First word -> safe compounds starting with it, longest first."""
+    compounds: Dict[str, List[Tuple[str, ...]]] = {}
+    for phrase in _SAFE_COMPOUNDS:
+        words = tuple(phrase.split())
+        compounds.setdefault(words[0], []).append(words)
+    for options in compounds.values():
+        options.sort(key=len, reverse=True)
+    return compounds
+
+
+_COMPOUNDS = _build_compounds()
+
+
+class Hit(NamedTuple):
+    term: str       # surface form found in the text
+    lemma: str
+    severity: str   # HARD / SOFT after negation handling
+    negated: bool
+
+
+class ScreenResult(NamedTuple):
+    verdict: str    # "unsafe" | "review" | "clean"
+    hits: List[Hit]
+
+    @property
+    def unsafe(self) -> bool:
+        return self.verdict == "unsafe"
+
+    @property
+    def clean(self) -> bool:
+        return self.verdict == "clean"
+
+
+def screen(text: str) -> ScreenResult:
+    """Screens `text` against the lexicon. Pure function, safe to call from any thread."""
+    hits = []
+    words = _WORD.findall(text.lower())
+    negating = False  # inside the phrase a negator applies to
+    i = 0
+    while i < len(words):
+        word = words[i]
+        compound = next((c for c in _COMPOUNDS.get(word, ()) if tuple(words[i:i + len(c)]) == c), None)
+        if compound is not None:
+            i += len(compound)
+            negating = False
+            continue
+        i += 1
+        if word in _NEGATORS:
+            negating = True
+            continue
+        entry = _LEXICON.get(word)
+        if entry is None:
+            if not (negating and (word in _NEGATION_FILLERS or word in _NEGATION_CONTINUERS)):
+                negating = False
+            continue
+        lemma, severity = entry
+        hits.append(Hit(word, lemma, SOFT if negating else severity, negating))
+
+    if any(h.severity == HARD for h in hits):
+        verdict = "unsafe"
+    elif hits:
+        verdict = "review"
+    else:
+        verdict = "clean"
+    return ScreenResult(verdict, hits)
@@ -0,0 +1,298 @@
+# story_audio.py
+"""
+Read-aloud audio for approved stories.
+
+A story is split into sentence chunks (the first one short, so playback can start
+early) and each chunk is synthesized by a pluggable engine on a background worker
+pool. Rendered chunks go into an on-disk cache keyed by a hash of engine, language
+and text, kept under a byte budget by evicting the least recently used files. A
+small JSON manifest per story lists its chunks, so any worker process can serve
+them.
+
+Engines:
+    gtts      Google Translate TTS through gTTS (needs network), MP3
+    offline   local stub that renders a short tone per word, WAV; no network
+"""
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import struct
+import tempfile
+import threading
+import wave
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Protocol
+
+
+class TTSEngine(Protocol):
+    name: str
+    media_type: str
+    extension: str
+
+    def synthesize(self, text: str) -> bytes: ...
+
+
+class GTTSEngine:
+    """gTTS (imported on first use)."""
+    name = "gtts"
+    media_type = "audio/mpeg"
+    extension = "mp3"
+
+    def __init__(self, lang: str = "en", tld: str = "com"):
+        self.lang = lang
+        self.tld = tld
+
+    def synthesize(self, text: str) -> bytes:
+        from gtts import gTTS
+        buf = io.BytesIO()
+        gTTS(text=text, lang=self.lang, tld=self.tld).write_to_fp(buf)
+        return buf.getvalue()
+
+
+class OfflineEngine:
+    """Deterministic stand-in: one short tone per word, pauses between sentences (16-bit mono WAV)."""
+    name = "offline"
+    media_type = "audio/wav"
+    extension = "wav"
+    lang = "none"
+
+    def __init__(self, rate: int = 8000, word_seconds: float = 0.18, gap_seconds: float = 0.07):
+        self.rate = rate
+        self._word = int(rate * word_seconds)
+        self._gap = b"\0\0" * int(rate * gap_seconds)
+        self._tones: Dict[int, bytes] = {}
+
+    def _tone(self, freq: int) -> bytes:
+        tone = self._tones.get(freq)
+        if tone is None:
+            samples = (int(6000 * math.sin(2 * math.pi * freq * i / self.rate)) for i in range(self._word))
+            tone = self._tones[freq] = struct.pack(f"<{self._word}h", *samples)
+        return tone
+
+    def synthesize(self, text: str) -> bytes:
+        frames = []
+        for word in text.split():
+            frames.append(self._tone(220 + 20 * (sum(word.encode("utf-8")) % 24)))
+            frames.append(self._gap * (4 if word[-1] in ".!?" else 1))
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(self.rate)
+            w.writeframes(b"".join(frames))
+        return buf.getvalue()
+
+
+def make_engine(name: str, lang: str = "en") -> TTSEngine:
+    if name == "gtts":
+        return GTTSEngine(lang=lang)
+    if name == "offline":
+        return OfflineEngine()
+    raise ValueError(f"unknown TTS_ENGINE: {name!r} (expected gtts or offline)")
+
+
+# ============================================================
+# CHUNKING
+# ============================================================
+_SENTENCE = re.compile(r"[^.!?]+(?:[.!?]+[\"')\]]*|$)")
+
+def split_chunks(text: str, max_chars: int = 240) -> List[str]:
+    """Sentence-aligned chunks of up to `max_chars`; the first chunk is a single sentence."""
+    sentences = [s.strip() for s in _SENTENCE.findall(text.replace("\n", " ")) if s.strip()]
+    chunks: List[str] = []
+    for sentence in sentences:
+        if len(chunks) > 1 and len(chunks[-1]) + 1 + len(sentence) <= max_chars:
+            chunks[-1] += " " + sentence
+        else:
+            chunks.append(sentence)
+    return chunks
+
+
+# ============================================================
+# CACHE
+# ============================================================
+class AudioCache:
+    """Content-addressed files in `directory`, trimmed to `max_bytes` (least recently used first)."""
+
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Running size estimate; the directory is re-scanned when it passes the budget
+        # (and every 100 writes, to see files written by other processes).
+        self._estimate: Optional[int] = None
+        self._puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def get(self, name: str) -> Optional[str]:
+        """Path of a cached file (marked as recently used), or None."""
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, name: str, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path(name))
+        with self._lock:
+            self._puts += 1
+            if self._estimate is not None:
+                self._estimate += len(data)
+            if self._estimate is None or self._estimate > self.max_bytes or self._puts % 100 == 0:
+                self._evict()
+
+    def _evict(self):
+        """
+        Removes least recently used files down to 90% of the budget (caller holds the lock).
+        Audio goes before the small .json manifests, so a story stays addressable and
+        its evicted chunks can be rendered again.
+        """
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.is_file() and not e.name.startswith("."):
+                st = e.stat()
+                entries.append((e.name.endswith(".json"), st.st_mtime, st.st_size, e.path))
+        total = sum(entry[2] for entry in entries)
+        if total > self.max_bytes:
+            # Trim to 90% of the budget so we don't evict on every single put.
+            for _, _, size, path in sorted(entries):
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self._estimate = total
+
+    def stats(self) -> Dict[str, int]:
+        files = [e for e in os.scandir(self.directory) if e.is_file() and not e.name.startswith(".")]
+        return {"files": len(files), "bytes": sum(e.stat().st_size for e in files), "max_bytes": self.max_bytes}
+
+
+# ============================================================
+# RENDERER
+# ============================================================
+_STORY_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class AudioRenderer:
+    """Renders story chunks on a worker pool into the cache; see manifest() for what is ready."""
+
+    def __init__(self, engine: TTSEngine, cache: AudioCache, workers: int = 2, max_chars: int = 240):
+        self.engine = engine
+        self.cache = cache
+        self.max_chars = max_chars
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story-audio")
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._counts = {"stories": 0, "chunks_rendered": 0, "chunks_cached": 0, "failures": 0}
+
+    def _key(self, text: str) -> str:
+        raw = f"{self.engine.name}|{getattr(self.engine, 'lang', '')}|{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+    def story_id(self, story: str) -> str:
+        """Stable id of a story's audio (same text and engine, same id)."""
+        return self._key(story)
+
+    def _chunk_file(self, key: str) -> str:
+        return f"{key}.{self.engine.extension}"
+
+    def submit(self, story: str) -> str:
+        """Queues every chunk of `story` (first chunk first) and returns the story id."""
+        story_id = self.story_id(story)
+        chunks = split_chunks(story, self.max_chars)
+        manifest = {"id": story_id, "engine": self.engine.name, "media_type": self.engine.media_type,
+                    "chunks": [{"key": self._key(c), "text": c} for c in chunks]}
+        self.cache.put(f"{story_id}.json", json.dumps(manifest).encode("utf-8"))
+        with self._lock:
+            self._counts["stories"] += 1
+            for chunk in manifest["chunks"]:
+                if self._queue(chunk["key"], chunk["text"]) is None:
+                    self._counts["chunks_cached"] += 1
+        return story_id
+
+    def _queue(self, key: str, text: str) -> Optional[Future]:
+        """Render job for a chunk (reusing a running one), or None when it is cached (caller holds the lock)."""
+        job = self._jobs.get(key)
+        if job is not None and not job.done():
+            return job
+        if self.cache.get(self._chunk_file(key)) is not None:
+            return None
+        job = self._jobs[key] = self._pool.submit(self._render, key, text)
+        return job
+
+    def _render(self, key: str, text: str):
+        try:
+            self.cache.put(self._chunk_file(key), self.engine.synthesize(text))
+        except Exception as e:
+            print(f"Audio rendering failed ({self.engine.name}): {e}")
+            with self._lock:
+                self._counts["failures"] += 1
+                self._jobs.pop(key, None)
+            raise
+        with self._lock:
+            self._counts["chunks_rendered"] += 1
+            self._jobs.pop(key, None)
+
+    def manifest(self, story_id: str) -> Optional[Dict[str, Any]]:
+        """The story's chunks with a `ready` flag each, or None for an unknown (or evicted) story."""
+        if not _STORY_ID.fullmatch(story_id):
+            return None
+        path = self.cache.get(f"{story_id}.json")
+        if path is None:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        for chunk in manifest["chunks"]:
+            chunk["ready"] = os.path.exists(self.cache.path(self._chunk_file(chunk["key"])))
+        manifest["complete"] = all(c["ready"] for c in manifest["chunks"])
+        return manifest
+
+    def chunk_path(self, story_id: str, index: int, wait: float = 0.0) -> Optional[str]:
+        """
+        Path of chunk `index`, waiting up to `wait` seconds for it to render. A chunk
+        that was evicted, or whose render failed, is queued again. None when the story
+        or chunk is unknown or not ready in time.
+        """
+        manifest = self.manifest(story_id)
+        if manifest is None or not 0 <= index < len(manifest["chunks"]):
+            return None
+        chunk = manifest["chunks"][index]
+        path = self.cache.get(self._chunk_file(chunk["key"]))
+        if path is not None:
+            return path
+        with self._lock:
+            job = self._queue(chunk["key"], chunk["text"])
+        if job is not None:
+            try:
+                job.result(timeout=wait)
+            except Exception:
+                return None
+        return self.cache.get(self._chunk_file(chunk["key"]))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._counts, pending=sum(not j.done() for j in self._jobs.values()))
+        out["engine"] = self.engine.name
+        out["cache"] = self.cache.stats()
+        return out
+
+
+def audio_from_env() -> AudioRenderer:
+    engine = make_engine(os.getenv("TTS_ENGINE", "gtts").lower(), lang=os.getenv("TTS_LANG", "en"))
+    cache = AudioCache(os.getenv("AUDIO_CACHE_DIR", "audio_cache"),
+                       max_bytes=int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(200 * 1024 * 1024))))
+    return AudioRenderer(engine, cache, workers=int(os.getenv("AUDIO_WORKERS", "2")),
+                         max_chars=int(os.getenv("AUDIO_CHUNK_CHARS", "240")))
@@ -0,0 +1,322 @@
+# story_batch.py
+"""
+Bulk story generation from a JSONL file of themes (classroom packs, newsletters).
+
+Each input line is {"theme": "...", "id": "...", "name": "..."} (id and name are
+optional; the id defaults to the line number) or a bare JSON string theme. Items
+skip the intent router and the session store and go straight through
+story_engine.generate_story on a worker pool. Every upstream call of the job is
+drawn from one requests-per-minute bucket on top of the gateway's model budgets,
+so a big job leaves room for interactive traffic.
+
+Results are appended to the output JSONL as they finish (so not in input order):
+{"id", "theme", "status": "story" | "refusal" | "error", "story", "suggestions",
+"error", "ms"}. The output doubles as the checkpoint: running the same job again
+skips every id already written with a story or a refusal and retries the errors.
+
+    python story_batch.py themes.jsonl stories.jsonl --workers 8 --rpm 300
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process guard against two runners on one output
+    fcntl = None
+
+from llm_gateway import _TokenBucket, rate_limit
+from story_engine import REFUSAL, generate_story
+import metrics
+
+FINISHED = ("story", "refusal")
+
+
+class BatchBusyError(RuntimeError):
+    """Raised when another runner holds the output file of the job."""
+
+
+def read_items(path: str) -> Iterator[Dict[str, Any]]:
+    """Input items with `id` and `theme` set; raises ValueError on a malformed line."""
+    with open(path, "r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{lineno}: not JSON: {e}") from None
+            if isinstance(item, str):
+                item = {"theme": item}
+            if not isinstance(item, dict) or not str(item.get("theme") or "").strip():
+                raise ValueError(f"{path}:{lineno}: expected a theme string or an object with a theme")
+            item["id"] = str(item.get("id", lineno))
+            yield item
+
+
+def finished_ids(path: str) -> Set[str]:
+    """Ids already written to `path` with a story or a refusal."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # torn last line
+            if result.get("status") in FINISHED:
+                done.add(str(result.get("id")))
+    return done
+
+def _trim_torn_line(path: str):
+    """Cuts off a partial last line (the previous run died mid-write)."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+
+class BatchJob:
+    """
+    One batch run from `input_path` to `output_path`. run() blocks until every
+    pending item is written; stats() can be read from other threads meanwhile.
+    """
+
+    def __init__(self, input_path: str, output_path: str, workers: int = 4, rpm: float = 0.0):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.workers = max(1, workers)
+        self.bucket = _TokenBucket(rpm, burst=max(1.0, workers)) if rpm else None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._counts = {"total": 0, "skipped": 0, "story": 0, "refusal": 0, "error": 0}
+        self.state = "pending"
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def cancel(self):
+        """Stops taking new items; the ones in flight are still written."""
+        self._stop.set()
+
+    def run(self) -> Dict[str, Any]:
+        self.started = time.time()
+        self.state = "running"
+        try:
+            with open(self.output_path + ".lock", "a+") as lock:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        raise BatchBusyError(f"{self.output_path} is being written by another batch runner") from None
+                self._run()
+            self.state = "cancelled" if self._stop.is_set() else "done"
+        except BaseException as e:
+            self.state, self.error = "failed", str(e)
+            raise
+        finally:
+            self.finished = time.time()
+        return self.stats()
+
+    def _run(self):
+        _trim_torn_line(self.output_path)
+        done = finished_ids(self.output_path)
+        # At most two items per worker are queued, so a 10k-theme file is streamed, not loaded.
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        seen: Set[str] = set()
+        with open(self.output_path, "a", encoding="utf-8") as out:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="story-batch") as pool:
+                for item in read_items(self.input_path):
+                    if item["id"] in seen:
+                        continue
+                    seen.add(item["id"])
+                    if self._stop.is_set():
+                        break
+                    with self._lock:
+                        self._counts["total"] += 1
+                        if item["id"] in done:
+                            self._counts["skipped"] += 1
+                            continue
+                    slots.acquire()
+                    pool.submit(self._process, item, out, slots)
+            out.flush()
+            os.fsync(out.fileno())
+
+    def _process(self, item: Dict[str, Any], out, slots: threading.BoundedSemaphore):
+        try:
+            if not self._stop.is_set():  # queued items of a cancelled job are left for the next run
+                self._write(out, self._generate(item))
+        finally:
+            slots.release()
+
+    def _generate(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"id": item["id"], "theme": item["theme"]}
+        t0 = time.perf_counter()
+        try:
+            with rate_limit(self.bucket):
+                story, suggestions = generate_story(item["theme"], item.get("name"), key=f"batch:{item['id']}")
+            if story == REFUSAL:
+                result["status"] = "refusal"
+            else:
+                result.update(status="story", story=story, suggestions=suggestions)
+        except Exception as e:
+            result.update(status="error", error=str(e))
+        result["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return result
+
+    def _write(self, out, result: Dict[str, Any]):
+        line = json.dumps(result, ensure_ascii=False) + "\n"
+        with self._lock:
+            out.write(line)
+            out.flush()
+            self._counts[result["status"]] += 1
+        metrics.BATCH_ITEMS.inc(result["status"])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._counts, state=self.state)
+        if self.error:
+            out["failure"] = self.error
+        written = out["story"] + out["refusal"] + out["error"]
+        if self.started:
+            elapsed = (self.finished or time.time()) - self.started
+            out["elapsed_seconds"] = round(elapsed, 1)
+            out["items_per_minute"] = round(written * 60 / elapsed, 1) if elapsed else 0.0
+        return out
+
+
+# ============================================================
+# SERVER JOBS (/batch)
+# ============================================================
+# A job's id is a hash of its input, so posting the same file again resumes it.
+BATCH_DIR = os.getenv("BATCH_DIR", "batch_jobs")
+_JOB_ID = re.compile(r"[0-9a-f]{16}")
+_jobs: Dict[str, BatchJob] = {}
+_jobs_lock = threading.Lock()
+
+def _job_paths(job_id: str) -> Tuple[str, str]:
+    directory = os.path.join(BATCH_DIR, job_id)
+    return os.path.join(directory, "input.jsonl"), os.path.join(directory, "output.jsonl")
+
+def start_job(data: bytes) -> Tuple[str, Dict[str, Any]]:
+    """
+    Stores the JSONL `data` and runs it in the background (resuming an earlier run
+    of the same input). Returns (job id, stats); ValueError for malformed input.
+    """
+    job_id = hashlib.sha256(data).hexdigest()[:16]
+    input_path, output_path = _job_paths(job_id)
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None and job.state == "running":
+            return job_id, job.stats()
+        if not os.path.exists(input_path):
+            os.makedirs(os.path.dirname(input_path), exist_ok=True)
+            tmp = input_path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            try:
+                sum(1 for _ in read_items(tmp))
+            except ValueError as e:
+                os.remove(tmp)
+                raise ValueError(str(e).replace(tmp + ":", "line ", 1)) from None
+            os.replace(tmp, input_path)
+        job = _jobs[job_id] = BatchJob(input_path, output_path,
+                                       workers=int(os.getenv("BATCH_WORKERS", "4")),
+                                       rpm=float(os.getenv("BATCH_RPM", "0")))
+        job.state = "running"  # before the thread starts, so a second post sees it
+    threading.Thread(target=_run_job, args=(job,), name=f"story-batch-{job_id}", daemon=True).start()
+    return job_id, job.stats()
+
+def _run_job(job: BatchJob):
+    try:
+        job.run()
+    except Exception as e:
+        print(f"Batch job {job.output_path} failed: {e}")
+
+def job_stats(job_id: str) -> Optional[Dict[str, Any]]:
+    """Stats of a job run by this process, or what its output shows; None if unknown."""
+    if not _JOB_ID.fullmatch(job_id):
+        return None
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is not None:
+        return job.stats()
+    input_path, output_path = _job_paths(job_id)
+    if not os.path.exists(input_path):
+        return None
+    # Not running here (finished in another worker, or interrupted by a restart).
+    finished = len(finished_ids(output_path))
+    total = len({item["id"] for item in read_items(input_path)})
+    return {"state": "done" if finished >= total else "stopped", "total": total, "finished": finished}
+
+def follow_results(job_id: str, poll: float = 0.5) -> Optional[Iterator[bytes]]:
+    """The job's result lines, then new ones as they are written until it stops running."""
+    if job_stats(job_id) is None:
+        return None
+    _, output_path = _job_paths(job_id)
+
+    def lines() -> Iterator[bytes]:
+        pos = 0
+        while True:
+            with _jobs_lock:
+                job = _jobs.get(job_id)
+            running = job is not None and job.state == "running"
+            if os.path.exists(output_path):
+                with open(output_path, "rb") as f:
+                    f.seek(pos)
+                    chunk = f.read()
+                end = chunk.rfind(b"\n") + 1  # only whole lines
+                if end:
+                    pos += end
+                    yield chunk[:end]
+            if not running:
+                return
+            time.sleep(poll)
+    return lines()
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("input", help="JSONL file of themes")
+    ap.add_argument("output", help="JSONL results file (also the checkpoint; appended to)")
+    ap.add_argument("--workers", type=int, default=int(os.getenv("BATCH_WORKERS", "4")))
+    ap.add_argument("--rpm", type=float, default=float(os.getenv("BATCH_RPM", "0")),
+                    help="upstream LLM requests per minute for the whole job (0 = gateway limits only)")
+    ap.add_argument("--progress", type=float, default=10.0, help="seconds between progress lines")
+    args = ap.parse_args()
+
+    job = BatchJob(args.input, args.output, workers=args.workers, rpm=args.rpm)
+
+    finished = threading.Event()
+
+    def work():
+        try:
+            job.run()
+        except Exception as e:
+            print(f"Batch job failed: {e}", file=sys.stderr)
+        finally:
+            finished.set()
+
+    # The job runs in a thread so Ctrl-C can stop it between items.
+    threading.Thread(target=work, daemon=True).start()
+    try:
+        while not finished.wait(args.progress):
+            print(json.dumps(job.stats()), file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Stopping after the items in flight; run again to resume.", file=sys.stderr)
+        job.cancel()
+        finished.wait()
+    print(json.dumps(job.stats()), file=sys.stderr)
+    sys.exit(0 if job.state in ("done", "cancelled") else 1)
@@ -1,57 +1,344 @@
 # story_engine.py
+"""
+Story pipeline: intent routing, story drafting, judging and rewriting, session memory.
+
+Importing this module only reads the configuration. The session store, the LLM
+clients, the LLM cache and gateway, the story pool and the audio renderer live in
+an AppContext and are built on first use (or by warm_up()), and LangChain is only
+imported when a caller asks for message objects. Configuration problems do not
+break the import: they are listed by config_errors() and raised as ConfigError
+when the first resource is built.
+"""
 import os
 import json
 import re
-from typing import Optional, List, Dict, Any, Tuple
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from typing import Optional, List, Dict, Any, Tuple, Callable, Iterator, Sequence
 from dotenv import load_dotenv
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import AIMessage, HumanMessage, BaseMessage
 # NOTE: memory_store.py must contain the JsonMessageHistoryStore class
-from memory_store import JsonMessageHistoryStore 
+from memory_store import (JsonMessageHistoryStore, SqliteMessageHistoryStore, RedisMessageHistoryStore,
+                          ShardedMessageHistoryStore, CachedMessageHistoryStore, SessionMaintenance,
+                          STORY_TAG, story_text)
+from intent_router import LocalIntentRouter, DEFAULT_MODEL_PATH
+from llm_cache import cache_from_env, make_key
+from llm_gateway import deadline, gateway_from_env
+from llm_backends import ChatModel, make_chat_model
+from safety_screen import screen
+from story_pool import personalize, pool_from_env
+from story_audio import AudioRenderer, audio_from_env
+import metrics
 
 # ============================================================
 # ENV + LANGSMITH
 # ============================================================
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GOOGLE_API_KEY:
-    raise ValueError("GEMINI_API_KEY not set in .env")
+class ConfigError(ValueError):
+    """Invalid engine configuration; raised on first use rather than at import."""
+
+_CONFIG_ERRORS: List[str] = []
+
+def _env_number(name: str, default: float, kind: Callable[[str], Any] = float) -> Any:
+    """Numeric setting; an unparsable value is recorded as a config error and the default used."""
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return kind(raw)
+    except ValueError:
+        _CONFIG_ERRORS.append(f"{name}={raw!r} is not a valid {kind.__name__}")
+        return default
+
+def _env_choice(name: str, default: str, choices: Sequence[str]) -> str:
+    value = os.getenv(name, default).lower()
+    if value not in choices:
+        expected = ", ".join(choices[:-1]) + " or " + choices[-1]
+        _CONFIG_ERRORS.append(f"unknown {name}: {value!r} (expected {expected})")
+    return value
+
+def config_errors() -> List[str]:
+    """Configuration problems found at import (empty when the settings are valid)."""
+    return list(_CONFIG_ERRORS)
+
+# "gemini" (default), "http" (LLM_BASE_URL, e.g. fake_llm_server.py) or "fake" (in-process,
+# deterministic). The Gemini key is only checked on the first LLM call.
+LLM_BACKEND = _env_choice("LLM_BACKEND", "http" if os.getenv("LLM_BASE_URL") else "gemini",
+                          ("gemini", "http", "fake"))
 
 LANGSMITH_ENABLED = os.getenv("LANGSMITH_TRACING", "").lower() == "true"
 
 # ============================================================
 # MEMORY
 # ============================================================
-MEMORY_PATH = os.getenv("MEMORY_DB_PATH", "sessions.json")
-_store = JsonMessageHistoryStore(MEMORY_PATH)
+# "sqlite" (default) keeps one row per message; "redis" (MEMORY_REDIS_URL) shares the
+# sessions between app nodes; "json" is the legacy whole-file store.
+MEMORY_BACKEND = _env_choice("MEMORY_BACKEND", "sqlite", ("sqlite", "redis", "json"))
+MEMORY_PATH = os.getenv("MEMORY_DB_PATH", "sessions.db")
+# Legacy sessions.json imported once into the SQLite store on first start.
+LEGACY_MEMORY_PATH = os.getenv("MEMORY_JSON_PATH", "sessions.json")
+# Messages kept in hot storage per session; older turns go to the compressed archive.
+# 0 disables windowing.
+HISTORY_HOT_WINDOW = _env_number("HISTORY_HOT_WINDOW", 40, int)
+# Comma-separated: one shard per server.
+MEMORY_REDIS_URLS = [u.strip() for u in os.getenv("MEMORY_REDIS_URL", "redis://127.0.0.1:6379/0").split(",")
+                     if u.strip()]
+# SQLite: spread sessions over sessions-0.db ... sessions-<N-1>.db by a hash of the
+# session id. Changing the count of an existing deployment needs a re-shard.
+MEMORY_SHARDS = _env_number("MEMORY_SHARDS", 1, int)
+# Sessions not written for this long are deleted (0 = keep forever).
+SESSION_TTL_SECONDS = _env_number("SESSION_TTL_SECONDS", 0.0)
+# In-process LRU of hot sessions (0 = off). Entries are checked against the store's
+# session version on every read unless checked in the last SESSION_CACHE_MAX_AGE_SECONDS.
+SESSION_CACHE_SIZE = _env_number("SESSION_CACHE_SIZE", 1000, int)
+SESSION_CACHE_MAX_AGE_SECONDS = _env_number("SESSION_CACHE_MAX_AGE_SECONDS", 0.0)
+# Background expiry every SESSION_MAINTENANCE_SECONDS (0 = off); compaction and
+# VACUUM every SESSION_COMPACT_SECONDS.
+SESSION_MAINTENANCE_SECONDS = _env_number("SESSION_MAINTENANCE_SECONDS", 60.0)
+SESSION_COMPACT_SECONDS = _env_number("SESSION_COMPACT_SECONDS", 3600.0)
 
-# --- Helper Functions for Message Conversion ---
-def _msg_to_dict(m: BaseMessage) -> Dict[str, str]:
-    """Converts a LangChain message object to a simple dictionary for storage."""
-    role = "human" if isinstance(m, HumanMessage) else "ai"
-    return {"role": role, "content": m.content}
+if MEMORY_BACKEND != "json" and MEMORY_PATH.endswith(".json"):
+    # Older .env files point MEMORY_DB_PATH at sessions.json: migrate it next door.
+    LEGACY_MEMORY_PATH = MEMORY_PATH
+    MEMORY_PATH = os.path.splitext(MEMORY_PATH)[0] + ".db"
+if MEMORY_SHARDS < 1 or (MEMORY_SHARDS > 1 and MEMORY_BACKEND != "sqlite"):
+    _CONFIG_ERRORS.append(f"MEMORY_SHARDS={MEMORY_SHARDS} needs MEMORY_BACKEND=sqlite and a count of at least 1 "
+                          "(Redis is sharded by listing several MEMORY_REDIS_URL servers)")
+
+_maintenance: Optional[SessionMaintenance] = None
+_session_cache: Optional[CachedMessageHistoryStore] = None
+
+def _open_backend():
+    if MEMORY_BACKEND == "redis":
+        shards = [RedisMessageHistoryStore(url, hot_window=HISTORY_HOT_WINDOW, ttl=SESSION_TTL_SECONDS)
+                  for url in MEMORY_REDIS_URLS]
+    elif MEMORY_SHARDS == 1:
+        # A single file keeps the pre-sharding name and imports the legacy JSON store.
+        return SqliteMessageHistoryStore(MEMORY_PATH, legacy_json_path=LEGACY_MEMORY_PATH,
+                                         hot_window=HISTORY_HOT_WINDOW, ttl=SESSION_TTL_SECONDS)
+    else:
+        base, ext = os.path.splitext(MEMORY_PATH)
+        shards = [SqliteMessageHistoryStore(f"{base}-{i}{ext}", hot_window=HISTORY_HOT_WINDOW,
+                                            ttl=SESSION_TTL_SECONDS)
+                  for i in range(MEMORY_SHARDS)]
+    return shards[0] if len(shards) == 1 else ShardedMessageHistoryStore(shards)
+
+def _open_store():
+    global _maintenance, _session_cache
+    if MEMORY_BACKEND == "json":
+        store = JsonMessageHistoryStore(MEMORY_PATH, hot_window=HISTORY_HOT_WINDOW)
+    else:
+        store = _open_backend()
+        if SESSION_MAINTENANCE_SECONDS > 0:
+            _maintenance = SessionMaintenance(store, SESSION_MAINTENANCE_SECONDS, SESSION_COMPACT_SECONDS).start()
+        if SESSION_CACHE_SIZE > 0:
+            store = _session_cache = CachedMessageHistoryStore(store, SESSION_CACHE_SIZE,
+                                                               SESSION_CACHE_MAX_AGE_SECONDS)
+    # Every store call is timed (story_store_op_seconds, per-request spans).
+    return metrics.InstrumentedStore(store)
+
+def store_stats() -> Dict[str, Any]:
+    """Session store settings, hot-session cache hits and maintenance totals."""
+    shards = len(MEMORY_REDIS_URLS) if MEMORY_BACKEND == "redis" else MEMORY_SHARDS
+    return {
+        "backend": MEMORY_BACKEND,
+        "shards": 1 if MEMORY_BACKEND == "json" else shards,
+        "ttl_seconds": SESSION_TTL_SECONDS,
+        "cache": _session_cache.stats() if _session_cache else None,
+        "maintenance": dict(_maintenance.totals) if _maintenance else None,
+    }
 
-def _dict_to_msg(m: Dict[str, str]) -> BaseMessage:
+def _store_metrics() -> List[str]:
+    cache = _session_cache.stats() if _session_cache else {}
+    totals = _maintenance.totals if _maintenance else {}
+    return (
+        metrics.counter_lines("story_session_cache_lookups_total", "Hot-session cache lookups by outcome.",
+                              ("outcome",), {("hit",): cache["hits"], ("miss",): cache["misses"]} if cache else {})
+        + metrics.counter_lines("story_session_maintenance_total", "Sessions expired and compacted, VACUUMs run.",
+                                ("event",), {(k,): totals[k] for k in ("expired", "compacted", "vacuumed", "errors")}
+                                if totals else {})
+    )
+
+metrics.add_collector(_store_metrics)
+
+# --- Helper Functions for Message Conversion ---
+def _dict_to_msg(m: Dict[str, str]):
     """Converts a simple dictionary from storage back to a LangChain message object."""
+    from langchain_core.messages import AIMessage, HumanMessage  # heavy; only callers of this pay for it
     return HumanMessage(content=m["content"]) if m["role"] == "human" \
         else AIMessage(content=m["content"])
 
-def _get_history(session_id: str) -> List[BaseMessage]:
-    """Retrieves the history for a session."""
-    return [_dict_to_msg(m) for m in _store.get_history(session_id)]
+def _get_history(session_id: str) -> list:
+    """Retrieves the history for a session (LangChain messages)."""
+    return [_dict_to_msg(m) for m in _app.store.get_history(session_id)]
+
+# ============================================================
+# SESSION SUMMARY (name, favourite themes, past story titles)
+# ============================================================
+# Caps keep the summary a small fixed-size record no matter how long the session runs.
+SUMMARY_MAX_THEMES = 10
+SUMMARY_MAX_TITLES = 20
+
+_NAME_PATTERNS = [
+    re.compile(r"\b(?:my name is|my name's|call me)\s+([A-Za-z][A-Za-z'-]{1,30})", re.IGNORECASE),
+    # Without an explicit "name" we only trust capitalized words ("I'm Mia", not "I'm tired").
+    re.compile(r"\b(?:I'm|I am|this is)\s+([A-Z][a-z'-]{1,30})\b"),
+]
+_THEME_STOPWORDS = {
+    "story", "stories", "about", "tell", "write", "make", "please", "bedtime", "with",
+    "that", "this", "there", "their", "they", "what", "who", "which", "where", "when",
+    "some", "another", "other", "again", "into", "from", "have", "like", "want", "would",
+    "could", "very", "little", "named", "called", "and", "the", "for",
+}
+_THEME_WORD = re.compile(r"[a-z]{4,}")
+
+def _detect_name(text: str) -> Optional[str]:
+    for pattern in _NAME_PATTERNS:
+        m = pattern.search(text)
+        if m:
+            return m.group(1).capitalize()
+    return None
+
+def _theme_words(req: str) -> List[str]:
+    return [w for w in _THEME_WORD.findall(req.lower()) if w not in _THEME_STOPWORDS]
+
+def _story_title(story: str) -> str:
+    """First sentence (or line) of the story, capped at 60 characters."""
+    first = re.split(r"(?<=[.!?])\s|\n", story.strip(), maxsplit=1)[0].strip()
+    return first if len(first) <= 60 else first[:57].rstrip() + "..."
+
+def _merge_summary(summary: Dict[str, Any], name: Optional[str] = None,
+                   theme: Optional[str] = None, story: Optional[str] = None) -> Dict[str, Any]:
+    out = dict(summary)
+    if name:
+        out["name"] = name
+    if theme:
+        counts = dict(out.get("themes", {}))
+        for word in _theme_words(theme):
+            counts[word] = counts.get(word, 0) + 1
+        top = sorted(counts.items(), key=lambda kv: -kv[1])[:SUMMARY_MAX_THEMES]
+        out["themes"] = dict(top)
+    if story:
+        out["story_titles"] = (out.get("story_titles", []) + [_story_title(story)])[-SUMMARY_MAX_TITLES:]
+    return out
+
+# ============================================================
+# SESSION CONTEXT (per-turn unit of work)
+# ============================================================
+class SessionContext:
+    """
+    Unit of work over one session's history for a single turn.
+
+    The current story comes from the store's story pointer (one small read, the
+    message list is never scanned), the full history is only read if someone asks
+    for `messages`, and all new messages are written back in one flush().
+    `messages` is the store's hot window, not the whole archived session; the
+    session summary is the compact record to use for personalization.
+    `reads` / `writes` count the store round trips made through this context.
+    """
+
+    def __init__(self, session_id: str, store=None):
+        self.session_id = session_id
+        self._store = store if store is not None else _app.store
+        self.reads = 0
+        self.writes = 0
+        self._loaded: Optional[List[Dict[str, str]]] = None
+        self._pending: List[Dict[str, str]] = []
+        self._story: Optional[str] = None
+        self._story_known = False
+        self._summary: Optional[Dict[str, Any]] = None
+        self._summary_updates: List[Dict[str, Optional[str]]] = []
+        # Set by remember(), cleared by flush(): summary() merges (and drains) the
+        # queued updates, so the queue alone cannot tell whether a write is due.
+        self._summary_dirty = False
+        # The async pipeline reads the summary in worker threads while the event
+        # loop queues updates.
+        self._summary_lock = threading.Lock()
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        """The session history including not-yet-flushed messages."""
+        if self._loaded is None:
+            self._loaded = list(self._store.get_history(self.session_id))
+            self.reads += 1
+        return self._loaded + self._pending
 
-def _save_history(session_id: str, messages: List[BaseMessage]):
-    """Saves the history for a session."""
-    _store.set_history(session_id, [_msg_to_dict(m) for m in messages])
+    def last_story(self) -> Optional[str]:
+        """Text of the most recent final story, or None."""
+        if not self._story_known:
+            self._story = self._store.get_current_story(self.session_id)
+            self._story_known = True
+            self.reads += 1
+        return self._story
+
+    def summary(self) -> Dict[str, Any]:
+        """The session summary ({"name", "themes", "story_titles"}), including queued updates."""
+        if self._summary is None:
+            loaded = self._store.get_summary(self.session_id)
+            with self._summary_lock:
+                if self._summary is None:
+                    self._summary = loaded
+                    self.reads += 1
+        with self._summary_lock:
+            while self._summary_updates:
+                self._summary = _merge_summary(self._summary, **self._summary_updates.pop(0))
+            return self._summary
+
+    def remember(self, name: Optional[str] = None, theme: Optional[str] = None,
+                 story: Optional[str] = None):
+        """Queues a summary update; it is merged and written on the next flush()."""
+        with self._summary_lock:
+            self._summary_updates.append({"name": name, "theme": theme, "story": story})
+            self._summary_dirty = True
+
+    def append(self, role: str, content: str):
+        """Queues a message; it is written on the next flush()."""
+        self._pending.append({"role": role, "content": content})
+        if role == "ai" and content.startswith(STORY_TAG):
+            self._story = story_text(content)
+            self._story_known = True
+        elif role == "human":
+            name = _detect_name(content)
+            if name:
+                self.remember(name=name)
+
+    def save_story(self, story: str):
+        """
+        Queues a new approved story. Refinements are saved the same way: each one
+        becomes a new version in the store instead of overwriting the old message.
+        """
+        self.append("ai", f"{STORY_TAG}\n{story}")
+
+    def flush(self):
+        """
+        Writes queued messages in a single store call (no-op when nothing changed).
+        Writes are append-only, so turns running concurrently on the same session
+        never overwrite each other's messages.
+        """
+        with self._summary_lock:
+            dirty, self._summary_dirty = self._summary_dirty, False
+        summary = self.summary() if dirty else None
+        if not self._pending and summary is None:
+            return
+        try:
+            self._store.apply_changes(self.session_id, self._pending, summary=summary)
+        except BaseException:
+            self._summary_dirty = self._summary_dirty or dirty
+            raise
+        self.writes += 1
+        if self._loaded is not None:
+            self._loaded.extend(self._pending)
+        self._pending = []
 
 def get_last_story(session_id: str) -> Optional[str]:
     """Retrieves the most recently saved final story text."""
-    for msg in reversed(_get_history(session_id)):
-        if isinstance(msg, AIMessage) and msg.content.startswith("[FINAL STORY]"):
-            return msg.content.replace("[FINAL STORY]", "").strip()
-    return None
+    return SessionContext(session_id).last_story()
 
 def _has_story(session_id: str) -> bool:
     """Checks if a final story exists in the session history."""
@@ -60,23 +347,183 @@ def _has_story(session_id: str) -> bool:
 # ============================================================
 # LLMs — Gemini Flash 2.5 (FAST)
 # ============================================================
-def _llm(temp: float = 0.6) -> ChatGoogleGenerativeAI:
-    """Factory function for creating ChatGoogleGenerativeAI instances."""
-    return ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        google_api_key=GOOGLE_API_KEY,
-        temperature=temp
+def _llm(temp: float = 0.6) -> ChatModel:
+    """Factory function for creating chat models on the configured LLM_BACKEND."""
+    return make_chat_model(LLM_BACKEND, "gemini-2.5-flash", temp)
+
+# The three clients (story 0.65 creative, judge 0.0 strict, chat 0.4 balanced) are
+# built by AppContext on first use.
+
+# ============================================================
+# LLM CACHE
+# ============================================================
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+# run_names served from the cache. Drafts, rewrites and chat replies stay live by
+# default so asking twice gives a fresh story; add them here to cache them too.
+LLM_CACHE_ROUTES = {
+    r.strip()
+    for r in os.getenv("LLM_CACHE_ROUTES", "intent_classifier_tool,judge,refine_judge,instruction_judge").split(",")
+    if r.strip()
+}
+# The story judge passes share one verdict per text.
+_JUDGE_ROUTES = {"judge", "refine_judge"}
+
+def _cache_key(llm: ChatModel, prompt: str, run_name: str,
+               cache_text: Optional[str] = None) -> Optional[str]:
+    """Cache key for a call, or None when `run_name` bypasses the cache."""
+    if not LLM_CACHE_ENABLED or run_name not in LLM_CACHE_ROUTES:
+        return None
+    kind = run_name
+    if run_name in _JUDGE_ROUTES:
+        kind = _JUDGE_CACHE_KIND
+    elif run_name == "instruction_judge":
+        kind = _INSTRUCTION_JUDGE_CACHE_KIND
+    return make_key(kind, getattr(llm, "model", ""), getattr(llm, "temperature", None) or 0.0,
+                    prompt if cache_text is None else cache_text)
+
+def cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters of the LLM cache, per prompt kind."""
+    return _app.llm_cache.stats()
+
+# ============================================================
+# LLM GATEWAY (budgets, retries, deadlines, hedging)
+# ============================================================
+# Wall-clock budget for all LLM calls of one turn; 0 disables it.
+LLM_TURN_DEADLINE_SECONDS = _env_number("LLM_TURN_DEADLINE_SECONDS", 60.0)
+# The router call is small and on every turn's critical path: hedge it when slow.
+LLM_HEDGE_AFTER_SECONDS = _env_number("LLM_HEDGE_AFTER_SECONDS", 1.5)
+_HEDGED_ROUTES = {"intent_classifier_tool"}
+
+def _hedge_after(run_name: str) -> Optional[float]:
+    return LLM_HEDGE_AFTER_SECONDS if run_name in _HEDGED_ROUTES and LLM_HEDGE_AFTER_SECONDS > 0 else None
+
+def gateway_stats() -> Dict[str, Any]:
+    """Per-model call / retry / hedge / throttle counters of the LLM gateway."""
+    return _app.gateway.stats()
+
+def _invoke(llm: ChatModel, prompt: str, run_name: str = "run",
+            cache_text: Optional[str] = None) -> str:
+    """
+    Invokes the LLM through the gateway with optional LangSmith tracing.
+    Routes listed in LLM_CACHE_ROUTES are answered from the cache when possible;
+    `cache_text` overrides what is hashed for the key (e.g. just the story for the judge).
+    Time, sizes and token usage are recorded under `run_name` as the stage.
+    """
+    with metrics.llm_call(run_name, prompt) as call:
+        key = _cache_key(llm, prompt, run_name, cache_text)
+        if key is not None:
+            cached = _app.llm_cache.get(key)
+            if cached is not None:
+                call.cache_hit(cached)
+                return cached
+
+        cfg = {"run_name": run_name} if LANGSMITH_ENABLED else {}
+        reply = _app.gateway.invoke(llm, prompt, cfg, hedge_after=_hedge_after(run_name))
+        call.response(reply.content, getattr(reply, "usage_metadata", None))
+
+    if key is not None:
+        _app.llm_cache.put(key, reply.content)
+    return reply.content
+
+def _engine_metrics() -> List[str]:
+    """LLM cache and gateway counters in the /metrics exposition (empty until they are built)."""
+    llm_cache, gateway_ = _app.peek("llm_cache"), _app.peek("gateway")
+    cache = {(kind, outcome): c[outcome] for kind, c in (llm_cache.stats() if llm_cache else {}).items()
+             if isinstance(c, dict) for outcome in ("hits", "disk_hits", "misses")}
+    gateway = gateway_.stats() if gateway_ else {}
+    events = {(model, event): v for model, c in gateway.items() for event, v in c.items() if event != "in_flight"}
+    return (
+        metrics.counter_lines("story_llm_cache_lookups_total", "LLM cache lookups by outcome.",
+                              ("kind", "outcome"), cache)
+        + metrics.counter_lines("story_llm_gateway_events_total", "LLM gateway calls, retries, hedges...",
+                                ("model", "event"), events)
+        + metrics.counter_lines("story_llm_gateway_in_flight", "Upstream LLM calls in flight.", ("model",),
+                                {(m,): c["in_flight"] for m, c in gateway.items()}, kind="gauge")
     )
 
-_story_llm = _llm(0.65)   # Creative (for story writing/rewriting)
-_judge_llm = _llm(0.0)    # Strict (for safety/JSON/Intent Classification)
-_chat_llm  = _llm(0.4)    # Balanced (for short chat replies)
+metrics.add_collector(_engine_metrics)
+
+# ============================================================
+# APPLICATION CONTEXT (process-wide resources, built on first use)
+# ============================================================
+class AppContext:
+    """
+    The engine's shared resources. Reading `store`, `story_llm`, `judge_llm`,
+    `chat_llm`, `llm_cache`, `gateway`, `story_pool`, `audio` or `verify_pool` builds it once
+    (thread-safe); after that it is a plain attribute, so it costs nothing per call
+    and can be replaced, e.g. to wrap the store in a benchmark.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name: str):
+        build = getattr(type(self), f"_build_{name}", None)
+        if build is None:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        with self._lock:
+            if name not in self.__dict__:
+                if _CONFIG_ERRORS:
+                    raise ConfigError("; ".join(_CONFIG_ERRORS))
+                self.__dict__[name] = build(self)
+        return self.__dict__[name]
+
+    def peek(self, name: str) -> Any:
+        """The resource if it has been built, else None (never builds it)."""
+        return self.__dict__.get(name)
+
+    def _build_store(self):
+        return _open_store()
+
+    def _build_story_llm(self) -> ChatModel:
+        return _llm(0.65)   # Creative (for story writing/rewriting)
+
+    def _build_judge_llm(self) -> ChatModel:
+        return _llm(0.0)    # Strict (for safety/JSON/Intent Classification)
+
+    def _build_chat_llm(self) -> ChatModel:
+        return _llm(0.4)    # Balanced (for short chat replies)
 
-def _invoke(llm: ChatGoogleGenerativeAI, prompt: str, run_name: str = "run") -> str:
-    """Invokes the LLM with optional LangSmith tracing."""
-    cfg = {"run_name": run_name} if LANGSMITH_ENABLED else {}
-    res = llm.invoke(prompt, config=cfg)
-    return res.content
+    def _build_llm_cache(self):
+        return cache_from_env()
+
+    def _build_gateway(self):
+        return gateway_from_env()
+
+    def _build_story_pool(self):
+        pool = pool_from_env(_pool_story, idle=_upstream_idle)
+        if STORY_POOL_ENABLED:
+            pool.start()
+        return pool
+
+    def _build_audio(self) -> Optional[AudioRenderer]:
+        return audio_from_env() if AUDIO_ENABLED else None
+
+    def _build_verify_pool(self) -> ThreadPoolExecutor:
+        # Runs the independent judge next to the rewrite in self_judge mode.
+        return ThreadPoolExecutor(max_workers=32, thread_name_prefix="story-verify")
+
+
+_app = AppContext()
+
+def app_context() -> AppContext:
+    return _app
+
+def warm_up():
+    """Builds every resource now (e.g. in a background thread at server start)."""
+    for name in ("store", "story_llm", "judge_llm", "chat_llm", "llm_cache", "gateway", "story_pool", "audio",
+                 "verify_pool"):
+        getattr(_app, name)
+
+# Module attributes kept for callers of the old globals (story_engine._store etc.).
+_LEGACY_NAMES = {"_store": "store", "_story_llm": "story_llm", "_judge_llm": "judge_llm",
+                 "_chat_llm": "chat_llm", "_llm_cache": "llm_cache", "_gateway": "gateway",
+                 "_story_pool": "story_pool", "_audio": "audio", "_VERIFY_POOL": "verify_pool"}
+
+def __getattr__(name: str):
+    if name in _LEGACY_NAMES:
+        return getattr(_app, _LEGACY_NAMES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ============================================================
 # JSON SAFETY (J2)
@@ -115,12 +562,18 @@ def _safe_json(raw: str) -> Dict[str, Any]:
 # LLM PROMPT TOOLS (The Tool Definitions)
 # ============================================================
 
+def _session_status(has_story: Optional[bool]) -> str:
+    """Session line for the router prompt; None means the history is still loading."""
+    if has_story is None:
+        return "Unknown (a story may be active)."
+    return "A story is active." if has_story else "No story is active."
+
 # Tool 1: Intent Classifier (Replaces hardcoded HINTS)
 INTENT_CLASSIFIER_PROMPT = lambda txt, has_story: f"""
 You are a routing system for a story generator. Your task is to classify the user's request 
 and extract the necessary instruction. Only use the available intents.
 
-Current Session Status: {'A story is active.' if has_story else 'No story is active.'}
+Current Session Status: {_session_status(has_story)}
 Mention Various themes in prompts for all the tools and Dont use hardcoded one use routing .The prompts should very much clear take various possibilites
 
 Possible intents:
@@ -139,13 +592,29 @@ User Request: "{txt}"
 """
 
 # Tool 2: Story Generator (Uses _story_llm) - UPDATED FOR STRICTER REFUSAL OF UNSAFE THEMES
-STORY_PROMPT = lambda req: f"""
+STORY_PROMPT = lambda req, name=None: f"""
 Write a short bedtime story (180–300 words) for kids age 5–10.
 The story must be Warm, positive, and use simple sentences. 
 STRICT RULE: Prohibit ANY content related to violence, fear, danger, sadness, death, or loss. 
 If the requested Theme/Topic: "{req}" contains an element that cannot be made 100% positive (e.g., 'murder,' 'fight,' 'tragedy'), **you must ignore that unsafe element entirely** and write a simple, safe story about a happy, unrelated subject (e.g., sharing a toy or finding a flower).
 Theme/Topic: "{req}"
-End with a gentle moral.
+""" + (f"""The listener's name is {name}; greet them by name in the first line.
+""" if name else "") + """End with a gentle moral.
+"""
+
+# Tool 2b: Story Generator with self-assessment (single-call "self_judge" pipeline)
+SELF_JUDGED_STORY_PROMPT = lambda req, name=None: STORY_PROMPT(req, name) + """
+Self-Assessment: after writing, check your own story against these rules:
+- NO violence, death, injury, loss, grief, fear or sadness that is not immediately resolved.
+- 180-300 words, ending with a moral.
+
+Return JSON ONLY:
+{
+  "story": "<the full story text>",
+  "unsafe": false,
+  "has_moral": true,
+  "hint": "<short improvement suggestion or empty string>"
+}
 """
 
 # Tool 3: Story Evaluator (Uses _judge_llm) - UPDATED FOR EXPLICIT TOOL STRUCTURE AND STRICTER SAFETY
@@ -173,6 +642,27 @@ Return JSON ONLY:
 Story to Evaluate: \"\"\"{s}\"\"\"
 """
 
+# Judge verdicts are cached per story text; hashing the rules invalidates them when JUDGE_PROMPT changes.
+_JUDGE_CACHE_KIND = "judge:" + hashlib.sha256(JUDGE_PROMPT("").encode("utf-8")).hexdigest()[:8]
+
+# Tool 3b: Request Safety Check (only for requests the lexicon pre-screen flags)
+INSTRUCTION_JUDGE_PROMPT = lambda req: f"""
+You are the **Request Safety Check** for a bedtime story generator (children age 5-10).
+Decide whether the user's request, read as a whole, asks for a story about violence, death, injury, abuse, weapons used to hurt someone, or frightening events.
+A word that only sounds dangerous inside a harmless phrase ("killer whale", "stab a strawberry with a fork", "bath bomb") does NOT make a request unsafe.
+Judge the request only, not its length or wording.
+
+Return JSON ONLY:
+{{
+  "unsafe": false
+}}
+
+User Request: \"\"\"{req}\"\"\"
+"""
+
+_INSTRUCTION_JUDGE_CACHE_KIND = "instruction_judge:" + \
+    hashlib.sha256(INSTRUCTION_JUDGE_PROMPT("").encode("utf-8")).hexdigest()[:8]
+
 # Tool 4: Revision Evaluator (Uses _story_llm, acting as a rewrite tool)
 IMPROVE_PROMPT = lambda story, hint: f"""
 Rewrite the ENTIRE story, applying this hint: "{hint}".
@@ -190,24 +680,97 @@ User: "{user}"
 """
 
 REFUSAL = "I can't write that safely for kids, as the theme might involve danger or fear, or an event of significant loss. However, I can offer a gentle, positive version if you want to try a similar topic."
+REFINE_REFUSAL = f"{REFUSAL} I cannot apply that change because it introduces danger, violence, or loss. The current safe story remains unchanged."
+
+# ============================================================
+# LOCAL SAFETY PRE-SCREEN (runs before the LLM tools)
+# ============================================================
+SAFETY_PRESCREEN_ENABLED = os.getenv("SAFETY_PRESCREEN_ENABLED", "true").lower() == "true"
+# Drafts with no lexicon hit at all skip the LLM judge (and so its improvement hint).
+SAFETY_SKIP_JUDGE_ON_CLEAN = os.getenv("SAFETY_SKIP_JUDGE_ON_CLEAN", "").lower() == "true"
+
+def _instruction_needs_judge(text: str) -> bool:
+    """True when the pre-screen finds a HARD term in a user request."""
+    if not SAFETY_PRESCREEN_ENABLED:
+        return False
+    with metrics.stage("safety_prescreen"):
+        return screen(text).unsafe
+
+def _instruction_is_unsafe(text: str) -> bool:
+    """
+    True when a user request asks for unsafe content (refuse before generating).
+    A lexicon hit is only a suspicion ("killer whale", "stabs a strawberry with a
+    fork"), so the short request check (INSTRUCTION_JUDGE_PROMPT) makes the call.
+    """
+    if not _instruction_needs_judge(text):
+        return False
+    return bool(_safe_json(_invoke(_app.judge_llm, INSTRUCTION_JUDGE_PROMPT(text), "instruction_judge",
+                                   cache_text=text)).get("unsafe"))
+
+def _prescreen_verdict(story: str) -> Optional[Dict[str, Any]]:
+    """Judge verdict decided locally, or None when the LLM judge must look at the story."""
+    if not SAFETY_PRESCREEN_ENABLED:
+        return None
+    with metrics.stage("safety_prescreen"):
+        result = screen(story)
+    if result.unsafe:
+        return {"unsafe": True, "hint": ""}
+    if result.clean and SAFETY_SKIP_JUDGE_ON_CLEAN:
+        return {"unsafe": False, "hint": ""}
+    return None
 
 # ============================================================
 # INTENT & CONTEXT EXTRACTION (TOOL-BASED ROUTING)
 # ============================================================
 
+# Local fast-path router: confident predictions skip the Intent Classifier LLM call.
+LOCAL_ROUTER_ENABLED = os.getenv("LOCAL_ROUTER_ENABLED", "true").lower() == "true"
+LOCAL_ROUTER_THRESHOLD = _env_number("LOCAL_ROUTER_THRESHOLD", 0.9)
+_local_router: Optional[LocalIntentRouter] = None
+
+def _get_local_router() -> Optional[LocalIntentRouter]:
+    global _local_router
+    if LOCAL_ROUTER_ENABLED and _local_router is None:
+        _local_router = LocalIntentRouter.load(os.getenv("LOCAL_ROUTER_MODEL", DEFAULT_MODEL_PATH))
+    return _local_router
+
+def fast_path_intent(txt: str, has_story: bool) -> Optional[Tuple[str, str]]:
+    """
+    Classifies `txt` with the local router. Returns (intent, instruction) when the
+    confidence clears LOCAL_ROUTER_THRESHOLD, else None (ask the LLM).
+    The whole message is used as the instruction.
+    """
+    router = _get_local_router()
+    if router is None:
+        return None
+    with metrics.stage("local_router"):
+        intent, confidence = router.classify(txt)
+    if confidence < LOCAL_ROUTER_THRESHOLD:
+        return None
+    if intent == "refine" and not has_story:
+        intent = "new_story"
+    return intent, txt.strip()
+
 def extract_context_and_detect_intent_tool_based(txt: str, has_story: bool) -> Tuple[str, str]:
     """
     Detects intent and extracts the core instruction using the LLM Intent Classification Tool (Tool 1).
+    Obvious messages are answered by the local fast-path router without an LLM call.
     Returns (intent, request/instruction).
     """
+    fast = fast_path_intent(txt, has_story)
+    if fast is not None:
+        return fast
     
     # 1. Invoke the LLM Intent Classification Tool
     raw_json = _invoke(
-        _judge_llm, # Use the strict LLM for reliable JSON output
+        _app.judge_llm, # Use the strict LLM for reliable JSON output
         INTENT_CLASSIFIER_PROMPT(txt, has_story),
         "intent_classifier_tool"
     )
-    
+    return _parse_intent(raw_json, txt, has_story)
+
+def _parse_intent(raw_json: str, txt: str, has_story: bool) -> Tuple[str, str]:
+    """Parses the Intent Classifier output and applies the post-classification rules."""
     # 2. Safely Parse the Output
     parsed_data = _safe_json(raw_json) 
     intent = parsed_data.get("intent", "chat").lower()
@@ -219,138 +782,609 @@ def extract_context_and_detect_intent_tool_based(txt: str, has_story: bool) -> T
         
     return intent, instruction
 
+# ============================================================
+# PIPELINE MODES & REWRITE POLICY
+# ============================================================
+# judge_loop: draft, judge, rewrite (up to three serial calls).
+# self_judge: one call returns the draft with a self-assessment; the judge only verifies.
+# ab:         sessions are split between the two by a stable hash of the session id.
+STORY_PIPELINE = _env_choice("STORY_PIPELINE", "judge_loop", ("judge_loop", "self_judge", "ab"))
+# Share of sessions in self_judge mode when STORY_PIPELINE=ab.
+STORY_PIPELINE_AB_SHARE = _env_number("STORY_PIPELINE_AB_SHARE", 0.5)
+# any: rewrite on any judge hint; violations: only when the story breaks the word-count
+# or moral rule; never: deliver the approved draft as is.
+STORY_REWRITE_POLICY = _env_choice("STORY_REWRITE_POLICY", "any", ("any", "violations", "never"))
+
+STORY_MIN_WORDS, STORY_MAX_WORDS = 180, 300
+_MORAL_WORDS = re.compile(r"\b(moral|lesson|learn(ed|s)?|remember(ed)?|always|never forget)\b", re.IGNORECASE)
+_VIOLATION_HINTS = {
+    "too_short": f"Make it a little longer ({STORY_MIN_WORDS}-{STORY_MAX_WORDS} words).",
+    "too_long": f"Make it a little shorter ({STORY_MIN_WORDS}-{STORY_MAX_WORDS} words).",
+    "moral": "End with a gentle moral.",
+}
+
+def pipeline_mode(session_id: str) -> str:
+    """judge_loop or self_judge for this session (stable across turns in ab mode)."""
+    if STORY_PIPELINE != "ab":
+        return STORY_PIPELINE
+    bucket = int(hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:8], 16) / 16 ** 8
+    return "self_judge" if bucket < STORY_PIPELINE_AB_SHARE else "judge_loop"
+
+def _parse_self_judged(raw: str) -> Dict[str, Any]:
+    """Story and self-assessment from a SELF_JUDGED_STORY_PROMPT reply; plain text counts as the story."""
+    result = {"story": (raw or "").strip(), "unsafe": False, "has_moral": None, "hint": ""}
+    m = re.search(r"\{.*\}", result["story"], flags=re.DOTALL)
+    try:
+        obj = json.loads(m.group(0)) if m else None
+    except ValueError:
+        obj = None
+    if not isinstance(obj, dict) or not str(obj.get("story", "")).strip():
+        return result
+    result["story"] = str(obj["story"]).strip()
+    for key in ("unsafe", "has_moral"):
+        value = obj.get(key)
+        if isinstance(value, str):
+            value = value.lower() == "true"
+        if isinstance(value, bool):
+            result[key] = value
+    result["hint"] = str(obj.get("hint") or "")
+    return result
+
+def _story_violations(story: str, has_moral: Optional[bool] = None) -> List[str]:
+    """Quality rules the story breaks: too_short / too_long (word count) and moral."""
+    violations = []
+    words = len(story.split())
+    if words < STORY_MIN_WORDS:
+        violations.append("too_short")
+    elif words > STORY_MAX_WORDS:
+        violations.append("too_long")
+    if has_moral is None:
+        # No self-assessment: look for a moral in the closing lines.
+        has_moral = bool(_MORAL_WORDS.search(story[-300:]))
+    if not has_moral:
+        violations.append("moral")
+    return violations
+
+def _rewrite_hint(story: str, hint: str, has_moral: Optional[bool] = None) -> str:
+    """The rewrite instruction under STORY_REWRITE_POLICY, or "" to keep the story."""
+    if STORY_REWRITE_POLICY == "never":
+        return ""
+    if STORY_REWRITE_POLICY == "any":
+        return hint
+    fixes = [_VIOLATION_HINTS[v] for v in _story_violations(story, has_moral)]
+    if not fixes:
+        return ""
+    return " ".join(([hint] if hint else []) + fixes)
+
+
+class _PipelineRun:
+    """Outcome of one new-story generation, filled in by the pipeline."""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.outcome = "error"
+        self.rewritten = False
+
+
+@contextmanager
+def _pipeline_run(mode: str) -> Iterator[_PipelineRun]:
+    """Records generation time, upstream LLM calls and rewrites per pipeline mode."""
+    run = _PipelineRun(mode)
+    t0 = time.perf_counter()
+    with metrics.count_llm_calls() as count:
+        try:
+            yield run
+        finally:
+            metrics.PIPELINE_SECONDS.observe(time.perf_counter() - t0, mode, run.outcome)
+            metrics.PIPELINE_LLM_CALLS.inc(mode, amount=count.calls)
+            if run.rewritten:
+                metrics.PIPELINE_REWRITES.inc(mode)
+
+def pipeline_stats() -> Dict[str, Dict[str, float]]:
+    """Per pipeline mode: stories, LLM calls per story, rewrite rate and mean generation time."""
+    runs: Dict[str, List[float]] = {}
+    for (mode, _), (count, seconds) in metrics.PIPELINE_SECONDS.totals().items():
+        totals = runs.setdefault(mode, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+    calls = metrics.PIPELINE_LLM_CALLS.values()
+    rewrites = metrics.PIPELINE_REWRITES.values()
+    return {
+        mode: {
+            "stories": int(n),
+            "llm_calls_per_story": round(calls.get((mode,), 0) / n, 3),
+            "rewrite_rate": round(rewrites.get((mode,), 0) / n, 3),
+            "mean_ms": round(seconds * 1000 / n, 1),
+        }
+        for mode, (n, seconds) in sorted(runs.items()) if n
+    }
+
 # ============================================================
 # STORY PIPELINE FUNCTIONS (LLM Tool Implementations)
 # ============================================================
 
-def generate_with_judge_loop(session_id: str, req: str) -> Tuple[str, List[str]]:
+def _judge_story(story: str, run_name: str = "judge") -> Dict[str, Any]:
     """
-    Implements the story generation, evaluation (Tool 3), and optional revision (Tool 4) loop.
-    Returns (final_story_text, suggestions_applied).
+    Runs the Story Evaluator (Tool 3). Clear lexicon hits are rejected locally first;
+    LLM verdicts are cached per story text.
     """
-    
+    local = _prescreen_verdict(story)
+    if local is not None:
+        return local
+    return _safe_json(_invoke(_app.judge_llm, JUDGE_PROMPT(story), run_name, cache_text=story))
+
+# Optional progress callback threaded through the pipeline (used by streaming).
+StatusCallback = Optional[Callable[[str], None]]
+
+def _notify(status: StatusCallback, message: str):
+    if status is not None:
+        status(message)
+
+def _generate_judge_loop(req: str, name: Optional[str], status: StatusCallback,
+                         run: _PipelineRun) -> Tuple[str, List[str]]:
+    """judge_loop mode: draft (Tool 2), judge (Tool 3), then rewrite (Tool 4) if the policy asks."""
     # 1) First Draft (Tool 2: Story Generator)
-    draft = _invoke(_story_llm, STORY_PROMPT(req), "story_draft")
+    _notify(status, "Writing your story...")
+    draft = _invoke(_app.story_llm, STORY_PROMPT(req, name), "story_draft")
 
     # 2) Judge Safety (Tool 3: Story Evaluator)
-    judge = _safe_json(_invoke(_judge_llm, JUDGE_PROMPT(draft), "judge"))
+    _notify(status, "Checking the story is gentle and safe...")
+    judge = _judge_story(draft)
     
     if judge.get("unsafe"):
         return REFUSAL, []
 
     # 3) Improve if needed (Tool 4: Revision Evaluator)
-    final_story = draft
-    suggestions = []
-    
-    if judge.get("hint"):
-        final_story = _invoke(_story_llm, IMPROVE_PROMPT(draft, judge["hint"]), "rewrite")
-        suggestions.append(judge["hint"])
+    hint = _rewrite_hint(draft, judge.get("hint", ""))
+    if not hint:
+        return draft, []
+    _notify(status, "Polishing the story...")
+    run.rewritten = True
+    return _invoke(_app.story_llm, IMPROVE_PROMPT(draft, hint), "rewrite"), [hint]
+
+def _generate_self_judged(req: str, name: Optional[str], status: StatusCallback,
+                          run: _PipelineRun) -> Tuple[str, List[str]]:
+    """
+    self_judge mode: one call returns the draft with its self-assessment. The
+    independent judge then only verifies the draft, in parallel with the rewrite
+    (when the policy asks for one), and can still refuse the story.
+    """
+    _notify(status, "Writing your story...")
+    raw = _invoke(_app.story_llm, SELF_JUDGED_STORY_PROMPT(req, name), "story_self_judged")
+    result = _parse_self_judged(raw)
+    if result["unsafe"]:
+        return REFUSAL, []
+
+    draft = result["story"]
+    _notify(status, "Checking the story is gentle and safe...")
+    verification = _app.verify_pool.submit(copy_context().run, _judge_story, draft)
+
+    final_story, suggestions = draft, []
+    hint = _rewrite_hint(draft, result["hint"], result["has_moral"])
+    if hint:
+        _notify(status, "Polishing the story...")
+        run.rewritten = True
+        final_story = _invoke(_app.story_llm, IMPROVE_PROMPT(draft, hint), "rewrite")
+        suggestions.append(hint)
+
+    if verification.result().get("unsafe"):
+        return REFUSAL, []
+    return final_story, suggestions
+
+def _run_pipeline(req: str, name: Optional[str], mode: str,
+                  status: StatusCallback = None) -> Tuple[str, List[str]]:
+    with _pipeline_run(mode) as run:
+        generate = _generate_self_judged if mode == "self_judge" else _generate_judge_loop
+        final_story, suggestions = generate(req, name, status, run)
+        run.outcome = "refusal" if final_story == REFUSAL else "story"
+    return final_story, suggestions
+
+def generate_story(req: str, name: Optional[str] = None, key: str = "") -> Tuple[str, List[str]]:
+    """
+    Draft -> judge -> rewrite for one theme, without routing, session history, the
+    story pool or index reuse (bulk jobs, see story_batch.py). `key` picks the
+    pipeline mode like a session id does. Approved stories are still indexed.
+    """
+    if _instruction_is_unsafe(req):
+        return REFUSAL, []
+    final_story, suggestions = _run_pipeline(req, name, pipeline_mode(key), None)
+    if final_story == REFUSAL:
+        return REFUSAL, []
+    _index_story(req, final_story, name, key)
+    return final_story, suggestions
+
+def generate_with_judge_loop(session_id: str, req: str,
+                             ctx: Optional[SessionContext] = None,
+                             status: StatusCallback = None) -> Tuple[str, List[str]]:
+    """
+    Implements the story generation, evaluation (Tool 3), and optional revision (Tool 4) loop.
+    Themes with a warm story pool (STORY_POOL_ENABLED) are served from it instantly;
+    otherwise a close approved story from the semantic index (STORY_INDEX_ENABLED) is
+    offered or used as the seed of a cheap rewrite.
+    The session's pipeline mode (see pipeline_mode) picks the serial judge loop or the
+    single-call self-judged draft; STORY_REWRITE_POLICY decides when a rewrite is made.
+    Returns (final_story_text, suggestions_applied).
+    When `ctx` is given, the story is queued on it and the caller is responsible for flushing.
+    """
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
+    # 0) Local pre-screen: clearly unsafe themes are refused without any LLM call
+    if _instruction_is_unsafe(req):
+        return REFUSAL, []
+
+    name = ctx.summary().get("name")
+    pooled = _take_pooled(req)
+    reused = _reuse_indexed(req, name, session_id, status) if pooled is None else None
+    if pooled is not None:
+        final_story, suggestions = personalize(pooled, name), []
+    elif reused is not None:
+        final_story, suggestions = reused
+    else:
+        final_story, suggestions = _run_pipeline(req, name, pipeline_mode(session_id), status)
+        if final_story == REFUSAL:
+            return REFUSAL, []
+        _index_story(req, final_story, name, session_id)
 
     # 4) Save final story
-    history = _get_history(session_id)
-    history.append(AIMessage(content=f"[FINAL STORY]\n{final_story}"))
-    _save_history(session_id, history)
+    ctx.save_story(final_story)
+    ctx.remember(theme=req, story=final_story)
+    render_story_audio(final_story)
+    if owns_ctx:
+        ctx.flush()
     
     return final_story, suggestions
 
-def refine_with_human_feedback(session_id: str, instruction: str) -> str:
+def refine_with_human_feedback(session_id: str, instruction: str,
+                               ctx: Optional[SessionContext] = None,
+                               status: StatusCallback = None) -> str:
     """
     Refines the last story based on direct user instruction (Tool 4: Revision Evaluator).
     CRITICAL: The refined story is run through the Judge (Tool 3) for safety.
     """
-    last = get_last_story(session_id)
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
+    last = ctx.last_story()
     if not last:
         return "I don't have a story right now. Could you ask me to tell you a new one?"
 
+    # 0. Local pre-screen: refuse clearly unsafe instructions before paying for a rewrite
+    if _instruction_is_unsafe(instruction):
+        return REFINE_REFUSAL
+
     # 1. Generate refined draft (Tool 4)
-    refined_draft = _invoke(_story_llm, IMPROVE_PROMPT(last, instruction), "rewrite_manual")
+    _notify(status, "Changing the story...")
+    refined_draft = _invoke(_app.story_llm, IMPROVE_PROMPT(last, instruction), "rewrite_manual")
     
     # 2. Safety Check the refined draft (Tool 3)
-    judge = _safe_json(_invoke(_judge_llm, JUDGE_PROMPT(refined_draft), "refine_judge"))
+    _notify(status, "Checking the story is gentle and safe...")
+    judge = _judge_story(refined_draft, "refine_judge")
     
     if judge.get("unsafe"):
         # CRITICAL REJECTION: If refinement introduces unsafe content, revert to the last safe story.
-        return f"{REFUSAL} I cannot apply that change because it introduces danger, violence, or loss. The current safe story remains unchanged."
+        return REFINE_REFUSAL
 
     # 3. Apply optional second improvement if the judge provided a hint
     final_story = refined_draft
     if judge.get("hint"):
-        final_story = _invoke(_story_llm, IMPROVE_PROMPT(refined_draft, judge["hint"]), "rewrite_post_refine")
+        _notify(status, "Polishing the story...")
+        final_story = _invoke(_app.story_llm, IMPROVE_PROMPT(refined_draft, judge["hint"]), "rewrite_post_refine")
 
-    # 4. Save the new safe story
-    history = _get_history(session_id)
-    
-    # Find the last story entry and update its content
-    found_and_updated = False
-    for msg in reversed(history):
-        if isinstance(msg, AIMessage) and msg.content.startswith("[FINAL STORY]"):
-            msg.content = f"[FINAL STORY]\n{final_story}"
-            found_and_updated = True
-            break
-            
-    if not found_and_updated:
-         history.append(AIMessage(content=f"[FINAL STORY]\n{final_story}"))
-
-    _save_history(session_id, history)
+    # 4. Save the new safe story as the next version
+    ctx.save_story(final_story)
+    render_story_audio(final_story)
+    if owns_ctx:
+        ctx.flush()
     return final_story
 
-def small_chat_reply(session_id: str, user: str) -> str:
+def small_chat_reply(session_id: str, user: str,
+                     ctx: Optional[SessionContext] = None,
+                     status: StatusCallback = None) -> str:
     """
     Generates a short, non-story chat reply (Tool 5: Chat Responder).
     """
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
     # Use context from the last story if available
-    ctx = (get_last_story(session_id) or "")[:400]
+    story_ctx = (ctx.last_story() or "")[:400]
     
     # Use the Chat Responder tool
-    reply = _invoke(_chat_llm, CHAT_PROMPT(ctx, user), "chat_reply").strip()
+    _notify(status, "Thinking...")
+    reply = _invoke(_app.chat_llm, CHAT_PROMPT(story_ctx, user), "chat_reply").strip()
     
     # Save the AI response to history
-    history = _get_history(session_id)
-    history.append(AIMessage(content=reply))
-    _save_history(session_id, history)
+    ctx.append("ai", reply)
+    if owns_ctx:
+        ctx.flush()
     
     return reply
 
+# ============================================================
+# STORY POOL (pre-generated stories for popular themes)
+# ============================================================
+STORY_POOL_ENABLED = os.getenv("STORY_POOL_ENABLED", "").lower() == "true"
+# Refill only while fewer upstream calls than this are in flight.
+STORY_POOL_IDLE_IN_FLIGHT = _env_number("STORY_POOL_IDLE_IN_FLIGHT", 4, int)
+
+def _pool_story(theme: str) -> Optional[str]:
+    """Refill worker: an unpersonalized, judge-approved story for a pooled theme (None if refused)."""
+    mode = pipeline_mode(f"pool:{theme}")
+    generate = _generate_self_judged if mode == "self_judge" else _generate_judge_loop
+    with deadline(LLM_TURN_DEADLINE_SECONDS):
+        story, _ = generate(theme, None, None, _PipelineRun("pool"))
+    return None if story == REFUSAL else story
+
+def _upstream_idle() -> bool:
+    return sum(c["in_flight"] for c in _app.gateway.stats().values()) < STORY_POOL_IDLE_IN_FLIGHT
+
+def _take_pooled(req: str) -> Optional[str]:
+    if not STORY_POOL_ENABLED:
+        return None
+    with metrics.stage("story_pool"):
+        return _app.story_pool.take(req)
+
+def pool_stats() -> Dict[str, Any]:
+    """Story pool hit rate, refill counters and pooled stories per theme."""
+    return dict(_app.story_pool.stats(), enabled=STORY_POOL_ENABLED)
+
+def _pool_metrics() -> List[str]:
+    pool = _app.peek("story_pool")
+    if pool is None:
+        return []
+    stats = pool.stats()
+    return (
+        metrics.counter_lines("story_pool_lookups_total", "New-story pool lookups by outcome.", ("outcome",),
+                              {("hit",): stats["hits"], ("miss",): stats["misses"], ("unpooled",): stats["unpooled"]})
+        + metrics.counter_lines("story_pool_refills_total", "Pool refill generations by outcome.", ("outcome",),
+                                {("ok",): stats["refills"], ("failed",): stats["refill_failures"]})
+        + metrics.counter_lines("story_pool_evictions_total", "Pooled stories evicted (expired or theme dropped).",
+                                ("reason",), {("expired",): stats["expired"], ("dropped",): stats["dropped"]})
+        + metrics.counter_lines("story_pool_stories", "Ready stories per pooled theme.", ("theme",),
+                                {(k,): n for k, n in stats["themes"].items()}, kind="gauge")
+    )
+
+if STORY_POOL_ENABLED:
+    metrics.add_collector(_pool_metrics)
+
+# ============================================================
+# SEMANTIC STORY INDEX (approved stories shared across sessions)
+# ============================================================
+STORY_INDEX_ENABLED = os.getenv("STORY_INDEX_ENABLED", "").lower() == "true"
+STORY_INDEX_PATH = os.getenv("STORY_INDEX_PATH", "story_index")
+# Cosine similarity a stored story needs to be reused for a request.
+STORY_INDEX_MIN_SCORE = _env_number("STORY_INDEX_MIN_SCORE", 0.75)
+# offer: serve the stored story as is; seed: rewrite it for the request (rewrite + judge).
+STORY_INDEX_REUSE = _env_choice("STORY_INDEX_REUSE", "offer", ("offer", "seed"))
+_story_index = None
+
+def _get_story_index():
+    """The index, opened on first use (needs numpy); None when disabled."""
+    global _story_index
+    if STORY_INDEX_ENABLED and _story_index is None:
+        from story_index import StoryIndex
+        _story_index = StoryIndex(STORY_INDEX_PATH)
+    return _story_index
+
+# Names in a request ("my sister Lily", "a fox named Pip") are swapped for these
+# stand-ins before a story is indexed, so they never reach other sessions; reuse
+# swaps in the names of the new request.
+_INDEX_STAND_INS = ("Tamsin", "Oren", "Juniper", "Wren")
+_PERSONAL_NAME_PATTERNS = _NAME_PATTERNS + [
+    re.compile(r"\b(?:named|called)\s+([A-Za-z][A-Za-z'-]{1,30})", re.IGNORECASE),
+    re.compile(r"\b(?:my|our)\s+(?:[a-z]+\s+)?(?:friend|sister|brother|son|daughter|mom|mum|mommy|mummy|dad|daddy|"
+               r"grandma|grandpa|granny|nana|cousin|aunt|uncle|teacher|baby|dog|cat|puppy|kitten|pet)s?"
+               r"\s+([A-Z][a-z'-]{1,30})\b"),
+]
+
+def _personal_names(text: str) -> List[str]:
+    """Names mentioned in a request, in order of first mention."""
+    found = sorted((m.start(1), m.group(1)) for p in _PERSONAL_NAME_PATTERNS for m in p.finditer(text))
+    names: List[str] = []
+    for _, name in found:
+        if name.lower() not in _THEME_STOPWORDS and name.lower() not in (n.lower() for n in names):
+            names.append(name)
+    return names
+
+def _swap_names(text: str, names: List[str], replacements: Sequence[str]) -> str:
+    for name, new in zip(names, replacements):
+        text = re.sub(rf"\b{re.escape(name)}\b", new, text, flags=re.IGNORECASE)
+    return text
+
+def _strip_names(req: str, text: str) -> str:
+    """`text` with the names mentioned in `req` replaced by the index stand-ins."""
+    return _swap_names(text, _personal_names(req)[:len(_INDEX_STAND_INS)], _INDEX_STAND_INS)
+
+def _fill_names(req: str, story: str) -> str:
+    """An indexed story with its stand-ins replaced by the names mentioned in `req`."""
+    return _swap_names(story, list(_INDEX_STAND_INS), _personal_names(req))
+
+def _indexed_story(req: str):
+    """Closest approved story for the request above STORY_INDEX_MIN_SCORE, or None."""
+    index = _get_story_index()
+    if index is None:
+        return None
+    with metrics.stage("story_index"):
+        hits = index.search(_strip_names(req, req), k=1, min_score=STORY_INDEX_MIN_SCORE)
+    metrics.INDEX_LOOKUPS.inc("hit" if hits else "miss")
+    return hits[0] if hits else None
+
+def _index_story(req: str, story: str, name: Optional[str], session_id: str):
+    """
+    Adds a new approved story. Stories written for a named listener stay private;
+    other names in the request are replaced by stand-ins (see _strip_names).
+    """
+    index = _get_story_index()
+    if index is None or name:
+        return
+    try:
+        with metrics.stage("story_index"):
+            index.add(_strip_names(req, req), _strip_names(req, story), source=session_id)
+    except Exception as e:
+        print(f"Could not add the story to the index: {e}")
+
+SEED_HINT = lambda req: f'Adapt it to this request: "{req}"'
+
+def _reuse_indexed(req: str, name: Optional[str], session_id: str,
+                   status: StatusCallback = None) -> Optional[Tuple[str, List[str]]]:
+    """(story, suggestions) built from an indexed story, or None to generate from scratch."""
+    match = _indexed_story(req)
+    if match is None:
+        return None
+    if STORY_INDEX_REUSE != "seed":
+        metrics.INDEX_REUSES.inc("offer")
+        return personalize(_fill_names(req, match.story), name), []
+    _notify(status, "Changing the story...")
+    hint = SEED_HINT(req)
+    story = _invoke(_app.story_llm, IMPROVE_PROMPT(_fill_names(req, match.story), hint), "rewrite_seeded")
+    _notify(status, "Checking the story is gentle and safe...")
+    if _judge_story(story).get("unsafe"):
+        metrics.INDEX_REUSES.inc("seed_rejected")
+        return None
+    metrics.INDEX_REUSES.inc("seed")
+    _index_story(req, story, None, session_id)
+    return personalize(story, name), [hint]
+
+def index_stats() -> Dict[str, Any]:
+    index = _get_story_index()
+    return dict(index.stats() if index is not None else {}, enabled=STORY_INDEX_ENABLED,
+                reuse=STORY_INDEX_REUSE, min_score=STORY_INDEX_MIN_SCORE)
+
+# ============================================================
+# STORY AUDIO (read-aloud rendering in the background)
+# ============================================================
+AUDIO_ENABLED = os.getenv("AUDIO_ENABLED", "").lower() == "true"
+
+def audio_renderer() -> Optional[AudioRenderer]:
+    return _app.audio
+
+def render_story_audio(story: str) -> Optional[str]:
+    """Queues the approved story for speech rendering; returns its audio id (None when disabled)."""
+    if _app.audio is None:
+        return None
+    try:
+        with metrics.stage("audio_submit"):
+            return _app.audio.submit(story)
+    except Exception as e:
+        print(f"Could not queue the story audio: {e}")
+        return None
+
+def story_audio_id(story: str) -> Optional[str]:
+    return _app.audio.story_id(story) if _app.audio is not None else None
+
 # ============================================================
 # MAIN ROUTER (The Public API)
 # ============================================================
 
-def handle_user_message(session_id: str, user_message: str) -> Tuple[str, str, Optional[int]]:
+def handle_user_message(session_id: str, user_message: str,
+                        ctx: Optional[SessionContext] = None,
+                        status: StatusCallback = None) -> Tuple[str, str, Optional[int]]:
     """
     The main routing function. Uses the LLM Intent Classifier tool for routing.
+
+    The session history is loaded once into a SessionContext and flushed once at the
+    end of the turn. Pass your own `ctx` to inspect its `reads` / `writes` counters.
+    `status` receives short progress messages as the pipeline moves between tools.
+    All LLM calls of the turn share one LLM_TURN_DEADLINE_SECONDS budget.
     
     Returns:
         (response_text, response_type, internal_revision_count)
     """
-    has_story = _has_story(session_id)
-    
-    # --- ROUTING STEP (Uses LLM Tool 1) ---
-    intent, instruction = extract_context_and_detect_intent_tool_based(user_message, has_story)
-    
-    # 1. Save User Message to History (for full context)
-    history = _get_history(session_id)
-    history.append(HumanMessage(content=user_message))
-    _save_history(session_id, history) 
-
-    if intent == "new_story":
-        # ROUTE: New Story Pipeline (Tools 2, 3, 4)
-        result, suggestions = generate_with_judge_loop(session_id, instruction)
+    if ctx is None:
+        ctx = SessionContext(session_id)
+    try:
+        with deadline(LLM_TURN_DEADLINE_SECONDS):
+            has_story = ctx.last_story() is not None
         
-        revision_count = 1 if suggestions else 0
-        response_type = "refusal" if result == REFUSAL else "story"
+            # --- ROUTING STEP (Uses LLM Tool 1) ---
+            _notify(status, "Reading your message...")
+            intent, instruction = extract_context_and_detect_intent_tool_based(user_message, has_story)
         
-        return result, response_type, revision_count
+            # 1. Save User Message to History (for full context)
+            ctx.append("human", user_message)
 
-    elif intent == "refine":
-        # ROUTE: Story Refinement Pipeline (Tool 4)
-        response = refine_with_human_feedback(session_id, instruction)
-        
-        # Check if the refinement function returned the refusal message
-        is_refusal = response.startswith(REFUSAL) and "I cannot apply that change" in response
-        
-        return response, "refusal" if is_refusal else "refinement", None
+            if intent == "new_story":
+                # ROUTE: New Story Pipeline (Tools 2, 3, 4)
+                result, suggestions = generate_with_judge_loop(session_id, instruction, ctx, status)
+            
+                revision_count = 1 if suggestions else 0
+                response_type = "refusal" if result == REFUSAL else "story"
+            
+                return result, response_type, revision_count
+
+            elif intent == "refine":
+                # ROUTE: Story Refinement Pipeline (Tool 4)
+                response = refine_with_human_feedback(session_id, instruction, ctx, status)
+            
+                # Check if the refinement function returned the refusal message
+                is_refusal = response == REFINE_REFUSAL
+            
+                return response, "refusal" if is_refusal else "refinement", None
+
+            else: # intent == "chat"
+                # ROUTE: Small Chat Reply (Tool 5)
+                response = small_chat_reply(session_id, instruction, ctx, status)
+                return response, "chat", None
+    finally:
+        # Single write per turn (the user message is kept even if a tool call failed).
+        ctx.flush()
+
+# ============================================================
+# STREAMING ROUTER
+# ============================================================
+TYPING_MARKER = "[typing]"
+STREAM_HEARTBEAT_SECONDS = 5.0
+
+def _typing(message: str = "") -> str:
+    """A status line the frontend's streamReader hides from the chat bubble."""
+    return f"{TYPING_MARKER} {message}\n" if message else f"{TYPING_MARKER}\n"
+
+def _text_chunks(text: str, words_per_chunk: int = 3) -> Iterator[str]:
+    """Splits text into small word groups, keeping the original whitespace."""
+    tokens = re.findall(r"\S+\s*", text)
+    for i in range(0, len(tokens), words_per_chunk):
+        yield "".join(tokens[i:i + words_per_chunk])
+
+def stream_user_message(session_id: str, user_message: str) -> Iterator[str]:
+    """
+    Streaming variant of handle_user_message for chunked HTTP responses.
+
+    Yields `[typing] ...` status lines while the turn runs (plus a heartbeat during
+    long LLM calls), then a `[typing] result:<response_type>` line, then the reply
+    text in small chunks. The turn runs the same pipeline as handle_user_message, so
+    story text is only produced after the Story Evaluator has approved it.
+    """
+    events: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+
+    def run():
+        try:
+            result = handle_user_message(session_id, user_message,
+                                         status=lambda m: events.put(("status", m)))
+            events.put(("result", result))
+        except Exception as e:
+            events.put(("error", e))
+
+    # Run the turn in a copy of the caller's context so request spans, call counters
+    # and caller rate-limit buckets follow it onto the worker thread.
+    threading.Thread(target=copy_context().run, args=(run,), name="stream-turn", daemon=True).start()
+    yield _typing()
 
-    else: # intent == "chat"
-        # ROUTE: Small Chat Reply (Tool 5)
-        response = small_chat_reply(session_id, instruction)
-        return response, "chat", None
\ No newline at end of file
+    while True:
+        try:
+            kind, payload = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+        except queue.Empty:
+            yield _typing()
+            continue
+        if kind == "status":
+            yield _typing(payload)
+        elif kind == "error":
+            raise payload
+        else:
+            response, response_type, _ = payload
+            yield _typing(f"result:{response_type}")
+            yield from _text_chunks(response)
+            return
@@ -0,0 +1,303 @@
+# story_engine_async.py
+"""
+asyncio version of the story pipeline in story_engine.py.
+
+Uses the same prompts, LLM clients, JSON parsing and SessionContext, but awaits
+`ainvoke` instead of blocking on `invoke`, so one event loop can serve many turns
+while they wait on the upstream API. Independent work inside a turn is overlapped:
+the history load runs alongside the Intent Classifier call, and (optionally) a
+speculative first draft is written while the router is still deciding.
+"""
+import asyncio
+import os
+from typing import Optional, List, Tuple
+
+from story_engine import (
+    LANGSMITH_ENABLED,
+    REFUSAL,
+    REFINE_REFUSAL,
+    SessionContext,
+    INTENT_CLASSIFIER_PROMPT,
+    STORY_PROMPT,
+    SELF_JUDGED_STORY_PROMPT,
+    JUDGE_PROMPT,
+    INSTRUCTION_JUDGE_PROMPT,
+    IMPROVE_PROMPT,
+    CHAT_PROMPT,
+    _app,
+    _safe_json,
+    _detect_name,
+    _fill_names,
+    _parse_intent,
+    _cache_key,
+    _instruction_needs_judge,
+    _prescreen_verdict,
+    _parse_self_judged,
+    _rewrite_hint,
+    _pipeline_run,
+    _take_pooled,
+    render_story_audio,
+    _indexed_story,
+    _index_story,
+    SEED_HINT,
+    STORY_INDEX_REUSE,
+    pipeline_mode,
+    _hedge_after,
+    LLM_TURN_DEADLINE_SECONDS,
+    fast_path_intent,
+)
+from llm_gateway import deadline
+from story_pool import personalize
+import metrics
+
+# Start drafting a story from the raw message while the router runs. Saves a full
+# round trip on new_story turns at the cost of a wasted (cancelled) call otherwise.
+SPECULATIVE_DRAFT = os.getenv("ASYNC_SPECULATIVE_DRAFT", "").lower() == "true"
+
+async def _ainvoke(llm, prompt: str, run_name: str = "run", cache_text: Optional[str] = None) -> str:
+    """Async counterpart of story_engine._invoke (shares its LLM cache, gateway budgets and metrics)."""
+    with metrics.llm_call(run_name, prompt) as call:
+        key = _cache_key(llm, prompt, run_name, cache_text)
+        if key is not None:
+            cached = _app.llm_cache.get(key)
+            if cached is not None:
+                call.cache_hit(cached)
+                return cached
+
+        cfg = {"run_name": run_name} if LANGSMITH_ENABLED else {}
+        reply = await _app.gateway.ainvoke(llm, prompt, cfg, hedge_after=_hedge_after(run_name))
+        call.response(reply.content, getattr(reply, "usage_metadata", None))
+
+    if key is not None:
+        _app.llm_cache.put(key, reply.content)
+    return reply.content
+
+async def _ainstruction_is_unsafe(text: str) -> bool:
+    """Async _instruction_is_unsafe (lexicon hits are decided by the LLM judge)."""
+    if not _instruction_needs_judge(text):
+        return False
+    return bool(_safe_json(await _ainvoke(_app.judge_llm, INSTRUCTION_JUDGE_PROMPT(text), "instruction_judge",
+                                          cache_text=text)).get("unsafe"))
+
+async def _ajudge_story(story: str, run_name: str = "judge"):
+    local = _prescreen_verdict(story)
+    if local is not None:
+        return local
+    return _safe_json(await _ainvoke(_app.judge_llm, JUDGE_PROMPT(story), run_name, cache_text=story))
+
+# ============================================================
+# ASYNC PIPELINE FUNCTIONS
+# ============================================================
+
+async def _adraft(req: str, name: Optional[str], mode: str = "judge_loop") -> str:
+    """
+    Tool 2 (Tool 2b in self_judge mode, raw reply), personalized with `name`. Takes
+    the name rather than the SessionContext, so a speculative draft never touches
+    the context while the turn is still updating it.
+    """
+    if mode == "self_judge":
+        return await _ainvoke(_app.story_llm, SELF_JUDGED_STORY_PROMPT(req, name), "story_self_judged")
+    return await _ainvoke(_app.story_llm, STORY_PROMPT(req, name), "story_draft")
+
+async def _ajudge_loop(draft: str, run) -> Tuple[str, List[str]]:
+    judge = await _ajudge_story(draft)
+    if judge.get("unsafe"):
+        return REFUSAL, []
+    hint = _rewrite_hint(draft, judge.get("hint", ""))
+    if not hint:
+        return draft, []
+    run.rewritten = True
+    return await _ainvoke(_app.story_llm, IMPROVE_PROMPT(draft, hint), "rewrite"), [hint]
+
+async def _aself_judged(raw: str, run) -> Tuple[str, List[str]]:
+    """The independent judge verifies the self-judged draft while the rewrite runs."""
+    result = _parse_self_judged(raw)
+    if result["unsafe"]:
+        return REFUSAL, []
+    draft = result["story"]
+    verification = asyncio.create_task(_ajudge_story(draft))
+    try:
+        final_story, suggestions = draft, []
+        hint = _rewrite_hint(draft, result["hint"], result["has_moral"])
+        if hint:
+            run.rewritten = True
+            final_story = await _ainvoke(_app.story_llm, IMPROVE_PROMPT(draft, hint), "rewrite")
+            suggestions.append(hint)
+        if (await verification).get("unsafe"):
+            return REFUSAL, []
+        return final_story, suggestions
+    finally:
+        verification.cancel()
+
+async def _areuse_indexed(req: str, name: Optional[str], session_id: str) -> Optional[Tuple[str, List[str]]]:
+    """Async _reuse_indexed (the index search runs in a thread; it may open the index)."""
+    match = await asyncio.to_thread(_indexed_story, req)
+    if match is None:
+        return None
+    if STORY_INDEX_REUSE != "seed":
+        metrics.INDEX_REUSES.inc("offer")
+        return personalize(_fill_names(req, match.story), name), []
+    hint = SEED_HINT(req)
+    story = await _ainvoke(_app.story_llm, IMPROVE_PROMPT(_fill_names(req, match.story), hint), "rewrite_seeded")
+    if (await _ajudge_story(story)).get("unsafe"):
+        metrics.INDEX_REUSES.inc("seed_rejected")
+        return None
+    metrics.INDEX_REUSES.inc("seed")
+    await asyncio.to_thread(_index_story, req, story, None, session_id)
+    return personalize(story, name), [hint]
+
+async def agenerate_with_judge_loop(session_id: str, req: str,
+                                    ctx: Optional[SessionContext] = None,
+                                    draft: Optional[str] = None,
+                                    pending_draft: Optional["asyncio.Future[str]"] = None) -> Tuple[str, List[str]]:
+    """
+    Async generate_with_judge_loop. `draft` (or `pending_draft`, awaited only when the
+    story pool has nothing for the theme) is an _adraft reply for this session's
+    pipeline mode and skips the first call (its time is not counted in the pipeline metrics).
+    """
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
+    if await _ainstruction_is_unsafe(req):
+        return REFUSAL, []
+
+    summary = await asyncio.to_thread(ctx.summary)
+    name = summary.get("name")
+    pooled = _take_pooled(req)
+    reused = await _areuse_indexed(req, name, session_id) if pooled is None else None
+    if pooled is not None:
+        final_story, suggestions = personalize(pooled, name), []
+    elif reused is not None:
+        final_story, suggestions = reused
+    else:
+        mode = pipeline_mode(session_id)
+        with _pipeline_run(mode) as run:
+            if draft is None and pending_draft is not None:
+                draft = await pending_draft
+            if draft is None:
+                draft = await _adraft(req, name, mode)
+            if mode == "self_judge":
+                final_story, suggestions = await _aself_judged(draft, run)
+            else:
+                final_story, suggestions = await _ajudge_loop(draft, run)
+            run.outcome = "refusal" if final_story == REFUSAL else "story"
+        if final_story == REFUSAL:
+            return REFUSAL, []
+        await asyncio.to_thread(_index_story, req, final_story, name, session_id)
+
+    ctx.save_story(final_story)
+    await asyncio.to_thread(render_story_audio, final_story)
+    ctx.remember(theme=req, story=final_story)
+    if owns_ctx:
+        await asyncio.to_thread(ctx.flush)
+    return final_story, suggestions
+
+async def arefine_with_human_feedback(session_id: str, instruction: str,
+                                      ctx: Optional[SessionContext] = None) -> str:
+    """Async refine_with_human_feedback (the refined story is still judged)."""
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
+    last = await asyncio.to_thread(ctx.last_story)
+    if not last:
+        return "I don't have a story right now. Could you ask me to tell you a new one?"
+    if await _ainstruction_is_unsafe(instruction):
+        return REFINE_REFUSAL
+
+    refined_draft = await _ainvoke(_app.story_llm, IMPROVE_PROMPT(last, instruction), "rewrite_manual")
+    judge = await _ajudge_story(refined_draft, "refine_judge")
+    if judge.get("unsafe"):
+        return REFINE_REFUSAL
+
+    final_story = refined_draft
+    if judge.get("hint"):
+        final_story = await _ainvoke(_app.story_llm, IMPROVE_PROMPT(refined_draft, judge["hint"]), "rewrite_post_refine")
+
+    ctx.save_story(final_story)
+    await asyncio.to_thread(render_story_audio, final_story)
+    if owns_ctx:
+        await asyncio.to_thread(ctx.flush)
+    return final_story
+
+async def asmall_chat_reply(session_id: str, user: str,
+                            ctx: Optional[SessionContext] = None) -> str:
+    """Async small_chat_reply."""
+    owns_ctx = ctx is None
+    if owns_ctx:
+        ctx = SessionContext(session_id)
+
+    story_ctx = ((await asyncio.to_thread(ctx.last_story)) or "")[:400]
+    reply = (await _ainvoke(_app.chat_llm, CHAT_PROMPT(story_ctx, user), "chat_reply")).strip()
+
+    ctx.append("ai", reply)
+    if owns_ctx:
+        await asyncio.to_thread(ctx.flush)
+    return reply
+
+# ============================================================
+# MAIN ROUTER (async)
+# ============================================================
+
+async def ahandle_user_message(session_id: str, user_message: str,
+                               ctx: Optional[SessionContext] = None) -> Tuple[str, str, Optional[int]]:
+    """
+    Async handle_user_message with the same return value.
+
+    Obvious messages are routed by the local fast-path router. Otherwise the Intent
+    Classifier is sent before the history has been read (the prompt says the session
+    status is unknown); the usual "refine without a story becomes new_story" rule
+    is applied once the history load finishes.
+    """
+    if ctx is None:
+        ctx = SessionContext(session_id)
+
+    # Every LLM call of the turn (tasks inherit the context) shares one deadline.
+    with deadline(LLM_TURN_DEADLINE_SECONDS):
+        history_task: Optional[asyncio.Task] = None
+        draft_task: Optional[asyncio.Task] = None
+        try:
+            history_task = asyncio.create_task(asyncio.to_thread(ctx.last_story))
+
+            # has_story=True keeps "refine" as-is; the rule is applied below after the load.
+            fast = fast_path_intent(user_message, True)
+            if fast is not None:
+                intent, instruction = fast
+                if intent == "refine" and await history_task is None:
+                    intent = "new_story"
+            else:
+                if SPECULATIVE_DRAFT:
+                    # The summary is read here, before the message is queued, not from the draft task.
+                    name = _detect_name(user_message) or (await asyncio.to_thread(ctx.summary)).get("name")
+                    draft_task = asyncio.create_task(_adraft(user_message, name, pipeline_mode(session_id)))
+                raw_json, last_story = await asyncio.gather(
+                    _ainvoke(_app.judge_llm, INTENT_CLASSIFIER_PROMPT(user_message, None), "intent_classifier_tool"),
+                    history_task,
+                )
+                intent, instruction = _parse_intent(raw_json, user_message, last_story is not None)
+
+            ctx.append("human", user_message)
+
+            if intent == "new_story":
+                # An unused speculative draft (pool hit) is cancelled below.
+                result, suggestions = await agenerate_with_judge_loop(session_id, instruction, ctx,
+                                                                      pending_draft=draft_task)
+                response_type = "refusal" if result == REFUSAL else "story"
+                return result, response_type, 1 if suggestions else 0
+
+            if intent == "refine":
+                response = await arefine_with_human_feedback(session_id, instruction, ctx)
+                is_refusal = response == REFINE_REFUSAL
+                return response, "refusal" if is_refusal else "refinement", None
+
+            response = await asmall_chat_reply(session_id, instruction, ctx)
+            return response, "chat", None
+        finally:
+            if draft_task is not None:
+                draft_task.cancel()
+                await asyncio.gather(draft_task, return_exceptions=True)
+            if history_task is not None:
+                # Never flush while the load thread may still be filling the context.
+                await asyncio.gather(history_task, return_exceptions=True)
+            await asyncio.to_thread(ctx.flush)
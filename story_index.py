@@ -0,0 +1,394 @@
+# story_index.py
+"""
+Semantic index over judge-approved stories, shared by all sessions.
+
+Each story is embedded locally as a hashed bag of words and word pairs (signed
+feature hashing into `dim` buckets, sublinear term frequency, L2-normalized),
+weighted towards the request theme it was written for. Vectors are stored as int8
+with a per-row scale in NumPy arrays persisted as memory-mapped .npy files, so a
+large index opens in milliseconds; every new story is appended in place.
+
+Queries use random-hyperplane LSH: `tables` signatures of `bits` bits per story,
+looked up (with every one-bit neighbour of the query's bucket) in per-table sorted
+code arrays, then the candidates are re-ranked by exact cosine similarity. Stories
+added since the tables were last sorted are scanned directly.
+
+    python story_index.py build --db sessions.db --json sessions.json
+    python story_index.py bench --stories 100000
+"""
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process locking degrades to in-process locks only
+    fcntl = None
+
+_TOKEN = re.compile(r"[a-z]+")
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "of", "to", "in", "on", "at", "for", "with", "about", "from",
+    "is", "was", "were", "are", "be", "been", "it", "its", "he", "she", "they", "them", "his", "her",
+    "their", "i", "me", "my", "you", "your", "we", "us", "our", "that", "this", "who", "which", "so",
+    "as", "had", "has", "have", "did", "do", "not", "very", "then", "there", "up", "out", "into",
+    "story", "tell", "write", "please", "bedtime", "once", "upon", "time", "moral",
+}
+THEME_WEIGHT = 0.6
+
+
+def _tokens(text: str) -> List[str]:
+    out = []
+    for w in _TOKEN.findall(text.lower()):
+        if w in _STOPWORDS or len(w) < 2:
+            continue
+        if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        out.append(w)
+    return out
+
+
+def embed(text: str, dim: int = 256) -> np.ndarray:
+    """Unit-length hashed term vector (float32) of `text`; zeros when it has no content words."""
+    tokens = _tokens(text)
+    feats = Counter(tokens)
+    for a, b in zip(tokens, tokens[1:]):
+        feats[f"{a} {b}"] += 0.5
+    v = np.zeros(dim, dtype=np.float32)
+    for feat, count in feats.items():
+        h = zlib.crc32(feat.encode("utf-8"))
+        v[h % dim] += (1.0 + math.log(count)) * (1.0 if h & 0x80000000 else -1.0)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+def embed_story(theme: str, story: str, dim: int = 256) -> np.ndarray:
+    """Document vector: the request theme (when known) blended with the story text."""
+    v = embed(story, dim)
+    if theme.strip():
+        v = THEME_WEIGHT * embed(theme, dim) + (1 - THEME_WEIGHT) * v
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+@contextmanager
+def _file_lock(path: str) -> Iterator[None]:
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Match(NamedTuple):
+    id: int
+    score: float
+    theme: str
+    story: str
+
+
+class StoryIndex:
+    """
+    Append-only index in directory `path`:
+      header.json    dim / tables / bits / seed / count / capacity
+      vectors.npy    (capacity, dim) int8 story vectors
+      scales.npy     (capacity,) float32 scale of each vector row
+      codes.npy      (capacity, tables) uint16 LSH signatures
+      offsets.npy    (capacity,) int64 offsets of each story in docs.jsonl
+      docs.jsonl     {"theme", "story", "source"} per story
+    Appends take a cross-process file lock; other processes see them on their next
+    query (the header is re-read at most every `refresh_seconds`).
+    """
+
+    def __init__(self, path: str, dim: int = 256, tables: int = 10, bits: int = 13, seed: int = 0,
+                 rebuild_after: int = 4096, refresh_seconds: float = 1.0):
+        if bits > 16:
+            raise ValueError("bits must be <= 16")
+        self.path = path
+        self.rebuild_after = rebuild_after
+        self.refresh_seconds = refresh_seconds
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._lock_path = os.path.join(path, "index.lock")
+        header = self._read_header()
+        if header is None:
+            header = {"dim": dim, "tables": tables, "bits": bits, "seed": seed, "count": 0, "capacity": 0}
+            with _file_lock(self._lock_path):
+                if self._read_header() is None:
+                    self._grow(header, 1024)
+                header = self._read_header()
+        self.dim, self.tables, self.bits = header["dim"], header["tables"], header["bits"]
+        rng = np.random.default_rng(header["seed"])
+        self._planes = rng.standard_normal((self.tables * self.bits, self.dim)).astype(np.float32)
+        self._weights = (1 << np.arange(self.bits, dtype=np.uint32)).astype(np.uint32)
+        self._probes = np.array([0] + [1 << b for b in range(self.bits)], dtype=np.uint16)
+        self._header = header
+        self._open(header)
+        self._sorted_codes: List[np.ndarray] = []
+        self._order: List[np.ndarray] = []
+        self._indexed = 0
+        self._checked = time.monotonic()
+        self._rebuild()
+
+    # ---------------- files ----------------
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_header(self) -> Optional[dict]:
+        try:
+            with open(self._file("header.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_header(self, header: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".header-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(header, f)
+        os.replace(tmp, self._file("header.json"))
+
+    def _open(self, header: dict):
+        self._vectors = np.load(self._file("vectors.npy"), mmap_mode="r+")
+        self._scales = np.load(self._file("scales.npy"), mmap_mode="r+")
+        self._codes = np.load(self._file("codes.npy"), mmap_mode="r+")
+        self._offsets = np.load(self._file("offsets.npy"), mmap_mode="r+")
+        self._count = header["count"]
+
+    def _grow(self, header: dict, capacity: int):
+        """Re-creates the arrays with `capacity` rows (caller holds the file lock)."""
+        n = header["count"]
+        specs = (("vectors.npy", np.int8, (capacity, header["dim"])),
+                 ("scales.npy", np.float32, (capacity,)),
+                 ("codes.npy", np.uint16, (capacity, header["tables"])),
+                 ("offsets.npy", np.int64, (capacity,)))
+        for name, dtype, shape in specs:
+            tmp = self._file(f".{name}.tmp")
+            new = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+            if n:
+                new[:n] = np.load(self._file(name), mmap_mode="r")[:n]
+            new.flush()
+            del new
+            os.replace(tmp, self._file(name))
+        header["capacity"] = capacity
+        self._write_header(header)
+
+    # ---------------- LSH ----------------
+    def _signature(self, vectors: np.ndarray) -> np.ndarray:
+        bits = (vectors @ self._planes.T > 0).reshape(len(vectors), self.tables, self.bits)
+        return (bits.astype(np.uint32) @ self._weights).astype(np.uint16)
+
+    def _rebuild(self):
+        """Sorts every table's codes; stories past `_indexed` are scanned directly."""
+        n = self._count
+        codes = np.asarray(self._codes[:n])
+        self._order = [np.argsort(codes[:, t], kind="stable") for t in range(self.tables)]
+        self._sorted_codes = [codes[order, t] for t, order in enumerate(self._order)]
+        self._indexed = n
+
+    def _refresh(self):
+        """Picks up stories appended by other processes and re-sorts a long unindexed tail."""
+        now = time.monotonic()
+        if now - self._checked >= self.refresh_seconds:
+            self._checked = now
+            header = self._read_header()
+            if header and header["count"] > self._count:
+                self._header = header
+                self._open(header)
+        if self._count - self._indexed > self.rebuild_after:
+            self._rebuild()
+
+    # ---------------- public API ----------------
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, theme: str, story: str, source: str = "") -> int:
+        """Appends an approved story; returns its id."""
+        return self.add_many([(theme, story, source)])[0]
+
+    def add_many(self, items: List[Tuple[str, str, str]]) -> List[int]:
+        """Appends (theme, story, source) items under one lock and header write; returns their ids."""
+        if not items:
+            return []
+        vectors = np.stack([embed_story(theme, story, self.dim) for theme, story, _ in items])
+        codes = self._signature(vectors)
+        lines = [(json.dumps({"theme": t, "story": s, "source": src}, ensure_ascii=False) + "\n").encode("utf-8")
+                 for t, s, src in items]
+        with self._lock, _file_lock(self._lock_path):
+            header = self._read_header()
+            start, end = header["count"], header["count"] + len(items)
+            if end > header["capacity"]:
+                capacity = max(1024, header["capacity"])
+                while capacity < end:
+                    capacity *= 2
+                self._grow(header, capacity)
+            if header != self._header:
+                self._header = header
+                self._open(header)
+            offsets = []
+            with open(self._file("docs.jsonl"), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                for line in lines:
+                    offsets.append(offset)
+                    offset += len(line)
+                f.write(b"".join(lines))
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            self._vectors[start:end] = np.rint(vectors / scales[:, None]).astype(np.int8)
+            self._scales[start:end] = scales
+            self._codes[start:end] = codes
+            self._offsets[start:end] = offsets
+            for arr in (self._vectors, self._scales, self._codes, self._offsets):
+                arr.flush()
+            header["count"] = end
+            self._write_header(header)
+            self._header = dict(header)
+            self._count = end
+        return list(range(start, end))
+
+    def doc(self, i: int) -> dict:
+        with open(self._file("docs.jsonl"), "rb") as f:
+            f.seek(int(self._offsets[i]))
+            return json.loads(f.readline())
+
+    def _candidates(self, code: np.ndarray) -> np.ndarray:
+        parts = [np.arange(self._indexed, self._count)]
+        for t in range(self.tables):
+            probes = code[t] ^ self._probes
+            lo = np.searchsorted(self._sorted_codes[t], probes, side="left")
+            hi = np.searchsorted(self._sorted_codes[t], probes, side="right")
+            parts += [self._order[t][a:b] for a, b in zip(lo, hi) if b > a]
+        return np.unique(np.concatenate(parts))
+
+    def search(self, query: str, k: int = 1, min_score: float = 0.0, exact: bool = False) -> List[Match]:
+        """Up to `k` stories closest to `query` with cosine similarity >= min_score, best first."""
+        with self._lock:
+            self._refresh()
+            if not self._count:
+                return []
+            q = embed(query, self.dim)
+            if not q.any():
+                return []
+            ids = np.arange(self._count) if exact else self._candidates(self._signature(q[None, :])[0])
+            if not len(ids):
+                return []
+            scores = (self._vectors[ids].astype(np.float32) @ q) * self._scales[ids]
+            top = np.argsort(-scores)[:k] if len(ids) <= k else np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+            hits = [(int(ids[j]), float(scores[j])) for j in top if scores[j] >= min_score]
+        return [Match(i, s, **{key: self.doc(i)[key] for key in ("theme", "story")}) for i, s in hits]
+
+    def stats(self) -> dict:
+        return {"stories": self._count, "indexed": self._indexed, "capacity": self._header["capacity"],
+                "dim": self.dim, "tables": self.tables, "bits": self.bits}
+
+
+# ============================================================
+# CLI: backfill from the session stores, benchmark
+# ============================================================
+def _backfill(index: StoryIndex, db_path: str, json_path: str) -> int:
+    """
+    Adds the approved stories of the session stores not indexed yet, under the rules
+    of story_engine._index_story: sessions with a named listener are skipped, names
+    from the session's requests are replaced by stand-ins, and each story is indexed
+    under the request just before it (stories without one are left out).
+    """
+    from memory_store import JsonMessageHistoryStore, SqliteMessageHistoryStore, _is_story, story_text
+    from story_engine import _strip_names
+    stores = []
+    if db_path and os.path.exists(db_path):
+        stores.append(SqliteMessageHistoryStore(db_path))
+    if json_path and os.path.exists(json_path):
+        stores.append(JsonMessageHistoryStore(json_path))
+    seen = set()
+    if len(index):
+        with open(index._file("docs.jsonl"), "r", encoding="utf-8") as f:
+            seen = {json.loads(line)["story"] for line in f if line.strip()}
+    items = []
+    for store in stores:
+        for session_id in store.session_ids():
+            if store.get_summary(session_id).get("name"):
+                continue
+            requests: List[str] = []
+            request = None
+            for m in store.get_full_history(session_id):
+                if m["role"] == "human":
+                    requests.append(m["content"])
+                    request = m["content"]
+                    continue
+                if _is_story(m) and request is not None:
+                    # Names may come from any earlier turn ("my sister Lily", then "make it longer").
+                    said = "\n".join(requests)
+                    story = _strip_names(said, story_text(m["content"]))
+                    if story not in seen:
+                        seen.add(story)
+                        items.append((_strip_names(said, request), story, session_id))
+                request = None
+    index.add_many(items)
+    return len(items)
+
+
+def _bench(stories: int, queries: int, path: str):
+    """Random-vocabulary stories (5000 pseudo-words): build time, open time, query latency and recall."""
+    rng = np.random.default_rng(1)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocab = ["".join(rng.choice(letters, 6)) for _ in range(5000)]
+    rows = rng.integers(0, len(vocab), size=(stories, 44))
+    items = [(" ".join(vocab[j] for j in row[:4]), " ".join(vocab[j] for j in row[4:]), "bench") for row in rows]
+
+    index = StoryIndex(path)
+    t0 = time.perf_counter()
+    for start in range(0, stories, 10000):
+        index.add_many(items[start:start + 10000])
+    print(f"built {stories} stories in {time.perf_counter() - t0:.1f}s")
+    t0 = time.perf_counter()
+    index.add("a single theme", "One more story, added on its own.")
+    print(f"single add: {(time.perf_counter() - t0) * 1000:.2f} ms")
+
+    t0 = time.perf_counter()
+    index = StoryIndex(path)
+    print(f"opened in {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    samples, agree = [], 0
+    for i in rng.integers(0, stories, size=queries):
+        q = items[i][0]
+        t0 = time.perf_counter()
+        hits = index.search(q, k=1)
+        samples.append(time.perf_counter() - t0)
+        exact = index.search(q, k=1, exact=True)
+        agree += bool(hits and exact and hits[0].id == exact[0].id)
+    samples.sort()
+    print(f"{queries} queries: p50 {samples[len(samples) // 2] * 1000:.2f} ms, "
+          f"p99 {samples[int(len(samples) * 0.99)] * 1000:.2f} ms, recall@1 vs exact {agree / queries:.1%}")
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="add the approved stories of the session stores")
+    b.add_argument("--index", default=os.getenv("STORY_INDEX_PATH", "story_index"))
+    b.add_argument("--db", default=os.getenv("MEMORY_DB_PATH", "sessions.db"))
+    b.add_argument("--json", default=os.getenv("MEMORY_JSON_PATH", "sessions.json"))
+    bb = sub.add_parser("bench", help="build a synthetic index and time queries")
+    bb.add_argument("--stories", type=int, default=100000)
+    bb.add_argument("--queries", type=int, default=500)
+    args = ap.parse_args()
+    if args.cmd == "build":
+        idx = StoryIndex(args.index)
+        print(f"added {_backfill(idx, args.db, args.json)} stories; index holds {len(idx)}")
+    else:
+        with tempfile.TemporaryDirectory(prefix="story-index-") as d:
+            _bench(args.stories, args.queries, d)
@@ -0,0 +1,207 @@
+# story_pool.py
+"""
+Warm pool of pre-generated, judge-approved stories for popular themes.
+
+New-story requests are reduced to a theme key ("Tell me a story about bunnies!"
+and "a bunny story" both become "bunny"). The pool keeps a few ready stories per
+key for a seed list of themes plus the keys requested most often, so a matching
+request is answered without waiting on the LLM. Background workers refill the
+pool only while the upstream is idle; stories older than the TTL are evicted,
+and every pooled story is served once.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+_WORD = re.compile(r"[a-z]+")
+_FILLER = {
+    "a", "an", "the", "story", "stories", "tale", "tales", "about", "of", "on", "tell", "me", "us",
+    "write", "make", "please", "bedtime", "some", "new", "another", "one", "i", "want", "would",
+    "like", "can", "you", "could", "give", "read", "for", "my", "kid", "kids", "child", "nice",
+    "and", "with", "who", "that", "is", "to", "in",
+}
+
+def _singular(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ches", "shes", "xes", "sses")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+def theme_key(req: str, max_words: int = 3) -> Optional[str]:
+    """
+    Normalized theme of a request: lower-case content words, naive singular, sorted.
+    None when nothing is left or the request is too specific to pool.
+    """
+    words = set()
+    for w in _WORD.findall(req.lower()):
+        if w in _FILLER:
+            continue
+        words.add(_singular(w))
+    if not words or len(words) > max_words:
+        return None
+    return " ".join(sorted(words))
+
+def personalize(story: str, name: Optional[str]) -> str:
+    """Cheap final step for pooled stories: greet the listener by name."""
+    return f"This story is for you, {name}!\n\n{story}" if name else story
+
+
+class StoryPool:
+    """
+    Per-theme queues of (created, story) with a size cap per theme, a cap on pooled
+    themes, TTL eviction and background refill through `generate(theme) -> story or None`.
+    `idle()` tells the refill loop whether the upstream has spare capacity.
+    """
+
+    def __init__(self, generate: Callable[[str], Optional[str]], seed_themes: Iterable[str] = (),
+                 size: int = 3, ttl: float = 6 * 3600, max_themes: int = 32, min_requests: int = 3,
+                 workers: int = 2, interval: float = 5.0, idle: Callable[[], bool] = lambda: True):
+        self.size = size
+        self.ttl = ttl
+        self.max_themes = max_themes
+        self.min_requests = min_requests
+        self.interval = interval
+        self.workers = workers
+        self._generate = generate
+        self._idle = idle
+        self._seeds = [k for k in (theme_key(t) for t in seed_themes) if k]
+        self._stories: Dict[str, Deque[Tuple[float, str]]] = {}
+        # Demand per theme key, most recent last; bounded so it cannot grow without limit.
+        self._demand: "OrderedDict[str, int]" = OrderedDict()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story-pool")
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._counts = {"hits": 0, "misses": 0, "unpooled": 0, "refills": 0, "refill_failures": 0,
+                        "expired": 0, "dropped": 0}
+
+    # ---------------- serving ----------------
+    def take(self, req: str) -> Optional[str]:
+        """A fresh pooled story for the request's theme (removed from the pool), or None."""
+        key = theme_key(req)
+        with self._lock:
+            if key is None:
+                self._counts["unpooled"] += 1
+                return None
+            self._demand[key] = self._demand.pop(key, 0) + 1
+            while len(self._demand) > self.max_themes * 8:
+                self._demand.popitem(last=False)
+            queue = self._stories.get(key)
+            self._expire(key, queue)
+            if queue:
+                self._counts["hits"] += 1
+                return queue.popleft()[1]
+            self._counts["misses"] += 1
+            return None
+
+    def _expire(self, key: str, queue: Optional[Deque[Tuple[float, str]]]):
+        if not queue or not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        while queue and queue[0][0] < cutoff:
+            queue.popleft()
+            self._counts["expired"] += 1
+
+    # ---------------- refill ----------------
+    def themes(self) -> List[str]:
+        """Pooled themes: the seeds, then the most requested keys, up to max_themes."""
+        with self._lock:
+            popular = sorted((k for k, n in self._demand.items() if n >= self.min_requests),
+                             key=lambda k: -self._demand[k])
+        themes = list(dict.fromkeys(self._seeds + popular))
+        return themes[:self.max_themes]
+
+    def refill_once(self) -> int:
+        """
+        Starts generation for pooled themes below their size, at most `workers` at a time
+        and only while idle(); returns the number started.
+        """
+        themes = self.themes()
+        started = 0
+        with self._lock:
+            for key in list(self._stories):
+                if key not in themes:
+                    self._counts["dropped"] += len(self._stories.pop(key))
+            wanted = []
+            for key in themes:
+                queue = self._stories.setdefault(key, deque())
+                self._expire(key, queue)
+                if len(queue) < self.size and key not in self._pending and len(self._pending) < self.workers:
+                    self._pending.add(key)
+                    wanted.append(key)
+        for key in wanted:
+            if not self._idle():
+                with self._lock:
+                    self._pending.discard(key)
+                continue
+            self._workers.submit(self._fill, key)
+            started += 1
+        return started
+
+    def _fill(self, key: str):
+        try:
+            story = self._generate(key)
+        except Exception as e:
+            print(f"Story pool refill for {key!r} failed: {e}")
+            story = None
+        with self._lock:
+            self._pending.discard(key)
+            if story is None:
+                self._counts["refill_failures"] += 1
+                return
+            self._counts["refills"] += 1
+            queue = self._stories.get(key)
+            if queue is not None and len(queue) < self.size:
+                queue.append((time.time(), story))
+
+    def start(self):
+        """Starts the background refill loop (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="story-pool-refill", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._workers.shutdown(wait=False)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.refill_once()
+            except Exception as e:
+                print(f"Story pool refill loop error: {e}")
+            self._stop.wait(self.interval)
+
+    # ---------------- stats ----------------
+    def stats(self) -> Dict[str, object]:
+        """Lookup / refill counters, hit rate and pooled stories per theme."""
+        with self._lock:
+            out: Dict[str, object] = dict(self._counts)
+            lookups = self._counts["hits"] + self._counts["misses"] + self._counts["unpooled"]
+            out["hit_rate"] = round(self._counts["hits"] / lookups, 4) if lookups else 0.0
+            out["themes"] = {k: len(q) for k, q in self._stories.items()}
+        return out
+
+
+def pool_from_env(generate: Callable[[str], Optional[str]], idle: Callable[[], bool] = lambda: True) -> StoryPool:
+    return StoryPool(
+        generate,
+        seed_themes=[t for t in os.getenv("STORY_POOL_THEMES", "animals,king,friendship,space").split(",") if t.strip()],
+        size=int(os.getenv("STORY_POOL_SIZE", "3")),
+        ttl=float(os.getenv("STORY_POOL_TTL_SECONDS", str(6 * 3600))),
+        max_themes=int(os.getenv("STORY_POOL_MAX_THEMES", "32")),
+        min_requests=int(os.getenv("STORY_POOL_MIN_REQUESTS", "3")),
+        workers=int(os.getenv("STORY_POOL_WORKERS", "2")),
+        interval=float(os.getenv("STORY_POOL_INTERVAL_SECONDS", "5")),
+        idle=idle,
+    )
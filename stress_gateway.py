@@ -0,0 +1,175 @@
+# stress_gateway.py
+"""
+Checks llm_gateway.py against fake_llm_server.py with injected latency, 429s,
+503s and slow tail requests.
+
+Fires a stream of router-style calls through one gateway (from a thread pool and
+from an event loop) and verifies that:
+  - every call succeeds despite the injected failures (retries with backoff),
+  - the upstream never sees more concurrent requests than the concurrency cap,
+  - the request rate stays within the RPM budget (plus the bucket's burst),
+  - a call under a short deadline fails fast with DeadlineExceeded,
+  - without a deadline, a rate-limit backlog longer than the attempt timeout is
+    waited out instead of failing,
+  - a hedge that finds no free slot does not use up a rate token,
+and reports latency percentiles with and without hedging.
+
+    python stress_gateway.py
+    python stress_gateway.py --calls 400 --clients 16 --concurrency 8 --rpm 3000
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from fake_llm_server import start_server
+from llm_gateway import DeadlineExceeded, HttpChatModel, LLMGateway, deadline
+
+ROUTER_PROMPT = 'You are a routing system for a story generator.\nUser Request: "tell me a story about a fox"'
+
+
+def _percentiles(samples: List[float]) -> str:
+    q = statistics.quantiles(samples, n=100)
+    return f"p50 {q[49] * 1000:.0f} ms, p95 {q[94] * 1000:.0f} ms, p99 {q[98] * 1000:.0f} ms"
+
+
+def _run_sync(gateway: LLMGateway, llm: HttpChatModel, calls: int, clients: int,
+              hedge_after: Optional[float]) -> Tuple[List[float], int]:
+    def one(_):
+        t0 = time.perf_counter()
+        try:
+            gateway.invoke(llm, ROUTER_PROMPT, hedge_after=hedge_after)
+            return time.perf_counter() - t0, 0
+        except Exception as e:
+            print(f"  call failed: {e}")
+            return time.perf_counter() - t0, 1
+
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(one, range(calls)))
+    return [r[0] for r in results], sum(r[1] for r in results)
+
+
+def _run_async(gateway: LLMGateway, llm: HttpChatModel, calls: int, clients: int,
+               hedge_after: Optional[float]) -> Tuple[List[float], int]:
+    async def one(sem: asyncio.Semaphore):
+        async with sem:
+            return await timed()
+
+    async def timed():
+        t0 = time.perf_counter()
+        try:
+            await gateway.ainvoke(llm, ROUTER_PROMPT, hedge_after=hedge_after)
+            return time.perf_counter() - t0, 0
+        except Exception as e:
+            print(f"  call failed: {e}")
+            return time.perf_counter() - t0, 1
+
+    async def main():
+        sem = asyncio.Semaphore(clients)
+        return await asyncio.gather(*(one(sem) for _ in range(calls)))
+
+    results = asyncio.run(main())
+    return [r[0] for r in results], sum(r[1] for r in results)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--calls", type=int, default=200)
+    ap.add_argument("--clients", type=int, default=6, help="calls in flight from the caller side")
+    ap.add_argument("--concurrency", type=int, default=12, help="gateway cap per model")
+    ap.add_argument("--rpm", type=float, default=6000)
+    ap.add_argument("--latency-ms", type=float, default=40)
+    ap.add_argument("--jitter-ms", type=float, default=10)
+    ap.add_argument("--tail-rate", type=float, default=0.03)
+    ap.add_argument("--tail-ms", type=float, default=1500)
+    ap.add_argument("--throttle-rate", type=float, default=0.05)
+    ap.add_argument("--error-rate", type=float, default=0.03)
+    ap.add_argument("--hedge-after", type=float, default=0.15)
+    args = ap.parse_args()
+
+    ok = True
+    for mode, runner in (("threads", _run_sync), ("asyncio", _run_async)):
+        for hedge_after in (None, args.hedge_after):
+            server = start_server(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                  tail_rate=args.tail_rate, tail_ms=args.tail_ms,
+                                  throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            gateway = LLMGateway(max_concurrency=args.concurrency, rpm=args.rpm, max_retries=5,
+                                 backoff_base=0.05, backoff_max=0.5, attempt_timeout=5.0)
+            llm = HttpChatModel(url, model="fake-llm")
+
+            t0 = time.perf_counter()
+            latencies, failures = runner(gateway, llm, args.calls, args.clients, hedge_after)
+            elapsed = time.perf_counter() - t0
+            counts = dict(server.counts)
+            stats = gateway.stats()["fake-llm"]
+            server.shutdown()
+
+            # The bucket starts full (10 s worth of requests), then refills at rpm/60 per second.
+            allowed = args.rpm / 60 * 10 + args.rpm / 60 * elapsed
+            label = f"[{mode}, {'hedge after %.2fs' % hedge_after if hedge_after else 'no hedging'}]"
+            print(f"{label} {args.calls} calls in {elapsed:.2f}s: {_percentiles(latencies)}")
+            print(f"  upstream: {counts['requests']} requests, {counts['throttled']} x 429, "
+                  f"{counts['errors']} x 503, {counts['slow']} slow, max in flight {counts['max_in_flight']}")
+            print(f"  gateway:  retries {stats['retries']}, hedges {stats['hedges']} "
+                  f"(won {stats['hedge_wins']}), throttled waits {stats['throttled']}, failures {failures}")
+            if failures:
+                ok = False
+            if counts["max_in_flight"] > args.concurrency:
+                print(f"  FAIL: {counts['max_in_flight']} concurrent upstream requests > cap {args.concurrency}")
+                ok = False
+            if counts["requests"] > allowed:
+                print(f"  FAIL: {counts['requests']} requests exceed the RPM budget ({allowed:.0f})")
+                ok = False
+
+    server = start_server(latency_ms=2000, jitter_ms=0)
+    gateway = LLMGateway(attempt_timeout=30.0)
+    llm = HttpChatModel(f"http://127.0.0.1:{server.server_address[1]}", model="slow-llm")
+    t0 = time.perf_counter()
+    try:
+        with deadline(0.3):
+            gateway.invoke(llm, ROUTER_PROMPT)
+        print("FAIL: call under a 0.3 s deadline did not time out")
+        ok = False
+    except DeadlineExceeded:
+        waited = time.perf_counter() - t0
+        print(f"deadline: 0.3 s budget raised DeadlineExceeded after {waited:.2f}s")
+        ok = ok and waited < 0.6
+    server.shutdown()
+
+    # Drain the bucket (60 rpm: a burst of 10, then one per second), so the last calls
+    # wait ~1 s each for a token, far longer than the attempt timeout.
+    server = start_server(latency_ms=5, jitter_ms=0)
+    gateway = LLMGateway(rpm=60, attempt_timeout=0.2, max_retries=0)
+    llm = HttpChatModel(f"http://127.0.0.1:{server.server_address[1]}", model="rpm-llm")
+    t0 = time.perf_counter()
+    try:
+        for _ in range(12):
+            gateway.invoke(llm, ROUTER_PROMPT)
+        print(f"rate backlog: 12 calls at 60 rpm waited {time.perf_counter() - t0:.2f}s without failing")
+    except Exception as e:
+        print(f"FAIL: rate backlog with no deadline raised {type(e).__name__}: {e}")
+        ok = False
+    server.shutdown()
+
+    # One slot, held by the primary: the hedge must give up without taking a token.
+    server = start_server(latency_ms=300, jitter_ms=0)
+    gateway = LLMGateway(max_concurrency=1, rpm=60)
+    llm = HttpChatModel(f"http://127.0.0.1:{server.server_address[1]}", model="hedge-llm")
+    gateway.invoke(llm, ROUTER_PROMPT, hedge_after=0.05)
+    bucket = gateway._budget(llm).bucket
+    print(f"hedge without a slot: {bucket.capacity - bucket._tokens:.2f} rate tokens used for 1 call")
+    if bucket._tokens < bucket.capacity - 1.5:
+        print("FAIL: the hedge took a rate token although it was never sent")
+        ok = False
+    server.shutdown()
+
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# stress_store.py
+"""
+Concurrency stress check for memory_store.py.
+
+Spawns several processes, each running several threads, that append messages to
+hundreds of sessions at once. Half of the sessions are shared by every writer, so
+same-session contention is exercised too. Afterwards every session is read back and
+checked for lost, duplicated or reordered messages.
+
+    python stress_store.py                      # every backend
+    python stress_store.py --backend sqlite --processes 8 --threads 16
+
+`sharded` spreads the sessions over four SQLite files; `redis` runs against a
+fake_redis_server.py started in this process (every worker process is a client).
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple
+
+from memory_store import (JsonMessageHistoryStore, RedisMessageHistoryStore,
+                          ShardedMessageHistoryStore, SqliteMessageHistoryStore)
+
+BACKENDS = ["sqlite", "json", "sharded", "redis"]
+SHARDS = 4
+
+
+def _open_store(backend: str, path: str):
+    """`path` is a file for the file backends and a redis:// URL for redis."""
+    if backend == "json":
+        return JsonMessageHistoryStore(path)
+    if backend == "sharded":
+        base = os.path.splitext(path)[0]
+        return ShardedMessageHistoryStore([SqliteMessageHistoryStore(f"{base}-{i}.db") for i in range(SHARDS)])
+    if backend == "redis":
+        return RedisMessageHistoryStore(path)
+    return SqliteMessageHistoryStore(path)
+
+
+def _sessions_for(writer: str, shared: int, private: int) -> List[str]:
+    return [f"shared-{i}" for i in range(shared)] + [f"{writer}-own-{i}" for i in range(private)]
+
+
+def _thread_work(store, writer: str, shared: int, private: int, messages: int):
+    sessions = _sessions_for(writer, shared, private)
+    for n in range(messages):
+        for sid in sessions:
+            store.append_messages(sid, [{"role": "human", "content": f"{writer}:{n}"}])
+
+
+def _process_work(backend: str, path: str, proc: int, threads: int,
+                  shared: int, private: int, messages: int):
+    store = _open_store(backend, path)
+    workers = [
+        threading.Thread(target=_thread_work,
+                         args=(store, f"p{proc}t{t}", shared, private, messages))
+        for t in range(threads)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+def _verify(store, writers: List[str], shared: int, private: int, messages: int) -> List[str]:
+    """Returns a list of human-readable problems (empty when everything survived)."""
+    problems = []
+    expected = {f"shared-{i}": writers for i in range(shared)}
+    for w in writers:
+        for i in range(private):
+            expected[f"{w}-own-{i}"] = [w]
+
+    for sid, owners in expected.items():
+        seen = {}
+        for m in store.get_history(sid):
+            writer, n = m["content"].split(":")
+            seen.setdefault(writer, []).append(int(n))
+        for w in owners:
+            got = seen.get(w, [])
+            if got != list(range(messages)):
+                problems.append(f"{sid}: writer {w} has {len(got)}/{messages} messages in order")
+    return problems
+
+
+def run(backend: str, processes: int, threads: int, shared: int, private: int,
+        messages: int) -> Tuple[bool, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stress.json" if backend == "json" else "stress.db")
+        server = None
+        if backend == "redis":
+            from fake_redis_server import start_server
+            server = start_server()
+            path = f"redis://127.0.0.1:{server.server_address[1]}/0"
+        _open_store(backend, path)  # create schema / file before the workers race
+
+        start = time.perf_counter()
+        procs = [
+            mp.Process(target=_process_work,
+                       args=(backend, path, p, threads, shared, private, messages))
+            for p in range(processes)
+        ]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        crashed = [p.pid for p in procs if p.exitcode != 0]
+        writers = [f"p{p}t{t}" for p in range(processes) for t in range(threads)]
+        problems = _verify(_open_store(backend, path), writers, shared, private, messages)
+
+        sessions = shared + len(writers) * private
+        writes = len(writers) * (shared + private) * messages
+        print(f"[{backend}] {processes} procs x {threads} threads, {sessions} sessions, "
+              f"{writes} appends in {elapsed:.2f}s ({writes / elapsed:.0f}/s)")
+        for pid in crashed:
+            print(f"  worker process {pid} crashed")
+        for line in problems[:20]:
+            print(f"  LOST: {line}")
+        if len(problems) > 20:
+            print(f"  ... and {len(problems) - 20} more")
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        return not crashed and not problems, elapsed
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--backend", choices=BACKENDS + ["all"], default="all")
+    ap.add_argument("--processes", type=int, default=4)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--shared", type=int, default=8, help="sessions written by every thread")
+    ap.add_argument("--private", type=int, default=8, help="sessions owned by a single thread")
+    ap.add_argument("--messages", type=int, default=5, help="messages per thread per session")
+    args = ap.parse_args()
+
+    backends = BACKENDS if args.backend == "all" else [args.backend]
+    ok = True
+    for backend in backends:
+        passed, _ = run(backend, args.processes, args.threads, args.shared,
+                        args.private, args.messages)
+        ok = ok and passed
+    print("OK: no messages lost" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+# tests/conftest.py
+"""
+Offline configuration for the tests: the in-process fake LLM backend, no warm-up
+thread, no background store maintenance, and session files in a temp directory.
+story_engine reads its settings at import, so they are set before anything imports it.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="story-tests-")
+os.environ.update({
+    "LLM_BACKEND": "fake",
+    "FAKE_LLM_LATENCY_MS": "*=fixed:0",
+    "ENGINE_WARMUP": "false",
+    "MEMORY_DB_PATH": os.path.join(_TMP, "sessions.db"),
+    "MEMORY_JSON_PATH": os.path.join(_TMP, "none.json"),
+    "SESSION_MAINTENANCE_SECONDS": "0",
+    "LLM_CACHE_ROUTES": "none",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    from memory_store import SqliteMessageHistoryStore
+    return SqliteMessageHistoryStore(str(tmp_path / "sessions.db"), hot_window=40)
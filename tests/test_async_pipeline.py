@@ -0,0 +1,48 @@
+# tests/test_async_pipeline.py
+import asyncio
+import json
+
+import asgi_app
+import story_engine_async
+from story_engine import SessionContext
+
+
+def _request(method, path, body=b""):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [], "query_string": b""}
+    asyncio.run(asgi_app.app(scope, receive, send))
+    return sent[0]["status"], json.loads(sent[1]["body"])
+
+
+def test_health():
+    assert _request("GET", "/health")[0] == 200
+
+
+def test_empty_message_gets_a_prompt_back():
+    status, payload = _request("POST", "/chat", b'{"session": "s1", "message": "  "}')
+    assert status == 200
+    assert payload["type"] == "chat"
+
+
+def test_unknown_path():
+    assert _request("GET", "/nope")[0] == 404
+
+
+def test_speculative_draft_keeps_the_name(sqlite_store, monkeypatch):
+    # The LLM router path with a speculative draft: the name given in the message
+    # must reach the store once the turn is flushed.
+    monkeypatch.setattr(story_engine_async, "SPECULATIVE_DRAFT", True)
+    monkeypatch.setattr(story_engine_async, "fast_path_intent", lambda *_: None)
+    ctx = SessionContext("s1", store=sqlite_store)
+    story, kind, _ = asyncio.run(story_engine_async.ahandle_user_message(
+        "s1", "my name is Mia, tell me a story about a dragon", ctx))
+    assert kind == "story"
+    assert sqlite_store.get_current_story("s1") == story
+    assert sqlite_store.get_summary("s1")["name"] == "Mia"
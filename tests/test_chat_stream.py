@@ -0,0 +1,20 @@
+# tests/test_chat_stream.py
+import metrics
+from story_engine import TYPING_MARKER, stream_user_message
+
+
+def test_stream_turn_runs_in_the_callers_context():
+    with metrics.count_llm_calls() as count:
+        chunks = list(stream_user_message("stream-ctx", "Tell me a story about a fox"))
+    assert f"{TYPING_MARKER} result:story\n" in chunks
+    assert count.calls > 0
+
+
+def test_stream_request_is_recorded():
+    from app_chat import app
+
+    before = metrics.REQUEST_SECONDS.totals().get(("story", "200"), (0, 0.0))[0]
+    response = app.test_client().post("/chat/stream", json={"session": "stream-metrics",
+                                                            "message": "Tell me a story about an owl"})
+    assert f"{TYPING_MARKER} result:story" in response.get_data(as_text=True)
+    assert metrics.REQUEST_SECONDS.totals()[("story", "200")][0] == before + 1
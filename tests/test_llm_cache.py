@@ -0,0 +1,41 @@
+# tests/test_llm_cache.py
+from llm_cache import LLMCache, _DiskTier, make_key
+
+
+def test_key_ignores_case_and_spacing():
+    assert make_key("router", "m", 0.0, "A story about a bunny.") == \
+        make_key("router", "m", 0.0, "a story  about a bunny")
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = LLMCache(disk_path=path)
+    key = make_key("router", "m", 0.0, "tell me a story")
+    assert cache.get(key) is None
+    cache.put(key, "reply")
+    assert cache.get(key) == "reply"
+    fresh = LLMCache(disk_path=path)
+    assert fresh.get(key) == "reply"
+    assert fresh.stats()["router"]["disk_hits"] == 1
+
+
+def test_disk_tier_stays_within_budget(tmp_path):
+    tier = _DiskTier(str(tmp_path / "cache.db"), max_bytes=10_000)
+    for i in range(200):
+        tier.put(f"k{i}", "x" * 100)
+    (total,) = tier._conn().execute("SELECT SUM(size) FROM cache").fetchone()
+    assert total <= 10_000
+    assert tier.get("k199", ttl=0) == "x" * 100  # least recently used entries go first
+    assert tier.get("k0", ttl=0) is None
+
+
+def test_disk_tier_running_total(tmp_path):
+    path = str(tmp_path / "cache.db")
+    tier = _DiskTier(path, max_bytes=10_000)
+    for i in range(200):
+        tier.put(f"k{i % 150}", "x" * 100)
+    conn = tier._conn()
+    assert tier._total == _DiskTier._stored_bytes(conn)
+    assert tier._total <= 10_000
+    assert tier.get("k149", ttl=0) == "x" * 100  # recently written entries survive
+    assert _DiskTier(path, max_bytes=10_000)._total == tier._total  # reseeded at open
@@ -0,0 +1,168 @@
+# tests/test_llm_gateway.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llm_backends import FakeChatModel
+from llm_gateway import DeadlineExceeded, LLMGateway, UpstreamError, _TokenBucket, deadline, rate_limit
+
+PROMPT = "tell me a story about a fox"
+
+
+class _CountingModel:
+    """Records how many calls are in flight at once, across threads and event loops."""
+
+    model = "counting-llm"
+
+    def __init__(self, seconds: float = 0.01):
+        self.seconds = seconds
+        self.in_flight = self.peak = self.calls = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.calls += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def invoke(self, prompt, config=None):
+        self._enter()
+        time.sleep(self.seconds)
+        self._leave()
+        return prompt
+
+    async def ainvoke(self, prompt, config=None):
+        self._enter()
+        await asyncio.sleep(self.seconds)
+        self._leave()
+        return prompt
+
+
+def test_concurrency_cap_is_shared_by_sync_and_async_callers():
+    gateway = LLMGateway(max_concurrency=3)
+    llm = _CountingModel()
+
+    def sync_caller():
+        for _ in range(10):
+            gateway.invoke(llm, "hi")
+
+    async def async_callers():
+        await asyncio.gather(*(gateway.ainvoke(llm, "hi") for _ in range(40)))
+
+    threads = [threading.Thread(target=sync_caller) for _ in range(4)]
+    threads += [threading.Thread(target=asyncio.run, args=(async_callers(),)) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert llm.calls == 120
+    assert llm.peak <= 3
+    assert gateway.stats()["counting-llm"]["in_flight"] == 0
+
+
+def test_cancelled_async_waiter_gives_its_slot_back():
+    gateway = LLMGateway(max_concurrency=1)
+    llm = _CountingModel(seconds=0.05)
+
+    async def main():
+        first = asyncio.ensure_future(gateway.ainvoke(llm, "a"))
+        waiting = asyncio.ensure_future(gateway.ainvoke(llm, "b"))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await first
+        await asyncio.wait_for(gateway.ainvoke(llm, "c"), timeout=1)
+
+    asyncio.run(main())
+    assert gateway.invoke(llm, "d") == "d"
+
+
+class _Throttled(FakeChatModel):
+    """Answers 429 with Retry-After on the first `failures` calls."""
+
+    def __init__(self, failures: int = 1, retry_after: float = 0.2, status: int = 429):
+        super().__init__(model="throttled-llm", latency="*=fixed:0")
+        self.failures = failures
+        self.retry_after = retry_after
+        self.status = status
+
+    def invoke(self, prompt, config=None):
+        if self.failures:
+            self.failures -= 1
+            raise UpstreamError("slow down", status=self.status, retry_after=self.retry_after)
+        return super().invoke(prompt, config)
+
+
+def test_deadline_cuts_a_slow_call_short():
+    gateway = LLMGateway(attempt_timeout=30.0)
+    llm = FakeChatModel(model="slow-llm", latency="*=fixed:500")
+    t0 = time.perf_counter()
+    with pytest.raises(DeadlineExceeded), deadline(0.1):
+        gateway.invoke(llm, PROMPT)
+    assert time.perf_counter() - t0 < 0.4
+
+    async def acall():
+        with deadline(0.1):
+            await gateway.ainvoke(llm, PROMPT)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(acall())
+
+
+def test_rate_wait_past_the_deadline_fails_fast():
+    gateway = LLMGateway(rpm=60)
+    llm = FakeChatModel(model="rpm-llm", latency="*=fixed:0")
+    bucket = gateway._budget(llm).bucket
+    bucket._tokens = 0
+    t0 = time.perf_counter()
+    with pytest.raises(DeadlineExceeded), deadline(0.2):
+        gateway.invoke(llm, PROMPT)
+    assert time.perf_counter() - t0 < 0.1
+
+
+def test_caller_rate_limit_spaces_calls():
+    gateway = LLMGateway()
+    llm = FakeChatModel(model="fast-llm", latency="*=fixed:0")
+    with rate_limit(_TokenBucket(rpm=600, burst=1)):
+        gateway.invoke(llm, PROMPT)
+        t0 = time.perf_counter()
+        gateway.invoke(llm, PROMPT)
+    assert time.perf_counter() - t0 >= 0.08
+    assert gateway.stats()["fast-llm"]["throttled"] == 1
+
+
+def test_hedge_without_a_free_slot_spends_no_rate_token():
+    gateway = LLMGateway(max_concurrency=1, rpm=60)
+    llm = FakeChatModel(model="hedge-llm", latency="*=fixed:150")
+    gateway.invoke(llm, PROMPT, hedge_after=0.03)
+    bucket = gateway._budget(llm).bucket
+    assert bucket._tokens > bucket.capacity - 1.5
+    assert gateway.stats()["hedge-llm"]["hedges"] == 0
+
+
+def test_hedge_is_sent_when_there_is_room():
+    gateway = LLMGateway(max_concurrency=2)
+    llm = FakeChatModel(model="hedge-llm", latency="*=fixed:150")
+    gateway.invoke(llm, PROMPT, hedge_after=0.03)
+    assert gateway.stats()["hedge-llm"]["hedges"] == 1
+
+
+def test_retry_after_is_honoured():
+    gateway = LLMGateway(backoff_base=0.001, backoff_max=0.001)
+    t0 = time.perf_counter()
+    assert gateway.invoke(_Throttled(retry_after=0.2), PROMPT).content
+    assert time.perf_counter() - t0 >= 0.2
+    assert gateway.stats()["throttled-llm"]["retries"] == 1
+
+
+def test_client_errors_are_not_retried():
+    gateway = LLMGateway(backoff_base=0.001, backoff_max=0.001)
+    with pytest.raises(UpstreamError):
+        gateway.invoke(_Throttled(status=400, retry_after=None), PROMPT)
+    stats = gateway.stats()["throttled-llm"]
+    assert (stats["retries"], stats["failures"]) == (0, 1)
@@ -0,0 +1,37 @@
+# tests/test_memory_store.py
+import threading
+
+import pytest
+
+from memory_store import JsonMessageHistoryStore, SqliteMessageHistoryStore, StoreCorruptedError
+
+
+@pytest.fixture(params=["sqlite", "json"])
+def store(request, tmp_path):
+    if request.param == "json":
+        return JsonMessageHistoryStore(str(tmp_path / "sessions.json"))
+    return SqliteMessageHistoryStore(str(tmp_path / "sessions.db"))
+
+
+def test_concurrent_appends_are_kept_in_order(store):
+    def writer(w):
+        for i in range(20):
+            store.append_messages("shared", [{"role": "human", "content": f"{w}:{i}"}])
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    contents = [m["content"] for m in store.get_history("shared")]
+    assert len(contents) == 160
+    for w in range(8):
+        assert [c for c in contents if c.startswith(f"{w}:")] == [f"{w}:{i}" for i in range(20)]
+
+
+def test_corrupted_json_is_not_reset(tmp_path):
+    path = tmp_path / "sessions.json"
+    path.write_text("{not json")
+    with pytest.raises(StoreCorruptedError):
+        JsonMessageHistoryStore(str(path)).get_history("s1")
+    assert path.read_text() == "{not json"
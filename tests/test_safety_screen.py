@@ -0,0 +1,57 @@
+# tests/test_safety_screen.py
+import pytest
+
+from safety_screen import screen
+import story_engine
+
+
+@pytest.mark.parametrize("text, verdict", [
+    ("a bunny who shares carrots with a dragon", "clean"),
+    ("the wolf kills the pig", "unsafe"),
+    ("no fighting please", "review"),
+])
+def test_verdicts(text, verdict):
+    assert screen(text).verdict == verdict
+
+
+@pytest.mark.parametrize("text", [
+    "a friendly killer whale",
+    "a bath bomb that fizzes",
+    "a blood orange tree",
+    "the gunner on the pirate ship",
+])
+def test_harmless_compounds_are_clean(text):
+    assert screen(text).clean
+
+
+@pytest.mark.parametrize("text, verdict", [
+    ("no scary monsters", "review"),
+    ("without any fighting", "review"),
+    ("remove the guns", "review"),
+    ("no fighting or blood", "review"),
+    ("the knight did not hesitate and killed the dragon", "unsafe"),
+    ("no blood, but the wolf kills the pig", "unsafe"),
+])
+def test_negation_covers_only_the_next_phrase(text, verdict):
+    assert screen(text).verdict == verdict
+
+
+def test_instruction_hits_go_to_the_judge():
+    # The fake judge approves, so a lexicon hit alone no longer refuses the request.
+    text = "a hedgehog who stabs a strawberry with a fork"
+    assert screen(text).unsafe
+    assert not story_engine._instruction_is_unsafe(text)
+
+
+def test_instruction_check_uses_the_request_prompt(monkeypatch):
+    calls = []
+
+    def invoke(llm, prompt, run_name, **kwargs):
+        calls.append(prompt)
+        return '{"unsafe": true}'
+
+    monkeypatch.setattr(story_engine, "_invoke", invoke)
+    assert story_engine._instruction_is_unsafe("the wolf kills the pig")
+    assert not story_engine._instruction_is_unsafe("a bunny who shares carrots")
+    assert calls == [story_engine.INSTRUCTION_JUDGE_PROMPT("the wolf kills the pig")]
+    assert "Story Evaluation Tool" not in calls[0]
@@ -0,0 +1,50 @@
+# tests/test_session_context.py
+from memory_store import SqliteMessageHistoryStore
+from story_engine import SessionContext
+
+
+def test_old_messages_move_to_the_archive(tmp_path):
+    store = SqliteMessageHistoryStore(str(tmp_path / "sessions.db"), hot_window=4)
+    messages = [{"role": "human", "content": f"message {i}"} for i in range(20)]
+    for m in messages:
+        store.append_messages("s1", [m])
+    assert len(store.get_history("s1")) <= 6
+    assert store.get_full_history("s1") == messages
+
+
+def test_summary_is_flushed_with_the_turn(sqlite_store):
+    ctx = SessionContext("s1", store=sqlite_store)
+    ctx.append("human", "my name is Mia, tell me a story about a dragon")
+    ctx.remember(theme="a story about a dragon", story="Once upon a time there was a dragon.")
+    ctx.flush()
+    assert ctx.writes == 1
+    summary = sqlite_store.get_summary("s1")
+    assert summary["name"] == "Mia"
+    assert summary["themes"] == {"dragon": 1}
+
+
+def test_name_is_saved_after_summary_was_read(sqlite_store):
+    # summary() merges the queued name update before flush() runs (as the pipeline
+    # does when it personalizes the draft); the name must still be written.
+    ctx = SessionContext("s1", store=sqlite_store)
+    ctx.append("human", "my name is Mia, tell me a story about a dragon")
+    assert ctx.summary()["name"] == "Mia"
+    ctx.flush()
+    assert sqlite_store.get_summary("s1")["name"] == "Mia"
+
+
+def test_flush_without_changes_writes_nothing(sqlite_store):
+    ctx = SessionContext("s1", store=sqlite_store)
+    ctx.summary()
+    ctx.flush()
+    assert ctx.writes == 0
+    assert sqlite_store.session_ids() == []
+
+
+def test_summary_is_written_once(sqlite_store):
+    ctx = SessionContext("s1", store=sqlite_store)
+    ctx.remember(theme="a story about a dragon")
+    ctx.flush()
+    ctx.flush()
+    assert ctx.writes == 1
+    assert sqlite_store.get_summary("s1")["themes"] == {"dragon": 1}
@@ -0,0 +1,15 @@
+# tests/test_story_index.py
+import pytest
+
+pytest.importorskip("numpy")
+
+from story_index import StoryIndex
+
+
+def test_close_request_finds_the_story(tmp_path):
+    index = StoryIndex(str(tmp_path / "index"))
+    index.add("a bunny who shares", "Once upon a time a bunny shared her carrots.", source="a")
+    index.add("a dragon who learns to fly", "A small dragon tried and tried to fly.", source="b")
+    hits = index.search("a story about a bunny that shares", k=1)
+    assert hits and hits[0].story.startswith("Once upon a time a bunny")
+    assert len(StoryIndex(str(tmp_path / "index"))) == 2
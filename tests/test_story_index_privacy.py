@@ -0,0 +1,60 @@
+# tests/test_story_index_privacy.py
+import pytest
+
+pytest.importorskip("numpy")
+
+import story_engine
+
+
+@pytest.fixture
+def story_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(story_engine, "STORY_INDEX_ENABLED", True)
+    monkeypatch.setattr(story_engine, "STORY_INDEX_PATH", str(tmp_path / "index"))
+    monkeypatch.setattr(story_engine, "STORY_INDEX_REUSE", "offer")
+    monkeypatch.setattr(story_engine, "STORY_INDEX_MIN_SCORE", 0.3)
+    monkeypatch.setattr(story_engine, "_story_index", None)
+    yield lambda: story_engine._get_story_index()
+
+
+def test_names_do_not_reach_other_sessions(story_index):
+    req = "a story about my sister Lily and her dog named Biscuit"
+    story_engine._index_story(req, "Lily and her dog Biscuit shared a big red apple. "
+                                   "Moral: sharing makes Lily's apple sweeter.", None, "a")
+    index = story_index()
+    assert len(index) == 1
+    assert "Lily" not in str(index.doc(0)) and "Biscuit" not in str(index.doc(0))
+
+    other, _ = story_engine._reuse_indexed("a story about my sister Rosie and her dog named Max", None, "b")
+    assert other.startswith("Rosie and her dog Max shared")
+    assert "Rosie's apple" in other
+
+    anonymous, _ = story_engine._reuse_indexed("a story about my sister and her dog", None, "c")
+    assert "Lily" not in anonymous and "Biscuit" not in anonymous
+
+
+def test_stories_for_a_named_listener_are_not_indexed(story_index):
+    story_engine._index_story("a story about a dragon", "Mia met a dragon.", "Mia", "a")
+    assert len(story_index()) == 0
+
+
+def test_backfill_strips_names(tmp_path, sqlite_store):
+    from story_index import StoryIndex, _backfill
+    story = lambda text: {"role": "ai", "content": f"[FINAL STORY]\n{text}"}
+    sqlite_store.apply_changes("a", [
+        {"role": "human", "content": "a story about my sister Lily"},
+        story("Lily found a shell on the beach."),
+        {"role": "human", "content": "make it longer"},
+        story("Lily found a shell on the beach and kept it forever."),
+    ])
+    sqlite_store.apply_changes("b", [
+        {"role": "human", "content": "my name is Mia, a story about a dragon"},
+        story("Mia met a kind dragon."),
+    ], summary={"name": "Mia"})
+    sqlite_store.apply_changes("c", [story("A story nobody asked for.")])
+
+    index = StoryIndex(str(tmp_path / "index"))
+    assert _backfill(index, str(tmp_path / "sessions.db"), "") == 2
+    docs = [index.doc(i) for i in range(len(index))]
+    assert all("Lily" not in str(d) and "Mia" not in str(d) for d in docs)
+    assert docs[0]["story"] == "Tamsin found a shell on the beach."
+    assert _backfill(index, str(tmp_path / "sessions.db"), "") == 0
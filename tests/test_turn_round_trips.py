@@ -0,0 +1,63 @@
+# tests/test_turn_round_trips.py
+from collections import Counter
+
+import pytest
+
+import story_engine
+from story_engine import SessionContext
+
+_READS = ("get_history", "get_current_story", "get_summary")
+
+
+class _CountingStore:
+    """Counts the store methods a turn calls."""
+
+    def __init__(self, store):
+        self._store = store
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+def test_history_is_read_once(sqlite_store):
+    sqlite_store.append_messages("s1", [{"role": "human", "content": "hello"}])
+    ctx = SessionContext("s1", store=sqlite_store)
+    assert ctx.messages == ctx.messages == [{"role": "human", "content": "hello"}]
+    assert ctx.reads == 1
+
+
+def test_turn_is_written_in_one_flush(sqlite_store):
+    ctx = SessionContext("s1", store=sqlite_store)
+    ctx.append("human", "tell me a story about a dragon")
+    ctx.save_story("Once upon a time there was a dragon.")
+    ctx.flush()
+    ctx.flush()
+    assert ctx.writes == 1
+    assert [m["role"] for m in sqlite_store.get_history("s1")] == ["human", "ai"]
+
+
+@pytest.mark.parametrize("message, response_type", [
+    ("tell me a story about a dragon", "story"),
+    ("make it shorter please", "refinement"),
+    ("thanks, that was lovely", "chat"),
+])
+def test_one_write_per_turn(sqlite_store, message, response_type):
+    story_engine.handle_user_message("s1", "tell me a story about a fox named Pip",
+                                     SessionContext("s1", store=sqlite_store))
+    store = _CountingStore(sqlite_store)
+    ctx = SessionContext("s1", store=store)
+    _, kind, _ = story_engine.handle_user_message("s1", message, ctx)
+    assert kind == response_type
+    assert all(store.calls[name] <= 1 for name in _READS), store.calls
+    assert set(store.calls) <= {*_READS, "apply_changes"}, store.calls
+    assert store.calls["apply_changes"] == 1
+    assert ctx.writes == 1
+    assert ctx.reads == sum(store.calls[name] for name in _READS)